@@ -0,0 +1,353 @@
+"""Session analytics: what a student's gaze log says about their session.
+
+Loads session logs, in any format events.py reads, per-frame or intervals,
+into a Timeline: NumPy columns with one row per run of identical directions.
+A run holds from its first frame until the next run starts, but at most
+ANALYTICS_MAX_GAP seconds past its last frame, so a disconnect or a stalled
+camera doesn't count as time spent looking anywhere. From that, without a
+Python loop over events:
+
+- time in each state (center, left, right, flagged away, no face),
+- away episodes: unbroken stretches of looking left, right or flagged away,
+  with their count, durations and how many reached the flag,
+- no-face intervals,
+- seconds in each state per minute of the session.
+
+report() turns these into the JSON /result serves with ``?format=json``. Run
+this module to report on many logs at once, spread over a process pool:
+
+    python analytics.py suspicious_behaviour/session_log/ --csv summary.csv
+    python analytics.py logs/*.npz --json reports.jsonl --workers 8
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import events
+from events import Direction
+from session_log import SESSION_LOG_DIR
+
+
+# Seconds a direction is taken to hold after the last frame of its run
+ANALYTICS_MAX_GAP = float(os.environ.get("ANALYTICS_MAX_GAP", "2.0"))
+# Width of the per-minute histogram bins, in seconds
+ANALYTICS_BIN_SECONDS = float(os.environ.get("ANALYTICS_BIN_SECONDS", "60"))
+
+# States in report order
+STATES = (Direction.CENTER, Direction.LEFT, Direction.RIGHT, Direction.AWAY_FLAGGED, Direction.NO_FACE,
+          Direction.UNKNOWN)
+AWAY = (Direction.LEFT, Direction.RIGHT, Direction.AWAY_FLAGGED)
+
+# When a session has logs in several formats (converted copies), the one read
+FORMAT_PREFERENCE = ("npz", "intervals", "events", "jsonl")
+
+# starts and durations in seconds (starts since the epoch), codes as Direction values
+Timeline = namedtuple("Timeline", ["session_id", "starts", "durations", "codes", "frames"])
+
+
+def timeline(session_id, records, max_gap=ANALYTICS_MAX_GAP):
+    """Timeline of EVENT_DTYPE or INTERVAL_DTYPE records"""
+    if not events.is_intervals(records):
+        records = events.run_length_encode(np.sort(records, order="timestamp"))
+    else:
+        records = np.sort(records, order="start")
+    starts = records["start"] / 1e9
+    ends = records["end"] / 1e9
+    if len(records):
+        # Up to the next run, unless the log went quiet in between
+        holds = np.minimum(np.append(starts[1:], ends[-1]), ends + max_gap)
+        durations = np.maximum(holds, ends) - starts
+    else:
+        durations = np.empty(0)
+    return Timeline(session_id, starts, durations, records["code"].astype(np.uint8),
+                    records["frames"].astype(np.int64))
+
+
+def load_jsonl(path):
+    """events.load_records() for JSON Lines logs, parsing timestamps in one go"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if not path.endswith(".json"):
+        # One json.loads() for the whole file is about twice as fast as one per line
+        text = "[" + ",".join(line for line in text.splitlines() if line.strip()) + "]"
+    records = json.loads(text)
+    if not records:
+        return events.session_id_of(path), np.empty(0, dtype=events.EVENT_DTYPE)
+    session_id = records[-1].get("session_id", events.session_id_of(path))
+    codes = np.array([events.encode(record["direction"]) for record in records], dtype=np.uint8)
+    if "start" in records[0]:
+        stamps = [record["start"] for record in records]
+        ends = [record["end"] for record in records]
+        frames = [record["frames"] for record in records]
+    else:
+        stamps = [record["timestamp"] for record in records]
+        ends = None
+    # Timestamps are local time without an offset: numpy reads them as UTC,
+    # so shift by the offset of the first one
+    shift = events._ns(stamps[0]) - np.datetime64(stamps[0], "ns").astype(np.int64)
+    if ends:
+        records = np.empty(len(codes), dtype=events.INTERVAL_DTYPE)
+        records["start"] = np.array(stamps, dtype="datetime64[ns]").astype(np.int64) + shift
+        records["end"] = np.array(ends, dtype="datetime64[ns]").astype(np.int64) + shift
+        records["frames"] = frames
+    else:
+        records = np.empty(len(codes), dtype=events.EVENT_DTYPE)
+        records["timestamp"] = np.array(stamps, dtype="datetime64[ns]").astype(np.int64) + shift
+    records["code"] = codes
+    return session_id, records
+
+
+def load_timeline(path, max_gap=ANALYTICS_MAX_GAP):
+    if events.format_of(path) == "jsonl":
+        session_id, records = load_jsonl(path)
+    else:
+        session_id, records = events.load_records(path)
+    return timeline(session_id, records, max_gap)
+
+
+def episodes(tl, codes):
+    """Merge back-to-back runs with a code in ``codes`` into episodes.
+
+    Returns (starts, durations, run counts per code) of the episodes, the
+    last as an (episodes, len(codes)) array of how many runs of each code
+    went into each episode.
+    """
+    selected = np.isin(tl.codes, codes)
+    ends = tl.starts + tl.durations
+    # A run continues the previous one if nothing was cut off in between
+    continues = np.zeros(len(selected), dtype=bool)
+    continues[1:] = selected[:-1] & (ends[:-1] >= tl.starts[1:] - 1e-6)
+    begins = selected & ~continues
+    ids = (np.cumsum(begins) - 1)[selected]
+    count = int(begins.sum())
+    durations = np.bincount(ids, weights=tl.durations[selected], minlength=count)
+    per_code = np.stack([np.bincount(ids, weights=tl.codes[selected] == code, minlength=count)
+                         for code in codes], axis=1) if count else np.zeros((0, len(codes)))
+    return tl.starts[begins], durations, per_code
+
+
+def time_in_states(tl):
+    """Seconds spent in each of STATES"""
+    seconds = np.bincount(tl.codes, weights=tl.durations, minlength=256)
+    return seconds[list(STATES)]
+
+
+def _time_before(edges, starts, durations):
+    """Seconds covered by the (sorted, disjoint) runs before each edge"""
+    if not len(starts):
+        return np.zeros(len(edges))
+    before = np.concatenate(([0.0], np.cumsum(durations)[:-1]))
+    index = np.searchsorted(starts, edges, side="right") - 1
+    run = np.maximum(index, 0)
+    covered = before[run] + np.clip(edges - starts[run], 0, durations[run])
+    return np.where(index >= 0, covered, 0.0)
+
+
+def histogram(tl, bin_seconds=ANALYTICS_BIN_SECONDS):
+    """Seconds in each of STATES per bin from the session's start, as a (bins, states) array"""
+    if not len(tl.codes):
+        return np.zeros((0, len(STATES)))
+    start = tl.starts[0]
+    end = (tl.starts + tl.durations).max()
+    edges = start + np.arange(int(np.ceil((end - start) / bin_seconds)) + 1) * bin_seconds
+    if len(edges) < 2:
+        edges = np.array([start, start + bin_seconds])
+    columns = []
+    for code in STATES:
+        mask = tl.codes == code
+        columns.append(np.diff(_time_before(edges, tl.starts[mask], tl.durations[mask])))
+    return np.stack(columns, axis=1)
+
+
+def iso(seconds):
+    return datetime.datetime.fromtimestamp(seconds).isoformat(timespec="seconds")
+
+
+def _stats(durations):
+    return {
+        "count": int(len(durations)),
+        "total_s": round(float(durations.sum()), 2),
+        "mean_s": round(float(durations.mean()), 2) if len(durations) else 0.0,
+        "longest_s": round(float(durations.max()), 2) if len(durations) else 0.0,
+    }
+
+
+def report(tl, bin_seconds=ANALYTICS_BIN_SECONDS):
+    """The analytics of one session as a JSON-ready dict"""
+    seconds = time_in_states(tl)
+    tracked = float(seconds.sum())
+    away_starts, away_durations, away_codes = episodes(tl, AWAY)
+    no_face_starts, no_face_durations, _ = episodes(tl, (Direction.NO_FACE,))
+    flagged = away_codes[:, AWAY.index(Direction.AWAY_FLAGGED)] > 0
+    has_runs = len(tl.codes) > 0
+    return {
+        "session_id": tl.session_id,
+        "start": iso(tl.starts[0]) if has_runs else None,
+        "end": iso((tl.starts + tl.durations).max()) if has_runs else None,
+        "duration_s": round(float((tl.starts + tl.durations).max() - tl.starts[0]), 2) if has_runs else 0.0,
+        "tracked_s": round(tracked, 2),
+        "frames": int(tl.frames.sum()),
+        "flagged_frames": int(tl.frames[tl.codes == Direction.AWAY_FLAGGED].sum()),
+        "time_in_state": {code.label: round(float(value), 2) for code, value in zip(STATES, seconds)},
+        "share": {code.label: round(float(value) / tracked, 4) if tracked else 0.0
+                  for code, value in zip(STATES, seconds)},
+        "away_episodes": dict(_stats(away_durations), flagged=int(flagged.sum()),
+                              episodes=[[iso(start), round(float(duration), 2), bool(flag)]
+                                        for start, duration, flag in zip(away_starts, away_durations, flagged)]),
+        "no_face": dict(_stats(no_face_durations),
+                        intervals=[[iso(start), round(float(duration), 2)]
+                                   for start, duration in zip(no_face_starts, no_face_durations)]),
+        "per_minute": {
+            "bin_seconds": bin_seconds,
+            "states": [code.label for code in STATES],
+            "seconds": np.round(histogram(tl, bin_seconds), 2).tolist(),
+        },
+    }
+
+
+def summary(report):
+    """One flat row of a report, for CSV output and log lines"""
+    return {
+        "session_id": report["session_id"],
+        "start": report["start"],
+        "duration_s": report["duration_s"],
+        "frames": report["frames"],
+        "center_share": report["share"][Direction.CENTER.label],
+        "away_s": report["away_episodes"]["total_s"],
+        "away_episodes": report["away_episodes"]["count"],
+        "flagged_episodes": report["away_episodes"]["flagged"],
+        "longest_away_s": report["away_episodes"]["longest_s"],
+        "no_face_s": report["no_face"]["total_s"],
+        "no_face_intervals": report["no_face"]["count"],
+        "flagged_frames": report["flagged_frames"],
+    }
+
+
+def is_session_log(name):
+    try:
+        events.format_of(name)
+    except ValueError:
+        return False
+    return name.startswith("session_")
+
+
+def pick_logs(paths):
+    """One log per session: the preferred format where a session has converted copies"""
+    chosen = {}
+    for path in paths:
+        session_id = events.session_id_of(path)
+        rank = FORMAT_PREFERENCE.index(events.format_of(path))
+        if session_id not in chosen or rank < chosen[session_id][0]:
+            chosen[session_id] = (rank, path)
+    return [path for _, path in chosen.values()]
+
+
+def find_session_log(session_id, directory=SESSION_LOG_DIR):
+    """Path of a session's log in ``directory``, None if it has none"""
+    prefix = f"session_{session_id}."
+    try:
+        names = [name for name in os.listdir(directory) if name.startswith(prefix) and is_session_log(name)]
+    except FileNotFoundError:
+        return None
+    paths = pick_logs(os.path.join(directory, name) for name in names)
+    return paths[0] if paths else None
+
+
+def session_report(session_id, directory=SESSION_LOG_DIR, path=None):
+    """Report of a session from its log at ``path``, or found in ``directory``; None if it has no log"""
+    if path is None or not os.path.exists(path):
+        path = find_session_log(session_id, directory)
+    return report(load_timeline(path)) if path is not None else None
+
+
+def expand_logs(inputs):
+    """Session logs among ``inputs``, directories searched one level deep"""
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if is_session_log(name))
+        else:
+            paths.append(path)
+    return pick_logs(paths)
+
+
+def _report_path(path):
+    try:
+        return path, report(load_timeline(path)), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def run_reports(paths, workers=None, chunksize=16):
+    """Yield (path, report, error) for many logs, in order, on a process pool"""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) < 2:
+        yield from map(_report_path, paths)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        yield from pool.map(_report_path, paths, chunksize=chunksize)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gaze analytics reports for session logs")
+    parser.add_argument("logs", nargs="+", help="session logs, or directories of them (any format events.py reads)")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (default: CPU count)")
+    parser.add_argument("--csv", help="write one summary row per session to this CSV file")
+    parser.add_argument("--json", help="write each full report as one line of this JSON Lines file")
+    parser.add_argument("--quiet", action="store_true", help="don't print a line per session")
+    args = parser.parse_args()
+
+    paths = expand_logs(args.logs)
+    if not paths:
+        print("No session logs found")
+        return
+
+    print(f"Reporting on {len(paths)} session logs on {args.workers or os.cpu_count()} workers...")
+    started = time.perf_counter()
+    csv_file = open(args.csv, "w", newline="", encoding="utf-8") if args.csv else None
+    json_file = open(args.json, "w", encoding="utf-8") if args.json else None
+    rows = None
+    failed = 0
+    totals = {"duration_s": 0.0, "away_s": 0.0, "flagged_episodes": 0, "flagged_sessions": 0}
+    try:
+        for path, session, error in run_reports(paths, workers=args.workers):
+            if error is not None:
+                failed += 1
+                print(f"FAILED {path}: {error}")
+                continue
+            row = summary(session)
+            totals["duration_s"] += row["duration_s"]
+            totals["away_s"] += row["away_s"]
+            totals["flagged_episodes"] += row["flagged_episodes"]
+            totals["flagged_sessions"] += row["flagged_episodes"] > 0
+            if csv_file is not None:
+                if rows is None:
+                    rows = csv.DictWriter(csv_file, fieldnames=list(row))
+                    rows.writeheader()
+                rows.writerow(row)
+            if json_file is not None:
+                json_file.write(json.dumps(session) + "\n")
+            if not args.quiet:
+                print(f"{path}: {row['duration_s']:.0f}s, {row['center_share']:.0%} center, "
+                      f"{row['away_episodes']} away episodes ({row['flagged_episodes']} flagged, "
+                      f"{row['away_s']:.0f}s), {row['no_face_intervals']} without a face ({row['no_face_s']:.0f}s)")
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+        if json_file is not None:
+            json_file.close()
+    elapsed = time.perf_counter() - started
+    print(f"Done: {len(paths) - failed} sessions, {failed} failed, {totals['duration_s'] / 3600:.1f} hours "
+          f"of gaze in {elapsed:.1f}s; {totals['flagged_sessions']} sessions with "
+          f"{totals['flagged_episodes']} flagged away episodes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""Offline gaze analysis of recorded exam sessions.
+
+Re-scores video files, or directories of frame images, with the same
+detection and gaze timers as live sessions and writes the same session logs
+(see session_log.py), one per input:
+
+    python batch.py recordings/*.mp4 --workers 8
+    python batch.py frames/student_42/ --source-fps 10 --log-mode intervals
+
+Inputs are spread over a process pool, one input per job and one warmed-up
+EyeTracker per worker process. Inside each job a reader thread decodes frames
+into a small bounded queue while the worker runs FaceMesh on the previous
+ones, so decoding and inference overlap instead of taking turns.
+
+Frames are sampled at ``--fps`` (default ANALYSIS_FPS, the rate the server
+analyzes live sessions at; 0 analyzes every frame). The gaze timers run on the
+frame's position in the recording rather than the wall clock, so a "looking
+away for 3+ seconds" flag means three seconds of video however fast the batch
+runs. Log timestamps start at the input's modification time.
+
+The same pipeline is available from Python through analyze_source() for one
+input and run_batch() for many.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import events
+from session_log import LOG_FORMAT, LOG_MODE, SESSION_LOG_DIR, session_log_path
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+ANALYSIS_FPS = float(os.environ.get("ANALYSIS_FPS", "3.3"))
+# Frames decoded ahead of inference within one job
+BATCH_PREFETCH = int(os.environ.get("BATCH_PREFETCH", "8"))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def source_session_id(path):
+    """Session id for an input: its file or directory name, made file-name safe"""
+    name = os.path.basename(os.path.normpath(path))
+    if not os.path.isdir(path):
+        name = os.path.splitext(name)[0]
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", name) or "session"
+
+
+def _video_frames(path, fps):
+    """Yield (seconds into the video, frame) for the frames sampled at ``fps``"""
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Can't open video {path}")
+    try:
+        source_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        step = 1.0 / fps if fps else 0.0
+        next_due = 0.0
+        index = 0
+        while True:
+            position = index / source_fps
+            index += 1
+            if position + 1e-9 < next_due:
+                # grab() skips the colour conversion and copy of frames we don't analyze
+                if not cap.grab():
+                    return
+                continue
+            ok, frame = cap.read()
+            if not ok:
+                return
+            next_due += step
+            yield position, frame
+    finally:
+        cap.release()
+
+
+def _directory_frames(path, fps, source_fps):
+    """Yield (seconds, frame) for the images of a directory, in name order"""
+    names = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+    step = 1.0 / fps if fps else 0.0
+    next_due = 0.0
+    for index, name in enumerate(names):
+        position = index / source_fps
+        if position + 1e-9 < next_due:
+            continue
+        frame = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if frame is None:
+            print(f"Skipping unreadable frame {name} in {path}")
+            continue
+        next_due += step
+        yield position, frame
+
+
+def _read_ahead(frame_iter, prefetch):
+    """Run ``frame_iter`` on a reader thread, yielding its frames through a bounded queue"""
+    frames_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        """Queue ``item`` unless the consumer stops first; returns whether it was queued"""
+        while not stop.is_set():
+            try:
+                frames_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for item in frame_iter:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            # Even the end marker and errors wait on a full queue, so they must also give up on stop
+            put(e)
+
+    thread = threading.Thread(target=reader, name="batch-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frames_queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def analyze_source(path, out_dir=SESSION_LOG_DIR, fps=ANALYSIS_FPS, source_fps=10.0, log_format=LOG_FORMAT,
+                   log_mode=LOG_MODE, tracker=None, prefetch=BATCH_PREFETCH):
+    """Analyze one video file or frame directory and write its session log.
+
+    Returns a summary dict with the log path, frame counts and throughput.
+    Uses ``tracker`` if given, otherwise the calling worker's own EyeTracker,
+    reset first so no face tracked in the previous input carries over.
+    """
+    from inference import _worker_tracker
+    from view import GazeState
+
+    tracker = (tracker or _worker_tracker()).reset()
+    state = GazeState()
+    session_id = source_session_id(path)
+    if os.path.isdir(path):
+        frame_iter = _directory_frames(path, fps, source_fps)
+    else:
+        frame_iter = _video_frames(path, fps)
+
+    buffer = events.EventBuffer()
+    start_ns = int(os.path.getmtime(path) * 1e9)
+    started = time.perf_counter()
+    for position, frame in _read_ahead(frame_iter, prefetch):
+        result = state.classify(tracker.detect(frame), frame.shape[1], now=position)
+        buffer.append(events.encode(result["direction"]), start_ns + int(position * 1e9))
+    elapsed = time.perf_counter() - started
+
+    records = np.empty(len(buffer), dtype=events.EVENT_DTYPE)
+    records["timestamp"] = np.frombuffer(buffer.timestamps, dtype=np.int64)
+    records["code"] = np.frombuffer(buffer.codes, dtype=np.uint8)
+    if log_mode == "intervals":
+        records_out = events.run_length_encode(records)
+    else:
+        records_out = records
+
+    os.makedirs(out_dir, exist_ok=True)
+    log_path = session_log_path(session_id, out_dir, log_format, log_mode)
+    events.save_records(log_path, session_id, records_out)
+    return {
+        "source": path,
+        "session_id": session_id,
+        "log": log_path,
+        "frames": len(records),
+        "flagged": int(np.count_nonzero(records["code"] == events.Direction.AWAY_FLAGGED)),
+        "seconds": elapsed,
+        "fps": len(records) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def _init_worker():
+    from inference import _worker_tracker
+    # One process per core already; OpenCV's own thread pool would only oversubscribe them
+    cv2.setNumThreads(1)
+    _worker_tracker()
+
+
+def run_batch(paths, workers=None, **options):
+    """Analyze many inputs on a process pool.
+
+    Yields each input's summary as it finishes (see analyze_source()); an input
+    that fails yields a summary with an ``error`` instead of stopping the batch.
+    """
+    workers = workers or os.cpu_count() or 1
+    # spawn rather than fork, as in inference.py: MediaPipe isn't fork safe
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths)) or 1,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker) as pool:
+        jobs = {pool.submit(analyze_source, path, **options): path for path in paths}
+        for job in as_completed(jobs):
+            try:
+                yield job.result()
+            except Exception as e:
+                yield {"source": jobs[job], "error": str(e)}
+
+
+def expand_inputs(inputs):
+    """Keep frame directories and video files; a directory without images is searched for videos"""
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path) and not any(name.lower().endswith(IMAGE_EXTENSIONS) for name in os.listdir(path)):
+            paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if os.path.isfile(os.path.join(path, name))))
+        else:
+            paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score recorded exam sessions offline and write their session logs")
+    parser.add_argument("inputs", nargs="+", help="video files, directories of frame images, or directories of videos")
+    parser.add_argument("--out", default=SESSION_LOG_DIR, help=f"log directory (default: {SESSION_LOG_DIR})")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (default: CPU count)")
+    parser.add_argument("--fps", type=float, default=ANALYSIS_FPS,
+                        help=f"frames analyzed per second of recording, 0 for every frame (default: {ANALYSIS_FPS})")
+    parser.add_argument("--source-fps", type=float, default=10.0,
+                        help="frame rate of frame directories (default: 10, what the browser sends)")
+    parser.add_argument("--log-format", choices=("jsonl", "binary"), default=LOG_FORMAT)
+    parser.add_argument("--log-mode", choices=("events", "intervals"), default=LOG_MODE)
+    parser.add_argument("--skip-existing", action="store_true", help="skip inputs whose log already exists")
+    args = parser.parse_args()
+
+    paths = expand_inputs(args.inputs)
+    if args.skip_existing:
+        paths = [path for path in paths if not os.path.exists(
+            session_log_path(source_session_id(path), args.out, args.log_format, args.log_mode))]
+    if not paths:
+        print("Nothing to analyze")
+        return
+
+    print(f"Analyzing {len(paths)} inputs on {args.workers or os.cpu_count()} workers...")
+    started = time.perf_counter()
+    total_frames = 0
+    failed = 0
+    for summary in run_batch(paths, workers=args.workers, out_dir=args.out, fps=args.fps,
+                             source_fps=args.source_fps, log_format=args.log_format, log_mode=args.log_mode):
+        if "error" in summary:
+            failed += 1
+            print(f"FAILED {summary['source']}: {summary['error']}")
+            continue
+        total_frames += summary["frames"]
+        print(f"{summary['source']} -> {summary['log']}: {summary['frames']} frames, "
+              f"{summary['flagged']} flagged, {summary['fps']:.1f} fps")
+    elapsed = time.perf_counter() - started
+    print(f"Done: {len(paths) - failed} inputs, {failed} failed, {total_frames} frames in {elapsed:.1f}s "
+          f"({total_frames / elapsed if elapsed > 0 else 0:.1f} fps overall)")
+
+
+if __name__ == "__main__":
+    main()
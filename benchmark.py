@@ -0,0 +1,474 @@
+"""Benchmark of the frame pipeline.
+
+Replays JPEG frames (a directory of .jpg files, a video, or synthetic frames
+with a drawn face that FaceMesh picks up) through the server's own code, in
+up to three modes:
+
+- ``stages``: every step of one frame in isolation, in the order /ws runs
+  them: unpacking the binary message, JPEG decode, cvtColor, FaceMesh,
+  landmark extraction and gaze measurement, gaze classification, JSON
+  serialization of the result and appending it to the session log. Also the
+  whole detect_frame() call, as frames per second and frames per CPU second.
+- ``inprocess``: concurrent sessions against the real /ws endpoint through
+  Starlette's TestClient (no sockets).
+- ``websocket``: concurrent sessions against a uvicorn server started on a
+  local port, over real WebSocket connections.
+
+Each session connects with its own session id, so its events are logged as
+in an exam. The session modes measure frame-to-result latency (from the seq echo of
+``?updates=all``), analyzed frames per second and per server CPU second, and
+server memory growth per session-minute. Results are printed and, with
+``--json``, written out for comparing versions:
+
+    python benchmark.py --json before.json
+    python benchmark.py --modes stages --frames recordings/exam.mp4 --count 500
+    python benchmark.py --modes websocket --sessions 8 --duration 30
+
+Session logs and evidence images go to a temporary directory.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+import frames
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ("stages", "inprocess", "websocket")
+
+
+# --- Frames -----------------------------------------------------------------
+
+def synthetic_face(width, height, center_x, center_y, scale):
+    """A flat cartoon face on a grey background; enough for FaceMesh to track"""
+    image = np.full((height, width, 3), 200, dtype=np.uint8)
+
+    def s(value):
+        return int(value * scale)
+
+    cv2.ellipse(image, (center_x, center_y), (s(90), s(120)), 0, 0, 360, (150, 180, 220), -1)
+    for dx in (-38, 38):
+        eye = (center_x + s(dx), center_y - s(25))
+        cv2.ellipse(image, eye, (s(22), s(11)), 0, 0, 360, (255, 255, 255), -1)
+        cv2.circle(image, eye, s(9), (60, 40, 20), -1)
+        cv2.circle(image, eye, s(4), (0, 0, 0), -1)
+        cv2.line(image, (eye[0] - s(25), eye[1] - s(25)), (eye[0] + s(25), eye[1] - s(27)), (40, 40, 60), s(5))
+    cv2.line(image, (center_x, center_y - s(15)), (center_x - s(8), center_y + s(25)), (110, 140, 190), s(4))
+    cv2.ellipse(image, (center_x, center_y + s(60)), (s(35), s(12)), 0, 0, 180, (80, 80, 180), s(6))
+    return image
+
+
+def synthetic_frames(count, width, height, quality):
+    """JPEGs of a face drifting slowly from side to side"""
+    scale = height / 480
+    jpegs = []
+    for i in range(count):
+        center_x = int(width / 2 + width * 0.1 * np.sin(i / 15))
+        image = synthetic_face(width, height, center_x, height // 2, scale)
+        jpegs.append(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+    return jpegs
+
+
+def load_frames(source, count, width, height, quality):
+    """JPEG bytes of up to ``count`` frames from a directory of .jpg files, a video, or synthetic"""
+    if source is None:
+        return synthetic_frames(count, width, height, quality)
+    if os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source) if name.lower().endswith((".jpg", ".jpeg")))[:count]
+        jpegs = []
+        for name in names:
+            with open(os.path.join(source, name), "rb") as f:
+                jpegs.append(f.read())
+        return jpegs
+    cap = cv2.VideoCapture(source)
+    jpegs = []
+    while len(jpegs) < count:
+        ok, image = cap.read()
+        if not ok:
+            break
+        jpegs.append(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+    cap.release()
+    return jpegs
+
+
+def binary_message(seq, jpeg):
+    return frames.FRAME_HEADER.pack(seq, time.time() * 1000) + jpeg
+
+
+# --- Measurement helpers ----------------------------------------------------
+
+def percentiles(samples_ms):
+    if not samples_ms:
+        return {"count": 0}
+    values = np.asarray(samples_ms)
+    p50, p90, p95, p99 = np.percentile(values, [50, 90, 95, 99])
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p90_ms": round(float(p90), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def rss_bytes(pid=None):
+    """Resident memory of a process (this one by default), or None where /proc isn't available"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_seconds(pid=None):
+    """User + system CPU time of a process (this one by default), or None if unknown"""
+    if pid is None:
+        # Unlike resource.getrusage(), also available on Windows
+        return time.process_time()
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# --- Stages -----------------------------------------------------------------
+
+def bench_stages(jpegs, warmup=5):
+    """Time each pipeline stage per frame, then the whole detect_frame() call"""
+    import filters
+    import gaze
+    from inference import detect_frame, new_tracker
+    from session_log import LogWriter
+    from sessions import Session
+    from view import GazeState
+
+    tracker = new_tracker()
+    state = GazeState()
+    log_writer = LogWriter(directory="bench_session_log")
+    session = Session("benchmark", log_writer.open("benchmark"))
+    stages = {name: [] for name in ("unpack", "decode", "cvtColor", "facemesh", "landmarks", "classify", "json", "log")}
+    clock = time.perf_counter
+
+    for i, jpeg in enumerate(jpegs):
+        raw = frames.RawFrame(binary_message(i, jpeg), True, time.monotonic())
+        t0 = clock()
+        seq, timestamp, payload = frames.unpack_frame(raw)
+        t1 = clock()
+        image = frames.decode_jpeg(payload)
+        t2 = clock()
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        t3 = clock()
+        results = tracker.face_mesh.process(rgb)
+        t4 = clock()
+        sample = None
+        if results.multi_face_landmarks:
+            points = tracker.landmarks.load(results.multi_face_landmarks[0], image.shape[1], image.shape[0])
+            sample = gaze.measure(points, image.shape[1], image.shape[0])
+        t5 = clock()
+        result = state.classify(sample, image.shape[1])
+        t6 = clock()
+        # Serialized the way Starlette's send_json does
+        json.dumps({**result, "seq": seq, "timestamp": timestamp}, separators=(",", ":"), ensure_ascii=False)
+        t7 = clock()
+        session.record(result["direction"])
+        t8 = clock()
+        if i >= warmup:
+            for name, start, end in zip(stages, (t0, t1, t2, t3, t4, t5, t6, t7), (t1, t2, t3, t4, t5, t6, t7, t8)):
+                stages[name].append((end - start) * 1000)
+
+    # The same frames through detect_frame() end to end, as a worker runs them
+    raws = [frames.RawFrame(binary_message(i, jpeg), True, time.monotonic()) for i, jpeg in enumerate(jpegs)]
+    for raw in raws[:warmup]:
+        detect_frame(raw, tracker)
+    timed = raws[warmup:] or raws
+    wall_started, cpu_started = clock(), cpu_seconds()
+    totals = []
+    for raw in timed:
+        started = clock()
+        detect_frame(raw, tracker)
+        totals.append((clock() - started) * 1000)
+    wall, cpu = clock() - wall_started, cpu_seconds() - cpu_started
+
+    session.finish()
+    log_writer.stop()
+    return {
+        "frames": len(jpegs),
+        "face_found": sum(1 for raw in raws if detect_frame(raw, tracker)[3] is not None),
+        "stages": {name: percentiles(values) for name, values in stages.items()},
+        "detect_frame": percentiles(totals),
+        "fps": round(len(timed) / wall, 2),
+        "fps_per_core": round(len(timed) / cpu, 2) if cpu else None,
+        "gaze_filter": filters.GAZE_FILTER,
+    }
+
+
+# --- Sessions ---------------------------------------------------------------
+
+def _session_summary(results, sessions, duration, wall, cpu, rss_before, rss_after):
+    latencies = [latency for result in results for latency in result["latencies"]]
+    sent = sum(result["sent"] for result in results)
+    analyzed = sum(result["analyzed"] for result in results)
+    session_minutes = sessions * duration / 60
+    return {
+        "sessions": sessions,
+        "duration_s": duration,
+        "frames_sent": sent,
+        "frames_analyzed": analyzed,
+        "latency": percentiles(latencies),
+        "analyzed_fps": round(analyzed / wall, 2),
+        "analyzed_fps_per_core": round(analyzed / cpu, 2) if cpu else None,
+        "rss_before_mb": round(rss_before / 2**20, 1) if rss_before else None,
+        "rss_after_mb": round(rss_after / 2**20, 1) if rss_after else None,
+        "rss_growth_mb_per_session_minute": (
+            round((rss_after - rss_before) / 2**20 / session_minutes, 3) if rss_before and rss_after else None),
+    }
+
+
+def _inprocess_session(client, jpegs, fps, duration, result):
+    """One TestClient session: a sender thread paced at ``fps``, this thread receiving results"""
+    sent_at = {}
+    with client.websocket_connect(f"/ws?updates=all&session_id={uuid.uuid4()}", subprotocols=[frames.BINARY_SUBPROTOCOL]) as ws:
+        ws.receive_json()
+
+        def sender():
+            seq = 0
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                sent_at[seq] = time.perf_counter()
+                ws.send_bytes(binary_message(seq, jpegs[seq % len(jpegs)]))
+                seq += 1
+                time.sleep(1 / fps)
+            result["sent"] = seq
+            # The pong tells the receiver the last frame has been read
+            ws.send_text(json.dumps({"type": "ping"}))
+
+        thread = threading.Thread(target=sender, daemon=True)
+        thread.start()
+        while True:
+            message = ws.receive_json()
+            if message.get("type") == "pong":
+                break
+            if "seq" in message and message["seq"] in sent_at:
+                result["analyzed"] += 1
+                result["latencies"].append((time.perf_counter() - sent_at[message["seq"]]) * 1000)
+        thread.join()
+
+
+def bench_inprocess(jpegs, sessions, duration, fps):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        def run(count, seconds):
+            results = [{"sent": 0, "analyzed": 0, "latencies": []} for _ in range(count)]
+            threads = [threading.Thread(target=_inprocess_session, args=(client, jpegs, fps, seconds, result))
+                       for result in results]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return results
+
+        # As many short sessions first, at once, so building their models doesn't count as growth or time
+        run(sessions, 1.0)
+        rss_before, cpu_started, wall_started = rss_bytes(), cpu_seconds(), time.perf_counter()
+        results = run(sessions, duration)
+        wall, cpu, rss_after = time.perf_counter() - wall_started, cpu_seconds() - cpu_started, rss_bytes()
+    return _session_summary(results, sessions, duration, wall, cpu, rss_before, rss_after)
+
+
+async def ws_session(url, jpegs, fps, duration, result):
+    """One WebSocket client: sends binary frames at ``fps`` for ``duration`` seconds, timing each result"""
+    import websockets
+
+    sent_at = {}
+    async with websockets.connect(f"{url}&session_id={uuid.uuid4()}", subprotocols=[frames.BINARY_SUBPROTOCOL], max_size=None) as ws:
+        await ws.recv()
+
+        async def receiver():
+            async for message in ws:
+                data = json.loads(message)
+                if data.get("type") == "pong":
+                    return
+                if "seq" in data and data["seq"] in sent_at:
+                    result["analyzed"] += 1
+                    result["latencies"].append((time.perf_counter() - sent_at[data["seq"]]) * 1000)
+
+        receiving = asyncio.create_task(receiver())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + duration
+        seq = 0
+        while loop.time() < deadline and not receiving.done():
+            sent_at[seq] = time.perf_counter()
+            await ws.send(binary_message(seq, jpegs[seq % len(jpegs)]))
+            seq += 1
+            await asyncio.sleep(1 / fps)
+        result["sent"] = seq
+        await ws.send(json.dumps({"type": "ping"}))
+        await asyncio.wait_for(receiving, 30)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, env=None):
+    """Start uvicorn serving main:app on ``port``, in the current directory; returns the process once it is up"""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, **(env or {})},
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Server didn't start within 60s")
+
+
+def bench_websocket(jpegs, sessions, duration, fps, env=None):
+    port = _free_port()
+    server = start_server(port, env)
+    url = f"ws://127.0.0.1:{port}/ws?updates=all"
+    try:
+        async def run(count, seconds):
+            results = [{"sent": 0, "analyzed": 0, "latencies": []} for _ in range(count)]
+            await asyncio.gather(*(ws_session(url, jpegs, fps, seconds, result) for result in results))
+            return results
+
+        # As in bench_inprocess(), warm up as many sessions as are measured
+        asyncio.run(run(sessions, 1.0))
+        rss_before, cpu_started, wall_started = rss_bytes(server.pid), cpu_seconds(server.pid), time.perf_counter()
+        results = asyncio.run(run(sessions, duration))
+        wall = time.perf_counter() - wall_started
+        cpu_after, rss_after = cpu_seconds(server.pid), rss_bytes(server.pid)
+        cpu = cpu_after - cpu_started if cpu_after is not None and cpu_started is not None else None
+    finally:
+        server.terminate()
+        server.wait()
+    return _session_summary(results, sessions, duration, wall, cpu, rss_before, rss_after)
+
+
+# --- Report -----------------------------------------------------------------
+
+def print_report(report):
+    print(f"Frames: {report['config']['frames']} ({report['config']['source']})")
+    stages = report.get("stages")
+    if stages:
+        print(f"\nStages (ms per frame, face found in {stages['face_found']}/{stages['frames']} frames)")
+        print(f"  {'stage':<14}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}")
+        for name, stats in list(stages["stages"].items()) + [("detect_frame", stages["detect_frame"])]:
+            print(f"  {name:<14}{stats['mean_ms']:>9.3f}{stats['p50_ms']:>9.3f}{stats['p90_ms']:>9.3f}{stats['p99_ms']:>9.3f}")
+        print(f"  detect_frame: {stages['fps']} fps, {stages['fps_per_core']} fps per core")
+    for mode in ("inprocess", "websocket"):
+        summary = report.get(mode)
+        if not summary:
+            continue
+        latency = summary["latency"]
+        print(f"\n{mode}: {summary['sessions']} sessions x {summary['duration_s']}s, "
+              f"{summary['frames_analyzed']}/{summary['frames_sent']} frames analyzed")
+        if latency["count"]:
+            print(f"  latency p50 {latency['p50_ms']}ms, p90 {latency['p90_ms']}ms, p99 {latency['p99_ms']}ms")
+        print(f"  {summary['analyzed_fps']} analyzed fps, {summary['analyzed_fps_per_core']} per core")
+        print(f"  memory {summary['rss_before_mb']} -> {summary['rss_after_mb']} MB, "
+              f"{summary['rss_growth_mb_per_session_minute']} MB per session-minute")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the frame pipeline stage by stage and end to end")
+    parser.add_argument("--frames", help="directory of .jpg frames or a video file (default: synthetic frames)")
+    parser.add_argument("--count", type=int, default=200, help="frames to load (default: 200)")
+    parser.add_argument("--width", type=int, default=640, help="synthetic frame width (default: 640)")
+    parser.add_argument("--height", type=int, default=480, help="synthetic frame height (default: 480)")
+    parser.add_argument("--quality", type=int, default=70, help="JPEG quality of encoded frames (default: 70)")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"comma separated, from {', '.join(MODES)}")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions (default: 4)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per session (default: 10)")
+    parser.add_argument("--client-fps", type=float, default=10.0, help="frames sent per second per session (default: 10)")
+    parser.add_argument("--calibrate", action="store_true", help="let sessions run the gaze calibration first")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(sorted(unknown))}")
+
+    jpegs = load_frames(args.frames, args.count, args.width, args.height, args.quality)
+    if not jpegs:
+        parser.error(f"No frames found in {args.frames}")
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # Session logs and evidence images land in a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix="gaze-benchmark-"))
+    env = {} if args.calibrate else {"CALIBRATION": "0"}
+    os.environ.update(env)
+
+    report = {
+        "config": {
+            "source": args.frames or f"synthetic {args.width}x{args.height}",
+            "frames": len(jpegs),
+            "mean_jpeg_bytes": int(np.mean([len(jpeg) for jpeg in jpegs])),
+            "modes": modes,
+            "sessions": args.sessions,
+            "duration_s": args.duration,
+            "client_fps": args.client_fps,
+            "calibrate": args.calibrate,
+            "env": {key: value for key, value in os.environ.items() if key in (
+                "ANALYSIS_FPS", "INFERENCE_EXECUTOR", "INFERENCE_WORKERS", "INFERENCE_BATCH_SIZE",
+                "INFERENCE_BATCH_WAIT", "GAZE_MODEL", "GAZE_ROI", "GAZE_FILTER",
+                "LOG_FORMAT", "LOG_MODE", "CALIBRATION")},
+        },
+        "system": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "opencv": cv2.__version__ if cv2 is not None else None,
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if "stages" in modes:
+        report["stages"] = bench_stages(jpegs)
+    if "inprocess" in modes:
+        report["inprocess"] = bench_inprocess(jpegs, args.sessions, args.duration, args.client_fps)
+    if "websocket" in modes:
+        report["websocket"] = bench_websocket(jpegs, args.sessions, args.duration, args.client_fps, env)
+
+    print_report(report)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {json_path}")
+
+
+if __name__ == "__main__":
+    main()
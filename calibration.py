@@ -0,0 +1,144 @@
+"""Per-session gaze calibration.
+
+At the start of a /ws connection the server walks the student through a few
+short steps: look at the center of the screen, then at its left and right
+edges. Each step is announced to the page as
+
+    {"type": "calibration", "step": "left", "prompt": "...", "index": 2, "steps": 3}
+
+which shows a target at that spot, and the frames analyzed while the student
+looks at it are collected. The medians become a gaze.Calibration: the
+student's neutral pose as the baseline, and the gaze angles of the screen
+edges for the away limits. The page is told
+``{"type": "calibration", "done": true, "calibrated": ...}`` at the end.
+
+Calibrations are kept in a CalibrationCache keyed by session id, so a
+reconnect (page reload, network blip) picks the old one up instead of
+calibrating again. They are also saved to the session store as JSON, for a
+reconnect that lands on another worker process.
+"""
+import asyncio
+import json
+import os
+import statistics
+import time
+from collections import OrderedDict
+
+import gaze
+
+
+# Set to 0 to skip calibration and classify against straight ahead
+CALIBRATION = os.environ.get("CALIBRATION", "1") == "1"
+# Seconds to let the eyes settle on a target before collecting, and to collect for
+CALIBRATION_SETTLE = float(os.environ.get("CALIBRATION_SETTLE", "0.8"))
+CALIBRATION_STEP_SECONDS = float(os.environ.get("CALIBRATION_STEP_SECONDS", "1.5"))
+# Samples with a face a step needs to count
+CALIBRATION_MIN_SAMPLES = int(os.environ.get("CALIBRATION_MIN_SAMPLES", "3"))
+CALIBRATION_TTL = float(os.environ.get("CALIBRATION_TTL", "14400"))
+CALIBRATION_CACHE_SIZE = int(os.environ.get("CALIBRATION_CACHE_SIZE", "1000"))
+
+CALIBRATION_STEPS = [
+    ("center", "Look at the dot in the center of the screen"),
+    ("left", "Look at the dot on the left edge of the screen"),
+    ("right", "Look at the dot on the right edge of the screen"),
+]
+
+# An edge closer to center than this (or on the wrong side) is treated as not measured
+MIN_EDGE_DEGREES = 3.0
+
+
+class CalibrationCache:
+    """LRU cache of gaze.Calibration by session id, each entry expiring ``ttl`` seconds after it was stored"""
+
+    def __init__(self, max_size=CALIBRATION_CACHE_SIZE, ttl=CALIBRATION_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # session id -> (calibration, expires at), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        calibration, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[session_id]
+            return None
+        self._entries.move_to_end(session_id)
+        return calibration
+
+    def put(self, session_id, calibration):
+        self._entries[session_id] = (calibration, time.monotonic() + self.ttl)
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, session_id):
+        self._entries.pop(session_id, None)
+
+
+def to_json(calibration):
+    return json.dumps([list(calibration.baseline), calibration.left, calibration.right])
+
+
+def from_json(text):
+    baseline, left, right = json.loads(text)
+    return gaze.Calibration(gaze.Baseline(*baseline), left, right)
+
+
+def _median(values):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def compute(samples):
+    """Turn ``{step: [GazeSample, ...]}`` into a gaze.Calibration, or None without a usable center step"""
+    center = samples.get("center", [])
+    if len(center) < CALIBRATION_MIN_SAMPLES:
+        return None
+    baseline = gaze.Baseline(
+        _median(sample.ratio_x for sample in center),
+        _median(sample.ratio_y for sample in center),
+        _median(sample.yaw for sample in center) or 0.0,
+        _median(sample.pitch for sample in center) or 0.0,
+    )
+
+    def edge(step, sign):
+        step_samples = samples.get(step, [])
+        if len(step_samples) < CALIBRATION_MIN_SAMPLES:
+            return None
+        angle = _median(gaze.gaze_angles(sample, baseline)[0] for sample in step_samples)
+        if angle * sign < MIN_EDGE_DEGREES:
+            # The student didn't follow the target, or the screen is too small to tell
+            return None
+        return angle
+
+    return gaze.Calibration(baseline, edge("left", 1), edge("right", -1))
+
+
+async def run(websocket, next_sample, steps=CALIBRATION_STEPS, settle=CALIBRATION_SETTLE,
+              step_seconds=CALIBRATION_STEP_SECONDS):
+    """Walk the page through the calibration steps and return the gaze.Calibration (None if it failed).
+
+    ``next_sample(timeout)`` is a coroutine function returning the GazeSample
+    of the next analyzed frame, or None when it had no face or no frame came
+    within ``timeout`` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    samples = {}
+    for index, (step, prompt) in enumerate(steps, 1):
+        await websocket.send_json({"type": "calibration", "step": step, "prompt": prompt,
+                                   "index": index, "steps": len(steps)})
+        collected = samples[step] = []
+        started = loop.time()
+        deadline = started + settle + step_seconds
+        while loop.time() < deadline:
+            sample = await next_sample(deadline - loop.time())
+            if sample is not None and loop.time() - started >= settle:
+                collected.append(sample)
+    calibration = compute(samples)
+    await websocket.send_json({"type": "calibration", "done": True, "calibrated": calibration is not None})
+    return calibration
@@ -0,0 +1,154 @@
+"""Capture profile: what the page should send, decided by the server.
+
+The page used to send full 640x480 JPEGs at quality 0.8 ten times a second,
+while the server analyzes ANALYSIS_FPS of them and FaceMesh needs far less
+than the full frame. On connect, and whenever it changes, /ws now tells the
+page
+
+    {"type": "capture", "fps": 5, "max_width": 480, "quality": 0.7, "crop": [x0, y0, x1, y1]}
+
+and the page captures to match: that many frames a second, scaled down to at
+most max_width pixels wide, at that JPEG quality. ``crop`` is the part of the
+camera frame to send, as fractions of its size, or null for all of it: once a
+face has been found, a padded box around it, sent with the gaze.binary.v2
+header so the server still measures in whole-frame coordinates (see
+frames.py). The crop is kept while the face stays well inside it and dropped
+as soon as the face is lost, so the next frame is searched whole again. It is
+also dropped while the look-away flag is latched: evidence images are saved
+from whole frames only (see whole_frame()), since a face crop can't show what
+the student turned to. That costs the bandwidth of whole frames exactly while
+a student is flagged.
+
+Under load, that is while connections wait for the inference pool, the
+profile is tightened towards CAPTURE_MIN_FPS, CAPTURE_MIN_WIDTH and
+CAPTURE_MIN_QUALITY, and relaxed again once the pool keeps up.
+"""
+import os
+from collections import namedtuple
+
+import frames
+
+
+CAPTURE_PROFILE = os.environ.get("CAPTURE_PROFILE", "1") == "1"
+# The profile without load; the page's own defaults are 10 fps, 640 px and 0.8
+CAPTURE_FPS = float(os.environ.get("CAPTURE_FPS", "5"))
+CAPTURE_MAX_WIDTH = int(os.environ.get("CAPTURE_MAX_WIDTH", "480"))
+CAPTURE_QUALITY = float(os.environ.get("CAPTURE_QUALITY", "0.7"))
+# The profile at full load
+CAPTURE_MIN_FPS = float(os.environ.get("CAPTURE_MIN_FPS", "2"))
+CAPTURE_MIN_WIDTH = int(os.environ.get("CAPTURE_MIN_WIDTH", "320"))
+CAPTURE_MIN_QUALITY = float(os.environ.get("CAPTURE_MIN_QUALITY", "0.5"))
+# Crop the frame to the face (gaze.binary.v2 clients only), with this much
+# padding on each side as a fraction of the face's size
+CAPTURE_CROP = os.environ.get("CAPTURE_CROP", "1") == "1"
+CAPTURE_CROP_PADDING = float(os.environ.get("CAPTURE_CROP_PADDING", "0.6"))
+# Seconds between profile changes that only follow the load
+CAPTURE_UPDATE_INTERVAL = float(os.environ.get("CAPTURE_UPDATE_INTERVAL", "2"))
+
+# Load levels the profile moves between; fewer levels means fewer messages
+LOAD_LEVELS = 3
+# Weight of the newest load reading in the running average
+LOAD_SMOOTHING = 0.2
+
+CaptureProfile = namedtuple("CaptureProfile", ["fps", "max_width", "quality", "crop"])
+
+
+def profile_for(level, crop=None):
+    """Profile at load ``level`` (0 = no load .. LOAD_LEVELS = full load)"""
+    t = level / LOAD_LEVELS
+    fps = CAPTURE_FPS + (CAPTURE_MIN_FPS - CAPTURE_FPS) * t
+    width = CAPTURE_MAX_WIDTH + (CAPTURE_MIN_WIDTH - CAPTURE_MAX_WIDTH) * t
+    quality = CAPTURE_QUALITY + (CAPTURE_MIN_QUALITY - CAPTURE_QUALITY) * t
+    return CaptureProfile(round(fps * 2) / 2, int(width) // 16 * 16, round(quality, 2), crop)
+
+
+def message(profile):
+    return {"type": "capture", "fps": profile.fps, "max_width": profile.max_width, "quality": profile.quality,
+            "crop": list(profile.crop) if profile.crop is not None else None}
+
+
+def executor_load(executor):
+    """0..1: how many frames wait in the inference scheduler, relative to what the pool takes at once"""
+    return min(1.0, executor.waiting / max(1, executor.queue_depth))
+
+
+def crop_around(face, padding=CAPTURE_CROP_PADDING):
+    """Padded crop (x0, y0, x1, y1) around a face box, both as fractions of the frame"""
+    x0, y0, x1, y1 = face
+    pad_x = (x1 - x0) * padding
+    pad_y = (y1 - y0) * padding
+    return (round(max(0.0, x0 - pad_x), 3), round(max(0.0, y0 - pad_y), 3),
+            round(min(1.0, x1 + pad_x), 3), round(min(1.0, y1 + pad_y), 3))
+
+
+def contains(crop, face, padding=CAPTURE_CROP_PADDING):
+    """Whether ``face`` is still well inside ``crop``: at least half the padding away from every cut edge"""
+    margin_x = (face[2] - face[0]) * padding / 2
+    margin_y = (face[3] - face[1]) * padding / 2
+    return ((crop[0] <= 0.0 or face[0] - crop[0] >= margin_x)
+            and (crop[1] <= 0.0 or face[1] - crop[1] >= margin_y)
+            and (crop[2] >= 1.0 or crop[2] - face[2] >= margin_x)
+            and (crop[3] >= 1.0 or crop[3] - face[3] >= margin_y))
+
+
+class CaptureController:
+    """Capture profile of one connection"""
+
+    def __init__(self, crop=CAPTURE_CROP, update_interval=CAPTURE_UPDATE_INTERVAL):
+        self.crop_enabled = crop
+        self.update_interval = update_interval
+        self.load = 0.0
+        self.level = 0
+        self.profile = profile_for(0)
+        self.changed_at = None
+
+    def update(self, eyes, load, now, flagged=False):
+        """Feed one analyzed frame; returns the new profile to send, or None if it stays.
+
+        ``eyes`` is the frame's GazeSample (None without a face), ``load`` the
+        current executor_load(), ``flagged`` whether the look-away flag is
+        latched, which asks for whole frames.
+        """
+        self.load += LOAD_SMOOTHING * (load - self.load)
+        level = self.level
+        # Step one level at a time, with some slack so the level doesn't flap
+        if self.load * LOAD_LEVELS > level + 0.75:
+            level += 1
+        elif self.load * LOAD_LEVELS < level - 0.75:
+            level -= 1
+
+        crop = self.profile.crop
+        face = getattr(eyes, "face", None) if self.crop_enabled and not flagged else None
+        if face is None:
+            crop = None
+        elif crop is None or not contains(crop, face):
+            crop = crop_around(face)
+
+        if crop == self.profile.crop and (level == self.level or now - self.changed_at < self.update_interval):
+            return None
+        self.level = level
+        self.profile = profile_for(level, crop)
+        self.changed_at = now
+        return self.profile
+
+    def start(self, now):
+        """Profile to send when the connection opens"""
+        self.changed_at = now
+        return self.profile
+
+    def whole_frame(self, raw):
+        """Whether a RawFrame is a whole camera frame rather than a face crop.
+
+        Crops still in flight arrive after the crop was dropped, and a crop
+        clamped to the top left corner starts at (0, 0) too, so a
+        gaze.binary.v2 frame counts as whole only if its JPEG is as large as
+        the camera frame its header describes.
+        """
+        if not raw.cropped:
+            return True
+        try:
+            _, _, jpeg = frames.unpack_frame(raw)
+        except ValueError:
+            return False
+        x, y, frame_width, frame_height = frames.frame_origin(raw)
+        return x == 0 and y == 0 and frames.jpeg_size(jpeg) == (frame_width, frame_height)
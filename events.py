@@ -0,0 +1,322 @@
+"""Compact encoding of gaze events.
+
+Directions are stored as one byte codes (Direction) instead of their display
+strings, and timestamps as int64 nanoseconds. In memory, EventBuffer keeps
+both in ``array`` columns; on disk there are two compact formats next to the
+JSON Lines log:
+
+- ``.events``: append-only packed records of EVENT_DTYPE (9 bytes per event,
+  wall clock ns + direction code), readable with ``np.fromfile``.
+- ``.npz``: a finished session as ``timestamps``/``codes`` arrays plus the
+  session id and the code labels.
+
+Since the direction rarely changes between frames, a session can also be
+logged as run-length intervals ``(direction, start, end, frames)``, where
+start/end are the timestamps of the first and last frame of the run
+(INTERVAL_DTYPE, ``.intervals`` when packed, ``.intervals.jsonl`` as JSON
+Lines, or ``.npz`` with ``starts``/``ends``/``frames``/``codes`` arrays).
+
+Run this module to convert logs between formats, or to run-length encode
+per-frame logs:
+
+    python events.py suspicious_behaviour/session_log/*.jsonl --to npz
+    python events.py suspicious_behaviour/session_log/*.events --to intervals
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+from array import array
+from enum import IntEnum
+
+import numpy as np
+
+
+class Direction(IntEnum):
+    CENTER = 0
+    LEFT = 1
+    RIGHT = 2
+    AWAY_FLAGGED = 3
+    NO_FACE = 4
+    UNKNOWN = 255
+
+    @property
+    def label(self):
+        return LABELS[self]
+
+
+# Display strings as returned by GazeState (and logged by older versions)
+LABELS = {
+    Direction.CENTER: "Looking Center",
+    Direction.LEFT: "Looking left",
+    Direction.RIGHT: "looking right",
+    Direction.AWAY_FLAGGED: "Flagged: Looking away for 3+ seconds",
+    Direction.NO_FACE: "No face detected",
+    Direction.UNKNOWN: "Unknown",
+}
+CODES = {label: code for code, label in LABELS.items()}
+
+
+def encode(direction):
+    return CODES.get(direction, Direction.UNKNOWN)
+
+
+# One event on disk: wall clock time in ns since the epoch + direction code
+EVENT_DTYPE = np.dtype([("timestamp", "<i8"), ("code", "u1")])
+# One run of identical directions: first/last frame time (wall clock ns), frame count, code
+INTERVAL_DTYPE = np.dtype([("start", "<i8"), ("end", "<i8"), ("frames", "<u4"), ("code", "u1")])
+
+FORMATS = ("jsonl", "events", "intervals", "npz")
+
+
+class EventBuffer:
+    """Column buffer of events: monotonic ns timestamps and direction codes"""
+
+    __slots__ = ("timestamps", "codes")
+
+    def __init__(self):
+        self.timestamps = array("q")
+        self.codes = array("B")
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, code, timestamp_ns=None):
+        self.timestamps.append(time.monotonic_ns() if timestamp_ns is None else timestamp_ns)
+        self.codes.append(code)
+
+    def to_records(self):
+        """Return the events as an EVENT_DTYPE array with wall clock timestamps"""
+        records = np.empty(len(self), dtype=EVENT_DTYPE)
+        offset = time.time_ns() - time.monotonic_ns()
+        records["timestamp"] = np.frombuffer(self.timestamps, dtype=np.int64) + offset
+        records["code"] = np.frombuffer(self.codes, dtype=np.uint8)
+        return records
+
+
+class IntervalBuffer:
+    """Column buffer of closed intervals, timestamps in monotonic ns"""
+
+    __slots__ = ("starts", "ends", "frames", "codes")
+
+    def __init__(self):
+        self.starts = array("q")
+        self.ends = array("q")
+        self.frames = array("I")
+        self.codes = array("B")
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, code, start, end, frames):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.frames.append(frames)
+        self.codes.append(code)
+
+    def to_records(self):
+        """Return the intervals as an INTERVAL_DTYPE array with wall clock timestamps"""
+        records = np.empty(len(self), dtype=INTERVAL_DTYPE)
+        offset = time.time_ns() - time.monotonic_ns()
+        records["start"] = np.frombuffer(self.starts, dtype=np.int64) + offset
+        records["end"] = np.frombuffer(self.ends, dtype=np.int64) + offset
+        records["frames"] = np.frombuffer(self.frames, dtype=np.uint32)
+        records["code"] = np.frombuffer(self.codes, dtype=np.uint8)
+        return records
+
+
+class RunLengthEncoder:
+    """Collapses a stream of per-frame codes into intervals"""
+
+    __slots__ = ("code", "start", "end", "frames")
+
+    def __init__(self):
+        self.code = None
+        self.start = self.end = 0
+        self.frames = 0
+
+    def update(self, code, timestamp_ns=None):
+        """Add a frame; returns the interval it closed as (code, start, end, frames), or None"""
+        timestamp_ns = time.monotonic_ns() if timestamp_ns is None else timestamp_ns
+        if code == self.code:
+            self.end = timestamp_ns
+            self.frames += 1
+            return None
+        closed = self.flush()
+        self.code = code
+        self.start = self.end = timestamp_ns
+        self.frames = 1
+        return closed
+
+    def flush(self):
+        """Close and return the open interval, if any"""
+        if self.code is None:
+            return None
+        closed = (self.code, self.start, self.end, self.frames)
+        self.code = None
+        return closed
+
+
+def run_length_encode(records):
+    """Turn EVENT_DTYPE records into INTERVAL_DTYPE records"""
+    codes = records["code"]
+    if len(codes) == 0:
+        return np.empty(0, dtype=INTERVAL_DTYPE)
+    starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+    ends = np.concatenate((starts[1:], [len(codes)])) - 1
+    intervals = np.empty(len(starts), dtype=INTERVAL_DTYPE)
+    intervals["start"] = records["timestamp"][starts]
+    intervals["end"] = records["timestamp"][ends]
+    intervals["frames"] = ends - starts + 1
+    intervals["code"] = codes[starts]
+    return intervals
+
+
+def is_intervals(records):
+    return records.dtype == INTERVAL_DTYPE
+
+
+def format_of(path):
+    if path.endswith(".npz"):
+        return "npz"
+    if path.endswith(".events"):
+        return "events"
+    if path.endswith(".intervals"):
+        return "intervals"
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        return "jsonl"
+    raise ValueError(f"Unknown session log format: {path}")
+
+
+def session_id_of(path):
+    name = os.path.basename(path).split(".")[0]
+    return name[len("session_"):] if name.startswith("session_") else name
+
+
+def _iso(timestamp_ns):
+    return datetime.datetime.fromtimestamp(timestamp_ns / 1e9).isoformat()
+
+
+def _ns(iso):
+    return int(datetime.datetime.fromisoformat(iso).timestamp() * 1e9)
+
+
+def jsonl_records(session_id, records):
+    """Yield the JSON Lines of EVENT_DTYPE or INTERVAL_DTYPE records"""
+    if is_intervals(records):
+        for start, end, frames, code in records.tolist():
+            yield json.dumps({
+                "session_id": session_id,
+                "direction": LABELS.get(code, LABELS[Direction.UNKNOWN]),
+                "start": _iso(start),
+                "end": _iso(end),
+                "frames": frames,
+            }) + "\n"
+        return
+    for timestamp, code in records.tolist():
+        yield json.dumps({
+            "session_id": session_id,
+            "timestamp": _iso(timestamp),
+            "direction": LABELS.get(code, LABELS[Direction.UNKNOWN]),
+        }) + "\n"
+
+
+def load_records(path):
+    """Load any session log into (session_id, records).
+
+    records is an EVENT_DTYPE array for per-frame logs and an INTERVAL_DTYPE
+    array for interval logs.
+    """
+    fmt = format_of(path)
+    if fmt == "npz":
+        with np.load(path) as data:
+            session_id = str(data["session_id"])
+            if "starts" in data:
+                records = np.empty(len(data["codes"]), dtype=INTERVAL_DTYPE)
+                records["start"] = data["starts"]
+                records["end"] = data["ends"]
+                records["frames"] = data["frames"]
+            else:
+                records = np.empty(len(data["codes"]), dtype=EVENT_DTYPE)
+                records["timestamp"] = data["timestamps"]
+            records["code"] = data["codes"]
+            return session_id, records
+    if fmt == "events":
+        return session_id_of(path), np.fromfile(path, dtype=EVENT_DTYPE)
+    if fmt == "intervals":
+        return session_id_of(path), np.fromfile(path, dtype=INTERVAL_DTYPE)
+
+    from session_log import read_session_log
+    session_id = session_id_of(path)
+    events = EventBuffer()
+    intervals = IntervalBuffer()
+    for record in read_session_log(path):
+        session_id = record.get("session_id", session_id)
+        code = encode(record["direction"])
+        if "start" in record:
+            intervals.append(code, _ns(record["start"]), _ns(record["end"]), record["frames"])
+        else:
+            events.append(code, _ns(record["timestamp"]))
+    if len(intervals):
+        records = np.empty(len(intervals), dtype=INTERVAL_DTYPE)
+        records["start"] = np.frombuffer(intervals.starts, dtype=np.int64)
+        records["end"] = np.frombuffer(intervals.ends, dtype=np.int64)
+        records["frames"] = np.frombuffer(intervals.frames, dtype=np.uint32)
+        records["code"] = np.frombuffer(intervals.codes, dtype=np.uint8)
+        return session_id, records
+    records = np.empty(len(events), dtype=EVENT_DTYPE)
+    records["timestamp"] = np.frombuffer(events.timestamps, dtype=np.int64)
+    records["code"] = np.frombuffer(events.codes, dtype=np.uint8)
+    return session_id, records
+
+
+def save_records(path, session_id, records):
+    fmt = format_of(path)
+    if fmt == "npz":
+        columns = {"timestamps": records["timestamp"]} if not is_intervals(records) else {
+            "starts": records["start"], "ends": records["end"], "frames": records["frames"]}
+        np.savez_compressed(
+            path,
+            codes=records["code"],
+            session_id=np.array(session_id),
+            labels=np.array([LABELS[code] for code in Direction]),
+            **columns,
+        )
+    elif fmt in ("events", "intervals"):
+        if is_intervals(records) != (fmt == "intervals"):
+            raise ValueError(f"Can't write {'interval' if is_intervals(records) else 'per-frame'} records to {path}")
+        records.tofile(path)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(jsonl_records(session_id, records))
+
+
+def convert(source, target):
+    session_id, records = load_records(source)
+    if format_of(target) == "intervals" and not is_intervals(records):
+        records = run_length_encode(records)
+    save_records(target, session_id, records)
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert session logs between JSON Lines, .events/.intervals and .npz")
+    parser.add_argument("logs", nargs="+", help="session logs (.json, .jsonl, .events, .intervals or .npz)")
+    parser.add_argument("--to", choices=FORMATS, required=True, help="format to convert to")
+    parser.add_argument("--out", help="output directory (default: next to each input)")
+    args = parser.parse_args()
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+    for source in args.logs:
+        name = os.path.basename(source).split(".")[0] + "." + args.to
+        target = os.path.join(args.out or os.path.dirname(source), name)
+        if os.path.abspath(target) == os.path.abspath(source):
+            continue
+        count = convert(source, target)
+        print(f"{source} -> {target} ({count} records, {os.path.getsize(source)} -> {os.path.getsize(target)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Background writer for flagged-frame evidence images.
+
+While a "looking away" flag stays latched, every analyzed frame is flagged,
+which used to mean a JPEG encode and a disk write on the event loop several
+times a second with no upper bound. EvidenceWriter instead:
+
+- writes the JPEG bytes exactly as the browser sent them (no re-encode),
+- keeps at most one image per session every EVIDENCE_MIN_INTERVAL seconds and
+  at most EVIDENCE_MAX_PER_SESSION images per session,
+- skips frames that look the same as the session's previous image, compared
+  with a 64 bit difference hash of a 1/8 scale grayscale decode,
+- does all decoding and disk I/O on its own thread behind a bounded queue,
+  dropping evidence rather than ever blocking the ingest loop.
+"""
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import frames
+import metrics
+
+try:
+    import cv2
+except ImportError:  # evidence is only submitted when eye tracking is available
+    cv2 = None
+
+
+EVIDENCE_DIR = "suspicious_behaviour/image/"
+EVIDENCE_MIN_INTERVAL = float(os.environ.get("EVIDENCE_MIN_INTERVAL", "2.0"))
+EVIDENCE_MAX_PER_SESSION = int(os.environ.get("EVIDENCE_MAX_PER_SESSION", "20"))
+# Frames whose hashes differ in at most this many of 64 bits count as duplicates
+EVIDENCE_HASH_DISTANCE = int(os.environ.get("EVIDENCE_HASH_DISTANCE", "6"))
+EVIDENCE_QUEUE_SIZE = int(os.environ.get("EVIDENCE_QUEUE_SIZE", "64"))
+
+
+def dhash(jpeg):
+    """64 bit difference hash of a JPEG, or None if it can't be decoded"""
+    buffer = np.frombuffer(jpeg, np.uint8)
+    # Reduced decode: the JPEG decoder skips most of the work at 1/8 scale
+    image = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_GRAYSCALE_8) if buffer.size else None
+    if image is None:
+        return None
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+class _SessionEvidence:
+    __slots__ = ("count", "last_submitted", "last_hash")
+
+    def __init__(self):
+        self.count = 0
+        self.last_submitted = 0.0
+        self.last_hash = None
+
+
+class EvidenceWriter:
+    def __init__(self, directory=EVIDENCE_DIR, min_interval=EVIDENCE_MIN_INTERVAL,
+                 max_per_session=EVIDENCE_MAX_PER_SESSION, hash_distance=EVIDENCE_HASH_DISTANCE,
+                 queue_size=EVIDENCE_QUEUE_SIZE, index=None):
+        self.directory = directory
+        # session_index.SessionIndex that written images are recorded in, if any
+        self.index = index
+        self.min_interval = min_interval
+        self.max_per_session = max_per_session
+        self.hash_distance = hash_distance
+        os.makedirs(directory, exist_ok=True)
+        self._sessions = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.skipped_duplicates = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="evidence-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, session_id, raw):
+        """Queue a flagged RawFrame as evidence for a session, if its limits allow.
+
+        Cheap enough to call on the event loop for every flagged frame.
+        """
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._sessions[session_id] = _SessionEvidence()
+        now = time.monotonic()
+        if state.count >= self.max_per_session or now - state.last_submitted < self.min_interval:
+            return False
+        try:
+            self._queue.put_nowait((session_id, raw, time.time()))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        state.last_submitted = now
+        return True
+
+    def forget(self, session_id):
+        """Drop the per-session limits of a finished session"""
+        self._sessions.pop(session_id, None)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                print(f"Error writing evidence image: {e}")
+
+    def _write(self, session_id, raw, timestamp):
+        state = self._sessions.get(session_id)
+        if state is None or state.count >= self.max_per_session:
+            return
+        jpeg = frames.unpack_frame(raw)[2]
+        image_hash = dhash(jpeg)
+        if image_hash is None:
+            return
+        if state.last_hash is not None and bin(image_hash ^ state.last_hash).count("1") <= self.hash_distance:
+            self.skipped_duplicates += 1
+            return
+        path = os.path.join(self.directory, f"{session_id}_{int(timestamp * 1000)}.jpg")
+        started = time.perf_counter()
+        with open(path, "wb") as f:
+            f.write(jpeg)
+        metrics.REGISTRY.observe("evidence_write", time.perf_counter() - started)
+        if self.index is not None:
+            self.index.add_evidence(session_id, timestamp, path, len(jpeg))
+        state.last_hash = image_hash
+        state.count += 1
+        self.written += 1
@@ -0,0 +1,119 @@
+"""Streaming filters for one session's gaze signal.
+
+Deciding every frame from one noisy landmark estimate made the reported
+direction flicker, and a single frame that happened to read as centered reset
+the 3 second look-away timer. GazeFilter sits between measurement and the
+gaze timers with a few floats of state per session:
+
+- a One Euro filter (Casiez et al., CHI 2012) on each continuous signal: a
+  low-pass whose cutoff rises with the signal's speed, so jitter is smoothed
+  while real head turns come through without lag, and
+- hysteresis on the discrete outputs: a new direction label is only reported
+  once it has held for FILTER_HOLD seconds, and looking away only ends once
+  the gaze has been back for FILTER_AWAY_RELEASE seconds, while the start of
+  looking away passes straight through to the timer.
+
+Both are time based rather than frame based, so they behave the same at any
+ANALYSIS_FPS, and robustness no longer depends on analyzing many frames.
+"""
+import math
+import os
+
+
+GAZE_FILTER = os.environ.get("GAZE_FILTER", "1") == "1"
+# One Euro parameters: cutoff (Hz) at rest, and how fast it rises with the
+# signal's speed (per degree/second)
+FILTER_MIN_CUTOFF = float(os.environ.get("FILTER_MIN_CUTOFF", "1.0"))
+FILTER_BETA = float(os.environ.get("FILTER_BETA", "0.05"))
+FILTER_D_CUTOFF = float(os.environ.get("FILTER_D_CUTOFF", "1.0"))
+# Seconds a new direction must hold before it is reported
+FILTER_HOLD = float(os.environ.get("FILTER_HOLD", "0.5"))
+# Seconds of looking back at the screen that end a look-away
+FILTER_AWAY_RELEASE = float(os.environ.get("FILTER_AWAY_RELEASE", "1.0"))
+
+
+def _alpha(cutoff, dt):
+    tau = 1.0 / (2 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter:
+    __slots__ = ("min_cutoff", "beta", "d_cutoff", "value", "speed", "last_time")
+
+    def __init__(self, min_cutoff=FILTER_MIN_CUTOFF, beta=FILTER_BETA, d_cutoff=FILTER_D_CUTOFF):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.value = None
+        self.speed = 0.0
+        self.last_time = None
+
+    def __call__(self, value, now):
+        """Filter one sample taken at ``now`` (seconds) and return the smoothed value"""
+        if self.value is None:
+            self.value, self.last_time = value, now
+            return value
+        dt = now - self.last_time
+        if dt <= 0:
+            return self.value
+        speed = (value - self.value) / dt
+        self.speed += _alpha(self.d_cutoff, dt) * (speed - self.speed)
+        cutoff = self.min_cutoff + self.beta * abs(self.speed)
+        self.value += _alpha(cutoff, dt) * (value - self.value)
+        self.last_time = now
+        return self.value
+
+
+class Hysteresis:
+    """Discrete value that only changes once a new value has held for a while.
+
+    ``hold`` is how long any new value must be seen (on consecutive updates)
+    before it is taken; a value listed in ``hold_for`` uses its own time to be
+    left, e.g. ``{True: 1.0}`` with ``hold=0`` for a flag that sets at once and
+    clears slowly.
+    """
+
+    __slots__ = ("value", "hold", "hold_for", "candidate", "since")
+
+    def __init__(self, hold, hold_for=None, value=None):
+        self.hold = hold
+        self.hold_for = hold_for or {}
+        self.value = value
+        self.candidate = None
+        self.since = None
+
+    def update(self, value, now):
+        if self.value is None or value == self.value:
+            self.value = value
+            self.candidate = None
+            return self.value
+        if value != self.candidate:
+            self.candidate, self.since = value, now
+        if now - self.since >= self.hold_for.get(self.value, self.hold):
+            self.value = value
+            self.candidate = None
+        return self.value
+
+
+class GazeFilter:
+    """Per-session smoothing of gaze angles and debouncing of direction/away"""
+
+    __slots__ = ("horizontal", "pitch", "position", "direction", "away")
+
+    def __init__(self, hold=FILTER_HOLD, away_release=FILTER_AWAY_RELEASE):
+        self.horizontal = OneEuroFilter()
+        self.pitch = OneEuroFilter()
+        # Eye position as a fraction of the frame width (position model); not
+        # in degrees, so no speed term
+        self.position = OneEuroFilter(beta=0.0)
+        self.direction = Hysteresis(hold)
+        self.away = Hysteresis(0.0, {True: away_release}, value=False)
+
+    def smooth_angles(self, horizontal, pitch, now):
+        return self.horizontal(horizontal, now), self.pitch(pitch, now)
+
+    def smooth_position(self, fraction, now):
+        return self.position(fraction, now)
+
+    def debounce(self, direction, away, now):
+        return self.direction.update(direction, now), self.away.update(away, now)
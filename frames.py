@@ -0,0 +1,162 @@
+"""Wire format for camera frames sent by the browser over /ws.
+
+Three encodings are supported and picked at connect time through the WebSocket
+subprotocol the browser offers:
+
+- ``gaze.binary.v1``: one binary message per frame, a fixed 12 byte header
+  (uint32 sequence number + float64 capture timestamp in ms, network byte
+  order) followed by the raw JPEG bytes.
+- ``gaze.binary.v2``: the same with 8 more header bytes, four uint16s placing
+  the JPEG in the camera frame: the frame's width and height, and the x and y
+  of the JPEG's top left corner, all in the JPEG's pixel scale. Lets the page
+  send only the face crop of the capture profile (see capture.py) while
+  landmarks are still measured in whole-frame coordinates.
+- ``gaze.json.v1`` (or no subprotocol at all, for older pages): a text message
+  ``{"type": "frame", "data": "data:image/jpeg;base64,..."}``.
+"""
+import asyncio
+import base64
+import struct
+import time
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import cv2
+except ImportError:  # decode_jpeg is only reached when eye tracking is available
+    cv2 = None
+
+
+BINARY_SUBPROTOCOL = "gaze.binary.v1"
+CROP_SUBPROTOCOL = "gaze.binary.v2"
+JSON_SUBPROTOCOL = "gaze.json.v1"
+
+FRAME_HEADER = struct.Struct("!Id")
+CROP_HEADER = struct.Struct("!Id4H")
+
+# A frame as received, before any base64 or JPEG decoding. ``payload`` is the
+# binary message (header included) or the data URL string of a JSON message;
+# ``cropped`` is set for binary messages with the gaze.binary.v2 header.
+RawFrame = namedtuple("RawFrame", ["payload", "binary", "received_at", "cropped"], defaults=(False,))
+
+
+def negotiate_protocol(websocket):
+    """Pick the subprotocol to accept from the ones the client offered.
+
+    Returns None for clients that didn't offer any, which keeps the legacy
+    JSON path working for pages that predate the binary protocol.
+    """
+    offered = websocket.scope.get("subprotocols") or []
+    for protocol in (CROP_SUBPROTOCOL, BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL):
+        if protocol in offered:
+            return protocol
+    return None
+
+
+def parse_binary_frame(message, header=FRAME_HEADER):
+    """Split a binary frame message into (seq, timestamp_ms, jpeg_bytes)"""
+    if len(message) <= header.size:
+        raise ValueError(f"Binary frame too short ({len(message)} bytes)")
+    seq, timestamp = header.unpack_from(message)[:2]
+    # memoryview keeps the payload zero-copy until imdecode reads it
+    return seq, timestamp, memoryview(message)[header.size:]
+
+
+def parse_json_frame(image_data):
+    """Turn the base64 data URL of a JSON frame message into JPEG bytes"""
+    # Remove data URL prefix if present
+    _, sep, encoded = image_data.partition(",")
+    return base64.b64decode(encoded if sep else image_data)
+
+
+def unpack_frame(raw):
+    """Return (seq, timestamp_ms, jpeg_bytes) for a RawFrame.
+
+    seq and timestamp are None for JSON frames, which carry neither.
+    """
+    if raw.binary:
+        return parse_binary_frame(raw.payload, CROP_HEADER if raw.cropped else FRAME_HEADER)
+    return None, None, parse_json_frame(raw.payload)
+
+
+def frame_origin(raw):
+    """(x, y, frame_width, frame_height) placing a cropped frame's JPEG in the camera frame, else None"""
+    if not raw.cropped:
+        return None
+    _, _, frame_width, frame_height, x, y = CROP_HEADER.unpack_from(raw.payload)
+    return x, y, frame_width, frame_height
+
+
+# Start-of-frame markers, which carry a JPEG's size; C4, C8 and CC are other segments
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_SOF = struct.Struct("!BHH")
+
+
+def jpeg_size(jpeg_bytes):
+    """(width, height) from a JPEG's header, without decoding it; None if it can't be read"""
+    data = memoryview(jpeg_bytes)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+        length = (data[position + 2] << 8) | data[position + 3]
+        if marker in JPEG_SOF_MARKERS:
+            if position + 4 + JPEG_SOF.size > len(data):
+                return None
+            _, height, width = JPEG_SOF.unpack_from(data, position + 4)
+            return width, height
+        position += 2 + length
+    return None
+
+
+def decode_jpeg(jpeg_bytes):
+    """Decode JPEG bytes into a BGR frame, or None if the data is not an image"""
+    buffer = np.frombuffer(jpeg_bytes, np.uint8)
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+class LatestFrame:
+    """Single-slot mailbox between a connection's receive loop and its analysis loop.
+
+    Putting a frame replaces any frame that hasn't been picked up yet, so the
+    analysis loop always gets the newest frame and frames it was too slow for
+    are dropped before they are ever decoded.
+    """
+
+    def __init__(self):
+        self._frame = None
+        self._ready = asyncio.Event()
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, payload, binary, cropped=False):
+        if self._frame is not None:
+            self.dropped += 1
+        self._frame = RawFrame(payload, binary, time.monotonic(), cropped)
+        self.received += 1
+        self._ready.set()
+
+    async def get(self):
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self._frame = self._frame, None
+        return frame
+
+    def newest(self, frame):
+        """Swap ``frame`` for a newer one if it arrived after ``frame`` was taken"""
+        if self._frame is None:
+            return frame
+        self.dropped += 1
+        self._ready.clear()
+        frame, self._frame = self._frame, None
+        return frame
@@ -0,0 +1,167 @@
+"""Gaze direction from eye geometry and head pose.
+
+The original classifier compared the absolute x of the iris centers against
+fixed fractions of the frame width, so a student sitting off-center was
+"looking away" the whole time. This engine instead measures, from the
+landmark array of one frame (see landmarks.py):
+
+- where each iris sits between the corners of its eye, as a 0..1 ratio
+  horizontally (projected on the corner-to-corner axis, so head roll doesn't
+  matter) and vertically between the lids, and
+- the head's yaw and pitch, from cv2.solvePnP of six landmarks against a
+  generic 3D face model.
+
+The horizontal gaze angle is then the head yaw plus the eye's rotation in the
+head, estimated as GAZE_EYE_DEGREES per unit of iris ratio off center. It is
+classified with the same labels as before: within GAZE_CENTER_DEGREES of
+straight ahead is "Looking Center", past GAZE_AWAY_DEGREES (or a head pitch
+past GAZE_PITCH_DEGREES, e.g. looking down at a phone) counts as looking away
+for the 3 second flag. Head angles are measured from facing the camera, and
+follow the image: positive yaw is toward the right edge of the frame,
+positive pitch is down. A student turned toward the
+left edge of an unmirrored webcam image is looking to their right, which is
+what "looking right" has always meant here.
+
+All angles are relative to a baseline (straight ahead by default). A
+calibration (see calibration.py) replaces it with the student's own neutral
+pose, and moves the away limits to just past where the student's screen
+edges actually are.
+"""
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import landmarks as lm
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+# pose: iris-in-eye ratio plus head pose; position: the original absolute-x thresholds
+GAZE_MODEL = os.environ.get("GAZE_MODEL", "pose")
+GAZE_CENTER_DEGREES = float(os.environ.get("GAZE_CENTER_DEGREES", "10"))
+GAZE_AWAY_DEGREES = float(os.environ.get("GAZE_AWAY_DEGREES", "25"))
+GAZE_PITCH_DEGREES = float(os.environ.get("GAZE_PITCH_DEGREES", "25"))
+# Eye rotation per unit of horizontal iris ratio (0 = one corner, 1 = the other)
+GAZE_EYE_DEGREES = float(os.environ.get("GAZE_EYE_DEGREES", "120"))
+# With a calibration, gaze counts as away this far past the measured screen edge
+GAZE_EDGE_MARGIN = float(os.environ.get("GAZE_EDGE_MARGIN", "5"))
+
+# Eye corners and lids, in the order of landmarks.IRISES (left eye, right eye).
+# Corners go from the left to the right edge of the image, lids top to bottom.
+EYE_CORNERS = np.array([[362, 263], [33, 133]])
+EYE_LIDS = np.array([[386, 374], [159, 145]])
+
+# Landmarks matched to HEAD_MODEL for solvePnP: nose tip, chin, outer eye
+# corners and mouth corners (each pair from the left edge of the image)
+HEAD_POSE_LANDMARKS = np.array([1, 152, 33, 263, 61, 291])
+# Generic face in arbitrary units, camera axes: x right, y down, z away from the camera
+HEAD_MODEL = np.array([
+    (0.0, 0.0, 0.0),
+    (0.0, 330.0, 65.0),
+    (-225.0, -170.0, 135.0),
+    (225.0, -170.0, 135.0),
+    (-150.0, 150.0, 125.0),
+    (150.0, 150.0, 125.0),
+], dtype=np.float64)
+
+# Everything detection measures on one frame. left/right are the iris centers
+# in frame pixels (as EyeTracker.detect() always returned); yaw and pitch are
+# None when solvePnP finds no plausible pose. face is the face's bounding box
+# (x0, y0, x1, y1) as fractions of the frame size
+GazeSample = namedtuple("GazeSample", ["left", "right", "ratio_x", "ratio_y", "yaw", "pitch", "face"],
+                        defaults=(None,))
+
+# Neutral pose a sample is measured against
+Baseline = namedtuple("Baseline", ["ratio_x", "ratio_y", "yaw", "pitch"])
+STRAIGHT_AHEAD = Baseline(0.5, 0.5, 0.0, 0.0)
+
+# A student's own neutral pose, plus the horizontal gaze angles (relative to
+# it) of the left and right screen edges, None where not measured. Looking at
+# the screen's left edge is looking to the student's left, so ``left`` is
+# positive and ``right`` negative
+Calibration = namedtuple("Calibration", ["baseline", "left", "right"])
+
+
+def eye_ratios(points):
+    """Mean (horizontal, vertical) iris position within the eyes, 0.5 = centered"""
+    irises = lm.iris_centers(points)
+    corners = points[EYE_CORNERS, :2]
+    axis = corners[:, 1] - corners[:, 0]
+    offset = irises - corners[:, 0]
+    horizontal = np.einsum("ij,ij->i", offset, axis) / np.einsum("ij,ij->i", axis, axis)
+    lids = points[EYE_LIDS, 1]
+    vertical = (irises[:, 1] - lids[:, 0]) / (lids[:, 1] - lids[:, 0])
+    return float(horizontal.mean()), float(vertical.mean())
+
+
+def head_pose(points, frame_width, frame_height):
+    """(yaw, pitch) of the head in degrees, or (None, None) without a plausible solution"""
+    image_points = points[HEAD_POSE_LANDMARKS, :2].astype(np.float64)
+    # Pinhole camera with the focal length about the frame width, as for a typical webcam
+    camera = np.array([
+        (frame_width, 0.0, frame_width / 2),
+        (0.0, frame_width, frame_height / 2),
+        (0.0, 0.0, 1.0),
+    ])
+    ok, rotation, translation = cv2.solvePnP(HEAD_MODEL, image_points, camera, None, flags=cv2.SOLVEPNP_SQPNP)
+    if not ok or translation[2, 0] <= 0:
+        return None, None
+    matrix, _ = cv2.Rodrigues(rotation)
+    # The face looks along -z in model space
+    forward = -matrix[:, 2]
+    if forward[2] >= 0:
+        # Facing away from the camera: a mirrored solution
+        return None, None
+    # Relative to the line of sight from the head to the camera, so a student
+    # sitting off to one side who faces the camera is at 0, not turned
+    tx, ty, tz = translation[:, 0]
+    yaw = math.degrees(math.atan2(forward[0], -forward[2]) - math.atan2(-tx, tz))
+    pitch = math.degrees(math.atan2(forward[1], -forward[2]) - math.atan2(-ty, tz))
+    return yaw, pitch
+
+
+def measure(points, frame_width, frame_height):
+    """GazeSample of a (478, 3) landmark array in frame pixels"""
+    (left_x, left_y), (right_x, right_y) = lm.iris_centers(points)
+    ratio_x, ratio_y = eye_ratios(points)
+    yaw, pitch = head_pose(points, frame_width, frame_height)
+    min_x, min_y, max_x, max_y = lm.bounds(points)
+    face = (float(min_x) / frame_width, float(min_y) / frame_height,
+            float(max_x) / frame_width, float(max_y) / frame_height)
+    return GazeSample((int(left_x), int(left_y)), (int(right_x), int(right_y)), ratio_x, ratio_y, yaw, pitch, face)
+
+
+def gaze_angles(sample, baseline=STRAIGHT_AHEAD):
+    """Horizontal gaze angle and head pitch of a sample, relative to ``baseline``"""
+    eye = (sample.ratio_x - baseline.ratio_x) * GAZE_EYE_DEGREES
+    if sample.yaw is None:
+        return eye, 0.0
+    return sample.yaw - baseline.yaw + eye, sample.pitch - baseline.pitch
+
+
+def direction_of(sample, calibration=None):
+    """Return (direction label, away) for a sample; ``away`` feeds the look-away timer"""
+    baseline = calibration.baseline if calibration is not None else STRAIGHT_AHEAD
+    return classify_angles(*gaze_angles(sample, baseline), calibration)
+
+
+def classify_angles(horizontal, pitch, calibration=None, center_degrees=GAZE_CENTER_DEGREES,
+                    away_degrees=GAZE_AWAY_DEGREES, pitch_degrees=GAZE_PITCH_DEGREES):
+    """Return (direction label, away) for angles from gaze_angles()"""
+    away_left = away_right = away_degrees
+    if calibration is not None:
+        if calibration.left is not None:
+            away_left = calibration.left + GAZE_EDGE_MARGIN
+        if calibration.right is not None:
+            away_right = -calibration.right + GAZE_EDGE_MARGIN
+    away = horizontal > away_left or horizontal < -away_right or abs(pitch) > pitch_degrees
+    if horizontal < -center_degrees:
+        return "looking right", away
+    if horizontal > center_degrees:
+        return "Looking left", away
+    return "Looking Center", away
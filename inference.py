@@ -0,0 +1,372 @@
+"""Runs FaceMesh inference off the asyncio event loop.
+
+Frame decoding and FaceMesh inference are CPU heavy and used to run inline in
+the /ws handler, blocking every other socket while they ran. The executor
+pushes them to a pool of workers instead:
+
+- ``thread`` (default): a thread pool. Each session checks a warmed-up
+  EyeTracker out of a TrackerPool for as long as it is connected, so FaceMesh
+  stays in tracking mode on that student's face. OpenCV and MediaPipe release
+  the GIL, so the threads run on separate cores.
+- ``process``: a process pool with one EyeTracker per worker process, for when
+  the GIL-bound parts of the pipeline become the bottleneck. Sessions don't
+  hold a model in this mode; frames go to whichever worker is free.
+
+Only detection runs on the workers; the away/no-face timers live in each
+session's GazeState on the event loop.
+
+Scheduling: the InferenceScheduler collects the pending frames of every
+connection and hands them to the pool in micro-batches, one pool job per
+batch. Each connection has at most one frame pending or in flight (its
+analysis loop awaits the result) and one waiting in its mailbox, so taking
+pending frames in arrival order serves the connections round-robin, and a
+slow client can't starve the others. A batch goes out once it is full
+(INFERENCE_BATCH_SIZE) or its oldest frame has waited INFERENCE_BATCH_WAIT,
+and at most ``queue_depth`` frames across all connections are on the pool at
+once. A batch is never larger than the free capacity split across the idle
+workers, so batching can't leave workers idle while frames wait. Each frame's
+result comes back to its connection through a future.
+
+FaceMesh takes one image per call, so a batch is not one vectorized
+inference: its frames run one after the other on the worker that picked the
+job up, each on its own session's model in thread mode. What batching saves
+is the per-frame handoff to the pool, which in process mode is a pickled
+round trip to the worker process. Handing a frame to a thread costs next to
+nothing, so in thread mode frames go out one per job by default. While a connection waits, its mailbox keeps
+only the newest frame, and that is the one that goes out with the batch.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import frames
+import metrics
+
+
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "thread")
+# By default the cores are split between uvicorn's worker processes
+INFERENCE_WORKERS = (int(os.environ.get("INFERENCE_WORKERS", "0"))
+                     or max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", "1"))))
+INFERENCE_QUEUE_DEPTH = int(os.environ.get("INFERENCE_QUEUE_DEPTH", "0")) or 2 * INFERENCE_WORKERS
+# Most frames per pool job (0: 1 in thread mode, PROCESS_BATCH_SIZE in process
+# mode), and seconds a pending frame waits for its batch to fill
+INFERENCE_BATCH_SIZE = int(os.environ.get("INFERENCE_BATCH_SIZE", "0"))
+PROCESS_BATCH_SIZE = 4
+INFERENCE_BATCH_WAIT = float(os.environ.get("INFERENCE_BATCH_WAIT", "0.002"))
+# Most FaceMesh models (and so concurrently tracked sessions) in thread mode,
+# and how many of them are built ahead of the first sessions
+TRACKER_POOL_SIZE = int(os.environ.get("TRACKER_POOL_SIZE", "32"))
+TRACKER_POOL_WARM = int(os.environ.get("TRACKER_POOL_WARM", "1"))
+
+# The EyeTracker of a worker process (process mode)
+_local = threading.local()
+
+
+def new_tracker():
+    """Build an EyeTracker and run a first inference on it"""
+    from view import EyeTracker
+    return EyeTracker().warm_up()
+
+
+def _worker_tracker():
+    tracker = getattr(_local, "tracker", None)
+    if tracker is None:
+        tracker = _local.tracker = new_tracker()
+    return tracker
+
+
+def _warm_worker():
+    _worker_tracker()
+
+
+def detect_frame(raw, tracker=None):
+    """Decode a RawFrame and run FaceMesh on it.
+
+    Uses ``tracker`` if given, otherwise the worker's own EyeTracker. Returns
+    (seq, timestamp, frame_width, eyes). frame_width is None when the payload
+    is not a decodable image; eyes is the output of EyeTracker.detect(). For a
+    cropped frame, frame_width and eyes are in the camera frame's coordinates.
+    """
+    return detect_frame_timed(raw, tracker)[0]
+
+
+def detect_frame_timed(raw, tracker=None):
+    """detect_frame() plus the seconds spent decoding and detecting, as ((...), (decode, inference)).
+
+    The timings travel back with the result, so they also work from a worker process.
+    """
+    started = time.perf_counter()
+    seq, timestamp, jpeg = frames.unpack_frame(raw)
+    frame = frames.decode_jpeg(jpeg)
+    decoded = time.perf_counter()
+    if frame is None:
+        return (seq, timestamp, None, None), (decoded - started, None)
+    tracker = tracker or _worker_tracker()
+    origin = frames.frame_origin(raw)
+    eyes = tracker.detect(frame, origin)
+    frame_width = origin[2] if origin is not None else frame.shape[1]
+    return (seq, timestamp, frame_width, eyes), (decoded - started, time.perf_counter() - decoded)
+
+
+def detect_batch(jobs):
+    """Run detect_frame() on several (raw, tracker, timed) jobs in turn, on one worker.
+
+    timed jobs use detect_frame_timed(). Returns one (ok, result) per job,
+    where result is the exception for a frame that failed, so one bad frame
+    doesn't fail the rest of the batch.
+    """
+    results = []
+    for raw, tracker, timed in jobs:
+        try:
+            results.append((True, (detect_frame_timed if timed else detect_frame)(raw, tracker)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class PendingFrame:
+    __slots__ = ("mailbox", "raw", "tracker", "timed", "future", "since")
+
+    def __init__(self, mailbox, raw, tracker, timed, future, since):
+        self.mailbox = mailbox
+        self.raw = raw
+        self.tracker = tracker
+        self.timed = timed
+        self.future = future
+        self.since = since
+
+
+class InferenceScheduler:
+    """Micro-batches the pending frames of all connections onto an executor pool.
+
+    submit() queues a connection's frame and returns a future for its
+    (raw, result). Batches are dispatched from the event loop, whenever a
+    frame is submitted, a batch finishes or a batch's wait runs out.
+    """
+
+    def __init__(self, pool, workers, queue_depth=INFERENCE_QUEUE_DEPTH, batch_size=1,
+                 max_wait=INFERENCE_BATCH_WAIT):
+        self._pool = pool
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self._pending = deque()
+        self._timer = None
+        self.in_flight = 0
+        # Batch jobs on the pool, running or queued for a worker
+        self.running = 0
+        self.batches = 0
+        self.batched_frames = 0
+        # Trackers with a batch still running on a worker -> that batch's job
+        self.busy = {}
+
+    @property
+    def waiting(self):
+        return len(self._pending)
+
+    def submit(self, mailbox, raw, tracker=None, timed=False):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(PendingFrame(mailbox, raw, tracker, timed, future, loop.time()))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Frames whose connection went away while they waited
+            while self._pending and self._pending[0].future.done():
+                self._pending.popleft()
+            if not self._pending:
+                return
+            capacity = self.queue_depth - self.in_flight
+            if capacity <= 0:
+                # _batch_done() dispatches again
+                return
+            # Spread the capacity over the idle workers rather than
+            # queueing one worker's batch while another has nothing to do
+            idle = self.workers - self.running
+            size = min(self.batch_size, capacity, -(-capacity // idle) if idle > 0 else capacity)
+            deadline = self._pending[0].since + self.max_wait
+            if len(self._pending) < size and loop.time() < deadline:
+                if self._timer is None:
+                    self._timer = loop.call_at(deadline, self._wait_over)
+                return
+            batch = []
+            while self._pending and len(batch) < size:
+                pending = self._pending.popleft()
+                if not pending.future.done():
+                    batch.append(pending)
+            if batch:
+                self._run(batch)
+
+    def _wait_over(self):
+        self._timer = None
+        self._dispatch()
+
+    def _run(self, batch):
+        jobs = []
+        for pending in batch:
+            pending.raw = pending.mailbox.newest(pending.raw)
+            if pending.timed:
+                metrics.REGISTRY.observe("queued", time.monotonic() - pending.raw.received_at)
+            jobs.append((pending.raw, pending.tracker, pending.timed))
+        self.in_flight += len(batch)
+        self.running += 1
+        self.batches += 1
+        self.batched_frames += len(batch)
+        job = asyncio.get_running_loop().run_in_executor(self._pool, detect_batch, jobs)
+        for pending in batch:
+            if pending.tracker is not None:
+                self.busy[pending.tracker] = job
+        job.add_done_callback(lambda job: self._batch_done(job, batch))
+
+    def _batch_done(self, job, batch):
+        self.in_flight -= len(batch)
+        self.running -= 1
+        for pending in batch:
+            if pending.tracker is not None and self.busy.get(pending.tracker) is job:
+                del self.busy[pending.tracker]
+        if job.cancelled():
+            outcomes = [None] * len(batch)
+        elif job.exception() is not None:
+            outcomes = [(False, job.exception())] * len(batch)
+        else:
+            outcomes = job.result()
+        for pending, outcome in zip(batch, outcomes):
+            # Done already if the connection stopped waiting
+            if pending.future.done():
+                continue
+            if outcome is None:
+                pending.future.cancel()
+            elif outcome[0]:
+                pending.future.set_result((pending.raw, outcome[1]))
+            else:
+                pending.future.set_exception(outcome[1])
+        self._dispatch()
+
+
+class TrackerPool:
+    """Bounded pool of warmed-up EyeTracker models.
+
+    Sessions check a model out for the length of their connection and return it
+    when they disconnect. Models are built on demand up to ``max_size``; past
+    that, checkout() waits until a session returns one.
+    """
+
+    def __init__(self, max_size=TRACKER_POOL_SIZE):
+        self.max_size = max_size
+        self.created = 0
+        self._idle = asyncio.Queue()
+
+    @property
+    def in_use(self):
+        return self.created - self._idle.qsize()
+
+    async def add(self, executor_pool):
+        """Build one more model on ``executor_pool`` and park it as idle"""
+        self.created += 1
+        try:
+            tracker = await asyncio.get_running_loop().run_in_executor(executor_pool, new_tracker)
+        except BaseException:
+            self.created -= 1
+            raise
+        self._idle.put_nowait(tracker)
+
+    async def checkout(self, executor_pool):
+        if self._idle.empty() and self.created < self.max_size:
+            await self.add(executor_pool)
+        return await self._idle.get()
+
+    def checkin(self, tracker):
+        self._idle.put_nowait(tracker)
+
+
+class InferenceExecutor:
+    def __init__(self, mode=INFERENCE_EXECUTOR, workers=INFERENCE_WORKERS, queue_depth=INFERENCE_QUEUE_DEPTH,
+                 pool_size=TRACKER_POOL_SIZE, batch_size=INFERENCE_BATCH_SIZE, batch_wait=INFERENCE_BATCH_WAIT):
+        if mode == "process":
+            # spawn rather than fork: the parent may already have MediaPipe loaded
+            self._pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_worker_tracker,
+            )
+            self.trackers = None
+        elif mode == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+            self.trackers = TrackerPool(pool_size)
+        else:
+            raise ValueError(f"Unknown inference executor {mode!r}, expected 'thread' or 'process'")
+        self.mode = mode
+        self.workers = workers
+        self.queue_depth = queue_depth
+        batch_size = batch_size or (PROCESS_BATCH_SIZE if mode == "process" else 1)
+        self.scheduler = InferenceScheduler(self._pool, workers, queue_depth, batch_size, batch_wait)
+
+    @property
+    def in_flight(self):
+        return self.scheduler.in_flight
+
+    @property
+    def waiting(self):
+        return self.scheduler.waiting
+
+    async def prewarm(self, count=TRACKER_POOL_WARM):
+        """Build and warm up models ahead of the first sessions"""
+        loop = asyncio.get_running_loop()
+        if self.trackers is None:
+            # One job per worker gets every worker process started and its tracker built
+            await asyncio.gather(*(loop.run_in_executor(self._pool, _warm_worker) for _ in range(self.workers)))
+            return
+        for _ in range(min(count, self.trackers.max_size) - self.trackers.created):
+            await self.trackers.add(self._pool)
+
+    async def checkout(self):
+        """Get a model for a new session (None in process mode)"""
+        if self.trackers is None:
+            return None
+        return await self.trackers.checkout(self._pool)
+
+    def checkin(self, tracker):
+        """Give a session's model back to the pool.
+
+        If the session went away while one of its frames was still running on
+        a worker, the model only goes back once that job finishes.
+        """
+        if tracker is None:
+            return
+        job = self.scheduler.busy.get(tracker)
+        if job is not None:
+            job.add_done_callback(lambda _: self.trackers.checkin(tracker))
+        else:
+            self.trackers.checkin(tracker)
+
+    async def detect(self, mailbox, raw, tracker=None, timed=False):
+        """Run detect_frame() for a connection on the pool.
+
+        The frame waits in the scheduler for its batch; if a newer frame
+        reached the connection's mailbox in the meantime, that one is analyzed
+        instead of ``raw``. Returns the frame that was analyzed and the
+        detect_frame() result. With ``timed``, the queued, decode and
+        inference stages are recorded in the metrics registry.
+
+        If the connection goes away while its frame is still pending, the
+        frame is dropped; once it is on a worker, the batch runs to the end
+        and the model stays taken until then (see checkin()).
+        """
+        raw, result = await self.scheduler.submit(mailbox, raw, tracker, timed)
+        if timed:
+            result, (decode, inference) = result
+            metrics.REGISTRY.observe("decode", decode)
+            if inference is not None:
+                metrics.REGISTRY.observe("inference", inference)
+        return raw, result
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
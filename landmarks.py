@@ -0,0 +1,88 @@
+"""FaceMesh landmarks as one NumPy array per frame.
+
+FaceMesh returns its 478 landmarks (with refine_landmarks=True) as protobuf
+objects; reading them one attribute at a time in Python costs more than the
+math done on them. LandmarkBuffer copies a whole landmark list into a
+preallocated ``(478, 3)`` float32 array of pixel coordinates in one go, by
+viewing the serialized message as packed records, and every feature (iris
+centers, face box, head pose points) is then an index operation on that
+array.
+"""
+import numpy as np
+
+
+NUM_LANDMARKS = 478
+
+LEFT_IRIS = np.array([474, 475, 476, 477])
+RIGHT_IRIS = np.array([469, 470, 471, 472])
+# Both irises, left first, as one (2, 4) index for iris_centers()
+IRISES = np.stack([LEFT_IRIS, RIGHT_IRIS])
+
+# Forehead, chin and the two cheek edges of the face oval: enough for a face box
+FACE_BOX = np.array([10, 152, 234, 454])
+
+# One serialized NormalizedLandmark with x, y and z set: a length-delimited
+# field header (tag 0x0a, length 15) followed by three tagged float32 fields
+_WIRE_RECORD = np.dtype([
+    ("tag", "u1"), ("length", "u1"),
+    ("x_tag", "u1"), ("x", "<f4"),
+    ("y_tag", "u1"), ("y", "<f4"),
+    ("z_tag", "u1"), ("z", "<f4"),
+])
+_WIRE_TAGS = (("tag", 0x0a), ("length", 15), ("x_tag", 0x0d), ("y_tag", 0x15), ("z_tag", 0x1d))
+
+
+def _read_wire(landmark_list, out):
+    """Fill ``out`` with normalized x, y, z from the serialized message, if it has the packed layout"""
+    data = landmark_list.SerializeToString()
+    if len(data) != len(out) * _WIRE_RECORD.itemsize:
+        # A coordinate of exactly 0.0 is left out of the message, or extra fields are set
+        return False
+    records = np.frombuffer(data, dtype=_WIRE_RECORD)
+    for field, value in _WIRE_TAGS:
+        if not (records[field] == value).all():
+            return False
+    out[:, 0] = records["x"]
+    out[:, 1] = records["y"]
+    out[:, 2] = records["z"]
+    return True
+
+
+class LandmarkBuffer:
+    """Reusable ``(478, 3)`` array holding the landmarks of the latest frame"""
+
+    __slots__ = ("points",)
+
+    def __init__(self, size=NUM_LANDMARKS):
+        self.points = np.empty((size, 3), dtype=np.float32)
+
+    def load(self, landmark_list, width, height, x0=0, y0=0):
+        """Copy a NormalizedLandmarkList in, as pixels of a ``width`` x ``height``
+        region whose top left corner is at (x0, y0) in the frame.
+
+        z is scaled by the width, like x, as FaceMesh defines it. Returns the
+        points array, which is overwritten by the next load().
+        """
+        points = self.points
+        if len(landmark_list.landmark) != len(points):
+            raise ValueError(f"Expected {len(points)} landmarks, got {len(landmark_list.landmark)}")
+        if not _read_wire(landmark_list, points):
+            points[:] = [(p.x, p.y, p.z) for p in landmark_list.landmark]
+        points[:, 0] *= width
+        points[:, 0] += x0
+        points[:, 1] *= height
+        points[:, 1] += y0
+        points[:, 2] *= width
+        return points
+
+
+def iris_centers(points):
+    """(2, 2) array of the left and right iris centers in pixels"""
+    return points[IRISES, :2].mean(axis=1)
+
+
+def bounds(points, index=FACE_BOX):
+    """(min_x, min_y, max_x, max_y) of the given landmarks"""
+    selected = points[index, :2]
+    (min_x, min_y), (max_x, max_y) = selected.min(axis=0), selected.max(axis=0)
+    return float(min_x), float(min_y), float(max_x), float(max_y)
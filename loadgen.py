@@ -0,0 +1,314 @@
+"""Load generator: simulated proctored students against /ws.
+
+Each client behaves like the quiz page: it connects to /ws with a session id,
+sends a JPEG every 1/--fps seconds (binary frames, or the legacy base64 JSON
+messages with ``--protocol json``) and a JSON ping every --ping-interval
+seconds. It records
+
+- response latency: from sending a frame to its result coming back, matched
+  on the seq the server echoes (binary protocol, with ``?updates=all``),
+- ping latency: from ping to pong, which shows how responsive the event loop
+  stays under load,
+- how many frames got a result, and error messages from the server,
+- connections that failed or were closed by the server.
+
+The number of clients is ramped up level by level (1, 2, 4, ... by default)
+until a level breaks the SLO: p95 response latency over --slo-ms, fewer
+results per client per second than --min-result-rate, or any error or failed
+connection. The last level that held is reported as the capacity of the
+server:
+
+    python loadgen.py --max-clients 128 --duration 20 --json capacity.json
+
+By default a uvicorn server with the current environment is started on a
+free local port (calibration off, logs in a temporary directory); --url
+points at a server already running on this machine instead.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import json
+import os
+import tempfile
+import time
+import uuid
+from urllib.parse import urlparse
+
+import numpy as np
+
+import benchmark
+import frames
+
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+class ClientStats:
+    __slots__ = ("sent", "results", "latencies", "pings", "pongs", "ping_latencies", "errors", "failure")
+
+    def __init__(self):
+        self.sent = 0
+        self.results = 0
+        self.latencies = []
+        self.pings = 0
+        self.pongs = 0
+        self.ping_latencies = []
+        self.errors = []
+        # Why the connection failed or was closed early, if it did
+        self.failure = None
+
+
+def frame_messages(jpegs, protocol):
+    """What a client sends for each frame: JPEG bytes for binary, ready-made JSON text for the legacy protocol"""
+    if protocol == "binary":
+        return jpegs
+    return [json.dumps({"type": "frame", "data": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()})
+            for jpeg in jpegs]
+
+
+async def run_client(url, messages, protocol, fps, duration, ping_interval, stats, start_delay=0.0):
+    """One simulated student for ``duration`` seconds after ``start_delay``"""
+    import websockets
+
+    await asyncio.sleep(start_delay)
+    subprotocol = frames.BINARY_SUBPROTOCOL if protocol == "binary" else frames.JSON_SUBPROTOCOL
+    sent_at = {}
+    pings_sent = collections.deque()
+    try:
+        async with websockets.connect(f"{url}&session_id={uuid.uuid4()}", subprotocols=[subprotocol],
+                                      max_size=None, open_timeout=30) as ws:
+
+            async def receiver():
+                async for message in ws:
+                    data = json.loads(message)
+                    if data.get("type") == "pong":
+                        if pings_sent:
+                            stats.pongs += 1
+                            stats.ping_latencies.append((time.perf_counter() - pings_sent.popleft()) * 1000)
+                        continue
+                    if "error" in data:
+                        stats.errors.append(data["error"])
+                    sent = sent_at.pop(data.get("seq"), None)
+                    if sent is not None:
+                        stats.latencies.append((time.perf_counter() - sent) * 1000)
+                    # Legacy JSON results carry no seq; status messages like "Waiting for ..." are not results
+                    if "direction" in data and (data.get("seq") is not None or protocol == "json") \
+                            and not data["direction"].startswith(("Waiting", "Loading")):
+                        stats.results += 1
+
+            receiving = asyncio.create_task(receiver())
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            next_frame = next_ping = started
+            seq = 0
+            while not receiving.done():
+                now = loop.time()
+                if now - started >= duration:
+                    break
+                if now >= next_ping and ping_interval > 0:
+                    pings_sent.append(time.perf_counter())
+                    stats.pings += 1
+                    await ws.send('{"type":"ping"}')
+                    next_ping += ping_interval
+                if now >= next_frame:
+                    message = messages[seq % len(messages)]
+                    if protocol == "binary":
+                        sent_at[seq] = time.perf_counter()
+                        message = benchmark.binary_message(seq, message)
+                    await ws.send(message)
+                    stats.sent += 1
+                    seq += 1
+                    # Fixed schedule like setInterval; a client that fell behind doesn't burst to catch up
+                    next_frame = max(next_frame + 1 / fps, now)
+                await asyncio.sleep(max(0.0, min(next_frame, next_ping if ping_interval > 0 else next_frame)
+                                        - loop.time()))
+            if receiving.done():
+                receiving.result()
+                stats.failure = "closed by server"
+                return
+            # Results of the last frames still in flight are not waited for
+            receiving.cancel()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        stats.failure = f"{type(e).__name__}: {e}"
+
+
+async def run_level(url, clients, messages, protocol, fps, duration, ping_interval, spread):
+    """Run ``clients`` concurrent clients, their starts spread over ``spread`` seconds"""
+    stats = [ClientStats() for _ in range(clients)]
+    await asyncio.gather(*(
+        run_client(url, messages, protocol, fps, duration, ping_interval, client, spread * i / clients)
+        for i, client in enumerate(stats)))
+    return stats
+
+
+def summarize(stats, clients, duration, server=None, cpu_before=None):
+    latencies = [latency for client in stats for latency in client.latencies]
+    ping_latencies = [latency for client in stats for latency in client.ping_latencies]
+    sent = sum(client.sent for client in stats)
+    results = sum(client.results for client in stats)
+    errors = collections.Counter(error for client in stats for error in client.errors)
+    failures = collections.Counter(client.failure for client in stats if client.failure)
+    summary = {
+        "clients": clients,
+        "frames_sent": sent,
+        "results": results,
+        "result_rate_per_client": round(results / clients / duration, 3),
+        "frames_without_result": round(1 - results / sent, 4) if sent else None,
+        "latency": benchmark.percentiles(latencies),
+        "ping_latency": benchmark.percentiles(ping_latencies),
+        "pings_unanswered": sum(client.pings - client.pongs for client in stats),
+        "errors": dict(errors),
+        "failed_connections": dict(failures),
+    }
+    if server is not None:
+        cpu_after = benchmark.cpu_seconds(server.pid)
+        rss = benchmark.rss_bytes(server.pid)
+        if cpu_before is not None and cpu_after is not None:
+            summary["server_cpu_cores"] = round((cpu_after - cpu_before) / duration, 3)
+        if rss is not None:
+            summary["server_rss_mb"] = round(rss / 2**20, 1)
+    return summary
+
+
+def slo_breaches(summary, slo_ms, min_result_rate):
+    """Reasons a level broke the SLO; empty if it held"""
+    breaches = []
+    p95 = summary["latency"].get("p95_ms")
+    if p95 is not None and p95 > slo_ms:
+        breaches.append(f"p95 latency {p95}ms > {slo_ms}ms")
+    if summary["result_rate_per_client"] < min_result_rate:
+        breaches.append(f"{summary['result_rate_per_client']} results/s per client < {min_result_rate}")
+    if summary["errors"]:
+        breaches.append(f"{sum(summary['errors'].values())} server errors")
+    if summary["failed_connections"]:
+        breaches.append(f"{sum(summary['failed_connections'].values())} failed connections")
+    return breaches
+
+
+def ramp_levels(start, factor, step, maximum):
+    clients = start
+    while clients <= maximum:
+        yield clients
+        clients = clients + step if step else max(clients + 1, int(clients * factor))
+
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit does (POSIX only; Windows has no such limit to raise)"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramp simulated students against /ws until a latency SLO breaks")
+    parser.add_argument("--url", help="ws:// URL of a server on this machine (default: start one)")
+    parser.add_argument("--frames", help="directory of .jpg frames or a video file (default: synthetic frames)")
+    parser.add_argument("--count", type=int, default=100, help="distinct frames to replay (default: 100)")
+    parser.add_argument("--width", type=int, default=640, help="synthetic frame width (default: 640)")
+    parser.add_argument("--height", type=int, default=480, help="synthetic frame height (default: 480)")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality, as the page sends (default: 80)")
+    parser.add_argument("--protocol", choices=("binary", "json"), default="binary",
+                        help="frame messages to send (default: binary); latency is only measured for binary")
+    parser.add_argument("--fps", type=float, default=10.0, help="frames per second per client (default: 10)")
+    parser.add_argument("--ping-interval", type=float, default=5.0, help="seconds between pings, 0 for none")
+    parser.add_argument("--start", type=int, default=1, help="clients in the first level (default: 1)")
+    parser.add_argument("--factor", type=float, default=2.0, help="growth of clients per level (default: 2)")
+    parser.add_argument("--step", type=int, default=0, help="add this many clients per level instead of --factor")
+    parser.add_argument("--max-clients", type=int, default=256, help="stop ramping here (default: 256)")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per level (default: 20)")
+    parser.add_argument("--spread", type=float, default=2.0, help="seconds over which a level's clients join")
+    parser.add_argument("--slo-ms", type=float, default=500.0, help="p95 response latency SLO (default: 500)")
+    parser.add_argument("--min-result-rate", type=float,
+                        help="results per second each client must get (default: 80%% of the analysis rate)")
+    parser.add_argument("--calibrate", action="store_true", help="let clients sit through calibration (own server)")
+    parser.add_argument("--keep-going", action="store_true", help="run every level even after the SLO breaks")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    if args.url and urlparse(args.url).hostname not in LOCAL_HOSTS:
+        parser.error("--url must point at this machine (localhost)")
+    analysis_fps = float(os.environ.get("ANALYSIS_FPS", "3.3"))
+    min_result_rate = args.min_result_rate
+    if min_result_rate is None:
+        min_result_rate = 0.8 * min(args.fps, analysis_fps)
+
+    jpegs = benchmark.load_frames(args.frames, args.count, args.width, args.height, args.quality)
+    if not jpegs:
+        parser.error(f"No frames found in {args.frames}")
+    messages = frame_messages(jpegs, args.protocol)
+    json_path = os.path.abspath(args.json) if args.json else None
+    raise_file_limit()
+
+    server = None
+    url = args.url
+    if url is None:
+        os.chdir(tempfile.mkdtemp(prefix="gaze-loadgen-"))
+        port = benchmark._free_port()
+        server = benchmark.start_server(port, {} if args.calibrate else {"CALIBRATION": "0"})
+        url = f"ws://127.0.0.1:{port}/ws"
+    url += ("&" if "?" in url else "?") + "updates=all"
+
+    report = {
+        "config": {
+            "url": url,
+            "frames": len(jpegs),
+            "mean_jpeg_bytes": int(np.mean([len(jpeg) for jpeg in jpegs])),
+            "protocol": args.protocol,
+            "fps": args.fps,
+            "duration_s": args.duration,
+            "slo_ms": args.slo_ms,
+            "min_result_rate": min_result_rate,
+            "analysis_fps": analysis_fps,
+        },
+        "levels": [],
+        "capacity": 0,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    try:
+        for clients in ramp_levels(args.start, args.factor, args.step, args.max_clients):
+            cpu_before = benchmark.cpu_seconds(server.pid) if server is not None else None
+            stats = asyncio.run(run_level(url, clients, messages, args.protocol, args.fps, args.duration,
+                                          args.ping_interval, args.spread))
+            summary = summarize(stats, clients, args.duration, server, cpu_before)
+            summary["slo_breaches"] = breaches = slo_breaches(summary, args.slo_ms, min_result_rate)
+            report["levels"].append(summary)
+            latency = summary["latency"]
+            parts = [f"{clients:>5} clients:"]
+            if latency["count"]:
+                parts.append(f"latency p50 {latency['p50_ms']}ms p95 {latency['p95_ms']}ms,")
+            parts.append(f"{summary['result_rate_per_client']} results/s per client,")
+            if summary["ping_latency"]["count"]:
+                parts.append(f"ping p95 {summary['ping_latency']['p95_ms']}ms,")
+            if server is not None:
+                parts.append(f"server {summary.get('server_cpu_cores')} cores / {summary.get('server_rss_mb')} MB")
+            if breaches:
+                parts.append(f" SLO broken: {'; '.join(breaches)}")
+            print(" ".join(parts).rstrip(","))
+            if not breaches:
+                report["capacity"] = max(report["capacity"], clients)
+            elif not args.keep_going:
+                break
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f"\nCapacity: {report['capacity']} concurrent clients within a p95 of {args.slo_ms}ms")
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {json_path}")
+
+
+if __name__ == "__main__":
+    main()
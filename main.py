@@ -1,31 +1,96 @@
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pathlib import Path
-from fastapi.responses import HTMLResponse
-import uuid
-import datetime
+from fastapi.responses import JSONResponse, PlainTextResponse
 import json
 import os
 import time
 import asyncio
+from contextlib import asynccontextmanager
 
-# Lazy import of OpenCV and EyeTracker to avoid startup errors on Railway
-# Railway servers don't have cameras, so we make these optional
-try:
-    import cv2
-    from view import EyeTracker
+import analytics
+import calibration
+import capture
+import frames
+import metrics
+from evidence import EvidenceWriter
+from page_cache import PageCache
+from session_index import open_index
+from session_log import LogWriter
+from sessions import FLAGGED_DIRECTION, SESSION_COOKIE, SessionRegistry, parse_session_id
+from store import open_store
+
+# The eye tracking modules are optional, since Railway servers don't have
+# cameras, and MediaPipe takes a while to import. frames, evidence and gaze
+# (via calibration) import OpenCV, if installed, along with this module, which
+# is quick; MediaPipe and the tracker are loaded by warm_up() after startup, so
+# the server answers /health right away. /ready tells when warm-up is over
+EYE_TRACKING_AVAILABLE = False
+cv2 = None
+GazeState = None
+InferenceExecutor = None
+
+# Set when warm_up() is done, whether eye tracking turned out available or not
+eye_tracking_ready = asyncio.Event()
+warmup_status = {"status": "starting", "seconds": None, "error": None}
+
+def load_eye_tracking():
+    """Import OpenCV, MediaPipe and the tracker modules; runs on a thread"""
+    global EYE_TRACKING_AVAILABLE, cv2, GazeState, InferenceExecutor
+    try:
+        import cv2 as cv2_module
+        from view import GazeState as gaze_state_class
+        from inference import InferenceExecutor as executor_class
+    except ImportError as e:
+        print(f"Warning: Eye tracking not available: {e}")
+        return False
+    cv2, GazeState, InferenceExecutor = cv2_module, gaze_state_class, executor_class
     EYE_TRACKING_AVAILABLE = True
-except ImportError as e:
-    print(f"Warning: Eye tracking not available: {e}")
-    EYE_TRACKING_AVAILABLE = False
-    cv2 = None
-    EyeTracker = None
+    return True
+
+async def warm_up():
+    """Load eye tracking and build the first FaceMesh models, so the first student doesn't wait for them"""
+    global EYE_TRACKING_AVAILABLE
+    started = time.monotonic()
+    warmup_status["status"] = "warming up"
+    try:
+        if await asyncio.to_thread(load_eye_tracking):
+            await get_inference_executor().prewarm()
+        warmup_status["status"] = "ready"
+    except Exception as e:
+        print(f"Eye tracking warm-up failed: {e}")
+        # /ws then takes the "Eye tracking disabled" path instead of failing on every connection
+        EYE_TRACKING_AVAILABLE = False
+        warmup_status["status"] = "failed"
+        warmup_status["error"] = str(e)
+    finally:
+        warmup_status["seconds"] = round(time.monotonic() - started, 2)
+        print(f"Eye tracking warm-up {warmup_status['status']} after {warmup_status['seconds']}s")
+        eye_tracking_ready.set()
 
 
-os.makedirs("suspicious_behaviour/image/", exist_ok=True)
-os.makedirs("suspicious_behaviour/session_log/", exist_ok=True)
+@asynccontextmanager
+async def lifespan(app):
+    eviction = asyncio.create_task(session_registry.run_eviction())
+    sync = asyncio.create_task(session_registry.run_sync())
+    warmup = asyncio.create_task(warm_up())
+    maintenance = asyncio.create_task(session_index.run_maintenance()) if session_index is not None else None
+    yield
+    eviction.cancel()
+    sync.cancel()
+    warmup.cancel()
+    if maintenance is not None:
+        maintenance.cancel()
+    if inference_executor is not None:
+        inference_executor.shutdown()
+    evidence_writer.stop()
+    log_writer.stop()
+    session_registry.sync_all()
+    session_registry.close()
+    session_store.close()
+    if session_index is not None:
+        session_index.close()
 
-app = FastAPI(title="Eye Tracking Quiz Application")
+app = FastAPI(title="Eye Tracking Quiz Application", lifespan=lifespan)
 
 # CORS configuration for production
 app.add_middleware(
@@ -36,26 +101,92 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize EyeTracker lazily to avoid import errors during startup
-eye_tracker = None
+# Pool that runs frame decoding and FaceMesh off the event loop, created on first use
+inference_executor = None
 
-def get_eye_tracker():
-    global eye_tracker
-    if not EYE_TRACKING_AVAILABLE:
-        raise RuntimeError("Eye tracking is not available on this server. Railway servers don't have camera access.")
-    if eye_tracker is None:
-        eye_tracker = EyeTracker()
-    return eye_tracker
+def get_inference_executor():
+    global inference_executor
+    if inference_executor is None:
+        inference_executor = InferenceExecutor()
+        print(f"Inference executor: {inference_executor.mode} pool with {inference_executor.workers} workers, "
+              f"batches of up to {inference_executor.scheduler.batch_size} frames")
+    return inference_executor
+
+# The HTML pages, read once and kept compressed; reloaded when a template changes
+page_cache = PageCache()
+page_cache.preload("landing.html", "index.html", "result.html")
+
+# Where every session's log, gaze summary and evidence images are (None with SESSION_INDEX=0)
+session_index = open_index()
+
+# Appends every session's events to its log file from a background thread
+log_writer = LogWriter()
+
+# Saves flagged frames as evidence images from a background thread
+evidence_writer = EvidenceWriter(index=session_index)
+
+# Gaze calibrations by session id, so reconnects skip calibrating again
+calibration_cache = calibration.CalibrationCache()
 
-session_data ={
-    "active":False,
-    "session_id": None,
-    "data":[]
-}
+# Session state shared with the other worker processes (in memory with a single worker)
+session_store = open_store()
 
-flagged = 0
-looking_left = 0
-looking_right = 0
+# All exam sessions of this process, keyed by session id
+session_registry = SessionRegistry(log_writer=log_writer, store=session_store, index=session_index,
+                                   on_evict=lambda session: session.active and evaluate(session))
+
+# Upper bound on frames analyzed per second per connection; the browser sends ~10
+ANALYSIS_FPS = float(os.environ.get("ANALYSIS_FPS", "3.3"))
+# "changes" pushes a result only when the direction changes (plus a heartbeat
+# every WS_HEARTBEAT seconds), "all" pushes every analyzed frame. Clients can
+# pick per connection with ?updates=all|changes
+WS_UPDATES = os.environ.get("WS_UPDATES", "changes")
+WS_HEARTBEAT = float(os.environ.get("WS_HEARTBEAT", "5"))
+# Seconds /result waits for a finished session's log to reach the disk before reporting on it
+REPORT_LOG_TIMEOUT = float(os.environ.get("REPORT_LOG_TIMEOUT", "5"))
+
+# Frame counts of closed connections, and the mailboxes of open ones, for /metrics
+closed_frame_counts = {"received": 0, "dropped": 0}
+open_mailboxes = set()
+
+def frame_count(name):
+    return closed_frame_counts[name] + sum(getattr(mailbox, name) for mailbox in open_mailboxes)
+
+def executor_gauge(read):
+    """Gauge callback reading the inference executor, skipped until it exists"""
+    return lambda: None if inference_executor is None else read(inference_executor)
+
+def tracker_pool_gauge(read):
+    return executor_gauge(lambda executor: None if executor.trackers is None else read(executor.trackers))
+
+metrics.REGISTRY.gauge("sessions", "Sessions held in the session registry", lambda: len(session_registry))
+metrics.REGISTRY.gauge("websocket_connections", "Open /ws connections", lambda: session_registry.connections)
+metrics.REGISTRY.counter("frames_received_total", "Frames received over /ws", lambda: frame_count("received"))
+metrics.REGISTRY.counter("frames_dropped_total", "Frames replaced by a newer one before they were analyzed",
+                         lambda: frame_count("dropped"))
+metrics.REGISTRY.gauge("inference_in_flight", "Frames running on the inference pool",
+                       executor_gauge(lambda executor: executor.in_flight))
+metrics.REGISTRY.gauge("inference_waiting", "Frames waiting in the scheduler for their batch",
+                       executor_gauge(lambda executor: executor.waiting))
+metrics.REGISTRY.gauge("inference_queue_depth", "Frames admitted to the inference pool at once",
+                       executor_gauge(lambda executor: executor.queue_depth))
+metrics.REGISTRY.gauge("inference_workers", "Workers of the inference pool",
+                       executor_gauge(lambda executor: executor.workers))
+metrics.REGISTRY.counter("inference_batches_total", "Batches dispatched to the inference pool",
+                         executor_gauge(lambda executor: executor.scheduler.batches))
+metrics.REGISTRY.counter("inference_batched_frames_total", "Frames dispatched to the inference pool in batches",
+                         executor_gauge(lambda executor: executor.scheduler.batched_frames))
+metrics.REGISTRY.gauge("tracker_pool_in_use", "FaceMesh models checked out by connections",
+                       tracker_pool_gauge(lambda pool: pool.in_use))
+metrics.REGISTRY.gauge("tracker_pool_created", "FaceMesh models built", tracker_pool_gauge(lambda pool: pool.created))
+metrics.REGISTRY.gauge("tracker_pool_max", "Most FaceMesh models the pool builds",
+                       tracker_pool_gauge(lambda pool: pool.max_size))
+metrics.REGISTRY.counter("evidence_images_total", "Flagged frames offered as evidence, by outcome", lambda: {
+    "written": evidence_writer.written,
+    "duplicate": evidence_writer.skipped_duplicates,
+    "dropped": evidence_writer.dropped,
+}, label="outcome")
+metrics.REGISTRY.gauge("calibrations_cached", "Session calibrations held in the cache", lambda: len(calibration_cache))
 
 def find_available_camera():
     """Try to find an available camera by testing different indices"""
@@ -114,21 +245,40 @@ def find_available_camera():
     return None, None
 
 @app.get("/")
-async def read_root():
+async def read_root(request: Request):
     """Landing page"""
-    html_file = Path("templates/landing.html")
-    if not html_file.exists():
+    response = page_cache.response(request, "landing.html")
+    if response is None:
         return {"message": "Server is up and running", "status": "healthy", "note": "Landing page not found"}
-    context = html_file.read_text(encoding="utf-8")
-    return HTMLResponse(content=context, status_code=200)
+    return response
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "eye-tracking-quiz"}
 
+@app.get("/ready")
+async def readiness_check():
+    """503 while eye tracking is warming up, 200 once that is over; ``eye_tracking`` tells whether it worked"""
+    body = {"status": warmup_status["status"],
+            "eye_tracking": EYE_TRACKING_AVAILABLE,
+            "warmup_seconds": warmup_status["seconds"]}
+    if warmup_status["error"]:
+        body["error"] = warmup_status["error"]
+    if inference_executor is not None and inference_executor.trackers is not None:
+        body["models"] = inference_executor.trackers.created
+    # A failed warm-up won't get better by waiting: answer 200 so the deploy goes ahead and
+    # serves the pages, with eye tracking reported off
+    return JSONResponse(body, status_code=200 if eye_tracking_ready.is_set() else 503)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Stage latencies, sessions, frame counts and pool state in the Prometheus text format"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/test-camera")
 async def test_camera():
     """Test endpoint to check camera availability"""
+    await eye_tracking_ready.wait()
     if not EYE_TRACKING_AVAILABLE:
         return {
             "status": "error",
@@ -174,19 +324,176 @@ async def test_camera():
         }
 
 @app.get("/home")
-async def home():
-    html_file = Path("templates/index.html")
-    if not html_file.exists():
+async def home(request: Request):
+    response = page_cache.response(request, "index.html")
+    if response is None:
         return {"error": "Template file not found"}
-    context = html_file.read_text(encoding="utf-8")
-    session_data['active'] = True
-    session_data['session_id'] = str(uuid.uuid4())
-    return HTMLResponse(content=context, status_code=200)
+    session = session_registry.create()
+    # The page passes this back on /ws, and the browser sends it along to /result
+    response.set_cookie(SESSION_COOKIE, session.session_id, samesite="lax")
+    return response
+
+async def calibrate(websocket, session, mailbox, executor, tracker):
+    """Return the session's cached calibration, or run the calibration steps for it"""
+    cached = calibration_cache.get(session.session_id)
+    if cached is not None:
+        return cached
+    # Calibrated on a connection another worker served
+    record = await asyncio.to_thread(session_store.get, session.session_id)
+    if record is not None and record.calibration is not None:
+        cached = calibration.from_json(record.calibration)
+        calibration_cache.put(session.session_id, cached)
+        return cached
+
+    async def next_sample(timeout):
+        try:
+            raw = await asyncio.wait_for(mailbox.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        _, (_, _, _, sample) = await executor.detect(mailbox, raw, tracker)
+        return sample
+
+    result = await calibration.run(websocket, next_sample)
+    if result is not None:
+        calibration_cache.put(session.session_id, result)
+        session_registry.write(session_store.set_calibration, session.session_id, calibration.to_json(result))
+    print(f"Calibration of session {session.session_id}: {result}")
+    return result
+
+async def analyze_frames(websocket, session, mailbox, executor, protocol=None):
+    """Analysis loop of one /ws connection.
+
+    Takes the newest frame from the mailbox at most ANALYSIS_FPS times a
+    second. When the tracker is slower than that, frames that arrive while it
+    is busy are overwritten in the mailbox, so it always resumes on the latest
+    frame instead of working through a backlog.
+
+    Each connection has its own gaze timers and, in thread mode, holds a
+    FaceMesh model from the tracker pool until it disconnects. The session is
+    calibrated first, unless it already was on an earlier connection.
+
+    The page is sent its capture profile first and whenever it changes, see
+    capture.py; only gaze.binary.v2 pages are asked to crop to the face.
+    """
+    state = GazeState()
+    loop = asyncio.get_running_loop()
+    capture_controller = None
+    if capture.CAPTURE_PROFILE:
+        capture_controller = capture.CaptureController(
+            crop=capture.CAPTURE_CROP and protocol == frames.CROP_SUBPROTOCOL)
+        await websocket.send_json(capture.message(capture_controller.start(loop.time())))
+    pool = executor.trackers
+    if pool is not None and pool.in_use >= pool.max_size:
+        await websocket.send_json({"direction": "Waiting for a free eye tracker..."})
+    tracker = await executor.checkout()
+
+    interval = 1.0 / ANALYSIS_FPS
+    next_due = loop.time()
+    push_all = websocket.query_params.get("updates", WS_UPDATES) == "all"
+    last_sent = None
+    last_sent_at = 0.0
+    consecutive_errors = 0
+    max_errors = 10
+
+    try:
+        if calibration.CALIBRATION and state.model == "pose":
+            state.calibration = await calibrate(websocket, session, mailbox, executor, tracker)
+
+        while True:
+            delay = next_due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            raw = await mailbox.get()
+            next_due = loop.time() + interval
+            timed = metrics.REGISTRY.sampled()
+
+            try:
+                # Decode + FaceMesh run on the inference pool; only the gaze timers run here
+                raw, (seq, timestamp, frame_width, eyes) = await executor.detect(mailbox, raw, tracker, timed)
+                if frame_width is None:
+                    metrics.REGISTRY.inc("frame_errors_total", "Frames that failed to decode or to be analyzed")
+                    consecutive_errors += 1
+                    if consecutive_errors >= max_errors:
+                        await websocket.send_json({"error": "Failed to decode frames"})
+                        break
+                    continue
+
+                if timed:
+                    started = time.perf_counter()
+                result = state.classify(eyes, frame_width)
+                if timed:
+                    metrics.REGISTRY.observe("classify", time.perf_counter() - started)
+
+                # Log to session data if active
+                if session.active and result and "direction" in result:
+                    session.record(result["direction"])
+
+                    # Save flagged images; rate limited, deduplicated and written off the loop. Only
+                    # whole frames: the capture profile drops the face crop while the flag is latched
+                    if result["direction"] == FLAGGED_DIRECTION and (
+                            capture_controller is None or capture_controller.whole_frame(raw)):
+                        evidence_writer.submit(session.session_id, raw)
+
+                # Reset error counter on success
+                consecutive_errors = 0
+
+                if capture_controller is not None:
+                    profile = capture_controller.update(eyes, capture.executor_load(executor), loop.time(),
+                                                        flagged=result["direction"] == FLAGGED_DIRECTION)
+                    if profile is not None:
+                        await websocket.send_json(capture.message(profile))
+
+                # Unless the client asked for every result, only push when the
+                # direction changes or the heartbeat is due
+                now = loop.time()
+                if not push_all and result["direction"] == last_sent and now - last_sent_at < WS_HEARTBEAT:
+                    continue
+                last_sent = result["direction"]
+                last_sent_at = now
+
+                # Echo the frame header so binary clients can match results to frames
+                if seq is not None:
+                    result = {**result, "seq": seq, "timestamp": timestamp}
+
+                # Send result back to frontend
+                if timed:
+                    started = time.perf_counter()
+                await websocket.send_json(result)
+                if timed:
+                    metrics.REGISTRY.observe("send", time.perf_counter() - started)
+                    metrics.REGISTRY.observe("frame", time.monotonic() - raw.received_at)
+
+            except WebSocketDisconnect:
+                # Socket closed underneath us; the receive loop handles the disconnect
+                break
+            except Exception as e:
+                print(f"Error processing frame: {e}")
+                import traceback
+                traceback.print_exc()
+                metrics.REGISTRY.inc("frame_errors_total", "Frames that failed to decode or to be analyzed")
+                consecutive_errors += 1
+                if consecutive_errors >= max_errors:
+                    break
+    finally:
+        executor.checkin(tracker)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
+    # Frame encoding is negotiated through the subprotocol the client offers;
+    # clients that don't offer one get the legacy base64 JSON path
+    protocol = frames.negotiate_protocol(websocket)
+    await websocket.accept(subprotocol=protocol)
     connection_active = True
+    analysis_task = None
+    mailbox = None
+
+    # The session id comes on the URL (?session_id=...) or in the cookie set by /home
+    session_id = parse_session_id(websocket.query_params.get("session_id") or websocket.cookies.get(SESSION_COOKIE))
+    session = session_registry.get(session_id) if session_id else None
+    if session is None:
+        # Unknown id, e.g. the server restarted mid-exam: keep logging under that id
+        session = session_registry.create(session_id, active=session_id is not None)
+    session_registry.connect(session)
     
     try:
         # Send initial connection message
@@ -197,7 +504,12 @@ async def websocket_endpoint(websocket: WebSocket):
             return
         
         print("WebSocket connected, waiting for frames from frontend...")
-        
+
+        if not eye_tracking_ready.is_set():
+            # Connected during startup; frames queue up until the models are loaded
+            await websocket.send_json({"direction": "Loading eye tracking..."})
+            await eye_tracking_ready.wait()
+
         # Check if OpenCV and MediaPipe are available
         if not EYE_TRACKING_AVAILABLE or cv2 is None:
             await websocket.send_json({
@@ -220,87 +532,47 @@ async def websocket_endpoint(websocket: WebSocket):
                 pass
             return
         
-        # Get eye tracker
-        tracker = get_eye_tracker()
-        
-        frame_count = 0
         consecutive_errors = 0
         max_errors = 10
+
+        # Frames are only parked in the mailbox here; the analysis task decides
+        # which ones get decoded, so skipped frames never cost a decode
+        mailbox = frames.LatestFrame()
+        open_mailboxes.add(mailbox)
+        analysis_task = asyncio.create_task(analyze_frames(websocket, session, mailbox, get_inference_executor(), protocol))
         
-        # Main processing loop - receive frames from frontend
-        print("Starting frame processing loop (receiving from frontend)...")
-        while connection_active:
+        # Main receive loop - receive frames from frontend
+        print(f"Starting frame processing loop (receiving from frontend, protocol={protocol or 'legacy json'})...")
+        while connection_active and not analysis_task.done():
             try:
                 # Receive message from frontend
-                message = await websocket.receive_text()
-                data = json.loads(message)
-                
+                message = await websocket.receive()
+                received = time.perf_counter()
+                if message["type"] == "websocket.disconnect":
+                    connection_active = False
+                    break
+
+                if message.get("bytes") is not None:
+                    # Binary frame: header and JPEG are only parsed if it gets analyzed
+                    mailbox.put(message["bytes"], binary=True, cropped=protocol == frames.CROP_SUBPROTOCOL)
+                    if metrics.REGISTRY.sampled():
+                        metrics.REGISTRY.observe("receive", time.perf_counter() - received)
+                    continue
+
+                data = json.loads(message["text"])
                 if data.get("type") == "frame":
-                    # Decode base64 image
-                    import base64
-                    image_data = data["data"]
-                    # Remove data URL prefix if present
-                    if "," in image_data:
-                        image_data = image_data.split(",")[1]
-                    
-                    # Decode base64 to bytes
-                    frame_bytes = base64.b64decode(image_data)
-                    
-                    # Convert bytes to numpy array
-                    import numpy as np
-                    nparr = np.frombuffer(frame_bytes, np.uint8)
-                    
-                    # Decode image using OpenCV
-                    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                    
-                    if frame is None:
-                        consecutive_errors += 1
-                        if consecutive_errors >= max_errors:
-                            await websocket.send_json({"error": "Failed to decode frames"})
-                            break
-                        continue
-                    
-                    # Reset error counter on success
-                    consecutive_errors = 0
-                    frame_count += 1
-                    
-                    # Process every 3rd frame to reduce load (~3-4 FPS processing)
-                    if frame_count % 3 == 0:
-                        try:
-                            # Process frame with eye tracker
-                            result = tracker.process_frame(frame)
-                            
-                            # Log to session data if active
-                            if session_data['active'] and result and "direction" in result:
-                                session_data['data'].append({
-                                    "session_id": session_data["session_id"],
-                                    "timestamp": datetime.datetime.now().isoformat(),
-                                    "direction": result["direction"],
-                                })
-                                
-                                # Save flagged images
-                                if result["direction"] == "Flagged: Looking away for 3+ seconds":
-                                    session_id = session_data["session_id"]
-                                    try:
-                                        cv2.imwrite(f"suspicious_behaviour/image/{session_id}_{int(time.time()*1000)}.jpg", frame)
-                                    except:
-                                        pass
-                            
-                            # Send result back to frontend
-                            await websocket.send_json(result)
-                            
-                        except Exception as e:
-                            print(f"Error processing frame: {e}")
-                            import traceback
-                            traceback.print_exc()
-                            consecutive_errors += 1
-                            if consecutive_errors >= max_errors:
-                                break
-                    
+                    # Keep the base64 data URL as-is until the frame is picked for analysis
+                    mailbox.put(data["data"], binary=False)
+                    if metrics.REGISTRY.sampled():
+                        metrics.REGISTRY.observe("receive", time.perf_counter() - received)
                 elif data.get("type") == "ping":
                     # Respond to ping to keep connection alive
                     await websocket.send_json({"type": "pong"})
-                    
+                consecutive_errors = 0
+
+            except WebSocketDisconnect:
+                connection_active = False
+                break
             except asyncio.CancelledError:
                 print("WebSocket task cancelled")
                 connection_active = False
@@ -318,75 +590,29 @@ async def websocket_endpoint(websocket: WebSocket):
                 if consecutive_errors >= max_errors:
                     break
                 await asyncio.sleep(0.1)
-                
-                # Process frame directly (MediaPipe is fast enough)
-                try:
-                    tracker = get_eye_tracker()
-                    result = tracker.process_frame(frame)
-                except Exception as process_error:
-                    print(f"Error processing frame: {process_error}")
-                    result = {"direction": "Processing error"}
-                
-                # Ensure result is always a dictionary
-                if result is None:
-                    result = {"direction": "Processing..."}
-                
-                # Only send updates every few frames to reduce WebSocket traffic
-                # Send every 3rd frame (roughly 10 FPS instead of 30)
-                if frame_count % 3 == 0:
-                    try:
-                        if session_data['active']:
-                            if result and "direction" in result:
-                                session_data['data'].append(
-                                    {"session_id": session_data["session_id"],
-                                     "timestamp": datetime.datetime.now().isoformat(),
-                                     "direction": result["direction"],
-                                     }
-                                )
-                                if result["direction"] == "Flagged: Looking away for 3+ seconds" and no_of_images < 5:
-                                    session_id = session_data["session_id"]
-                                    session_data['data'][-1]["flagged_image"] = f"suspicious_behaviour/image/{session_id}.jpg"
-                                    cv2.imwrite(f"suspicious_behaviour/image/{session_id}_{int(time.time()*1000)}.jpg", frame)
-                                    no_of_images += 1
-                                else:
-                                    no_of_images = 0
-                        
-                        # Send result to client
-                        await websocket.send_json(result)
-                    except Exception as send_error:
-                        # WebSocket might be closed
-                        print(f"Error sending to WebSocket: {send_error}")
-                        connection_active = False
-                        break
-                
-                frame_count += 1
-                
-                # Small delay to prevent overwhelming the system
-                await asyncio.sleep(0.033)  # ~30 FPS
-                
-            except asyncio.CancelledError:
-                print("WebSocket task cancelled")
-                connection_active = False
-                break
-            except Exception as frame_error:
-                print(f"Unexpected error in frame loop: {frame_error}")
-                import traceback
-                traceback.print_exc()
-                try:
-                    await websocket.send_json({"error": f"Frame processing error: {str(frame_error)}"})
-                except:
-                    pass
-                consecutive_errors += 1
-                if consecutive_errors >= max_errors:
-                    break
-                await asyncio.sleep(0.1)
-                
+
+        print(f"Frames received: {mailbox.received}, dropped before decode: {mailbox.dropped}")
+
+        if analysis_task.done() and not analysis_task.cancelled() and analysis_task.exception() is not None:
+            # The analysis loop died: tell the page instead of leaving it waiting on an open socket
+            error = analysis_task.exception()
+            print(f"Error in frame analysis: {error}")
+            import traceback
+            traceback.print_exception(type(error), error, error.__traceback__)
+            metrics.REGISTRY.inc("websocket_errors_total", "/ws connections ended by an unexpected error")
+            try:
+                await websocket.send_json({"error": f"An error occurred: {str(error)}"})
+                await websocket.close(code=1011)  # Internal error
+            except:
+                pass
+
     except asyncio.CancelledError:
         print("WebSocket connection cancelled")
     except Exception as e:
         print(f"Error in WebSocket handler: {e}")
         import traceback
         traceback.print_exc()
+        metrics.REGISTRY.inc("websocket_errors_total", "/ws connections ended by an unexpected error")
         try:
             await websocket.send_json({"error": f"An error occurred: {str(e)}"})
             await websocket.close(code=1011)  # Internal error
@@ -395,37 +621,83 @@ async def websocket_endpoint(websocket: WebSocket):
     finally:
         # Clean up
         connection_active = False
+        if analysis_task is not None:
+            analysis_task.cancel()
+        if mailbox is not None:
+            open_mailboxes.discard(mailbox)
+            closed_frame_counts["received"] += mailbox.received
+            closed_frame_counts["dropped"] += mailbox.dropped
+        session_registry.disconnect(session)
         print("WebSocket connection closed")
 
-def evaluate():
-    flagged = 0
-    session_data["active"] = False
-    filepath = "suspicious_behaviour/session_log/"
-    os.makedirs(filepath, exist_ok=True)
-    filename = f"session_{session_data['session_id']}.json"
-    file = filepath + filename
-    with open(file, "w") as f:
-        json.dump(session_data["data"], f, indent=2)
-        
-    with open(file, "r") as f:
-        data = json.load(f)
-        
-        for i in data:
-            if i["direction"] == "Flagged: Looking away for 3+ seconds":
-                flagged += 1
-    
+def evaluate(session):
+    """Finish a session; returns a future of its number of flagged events.
+
+    The log has been streamed to disk as events arrived and the flags were
+    counted along the way, so this only closes the log. The count is the
+    store's, which includes connections other workers served, and is read on
+    the registry's writer thread once this worker's counts are in.
+    """
+    session.finish()
+    session_registry.sync(session)
+    evidence_writer.forget(session.session_id)
+    calibration_cache.discard(session.session_id)
+    return session_registry.write(finish_session, session.session_id, session.flagged)
+
+def finish_session(session_id, flagged=None):
+    """Mark a session finished in the store and report its flags (``flagged`` if the store doesn't know it)"""
+    record = session_store.finish(session_id)
+    if record is not None:
+        flagged = record.flagged
+    return report_flagged(session_id, flagged) if flagged is not None else None
+
+def report_flagged(session_id, flagged):
     if flagged > 1000:
-        print(f"User with id {session_data['session_id']} engaged in malpractice")
-    
+        print(f"User with id {session_id} engaged in malpractice")
     return flagged
-        
+
+
+def session_report(session_id, log=None):
+    """Gaze analytics of a finished session, read back from its log (None without one); runs on a thread"""
+    if log is not None and not log.written.wait(REPORT_LOG_TIMEOUT):
+        print(f"Session log of {session_id} still not written after {REPORT_LOG_TIMEOUT}s, reporting on what's there")
+    path = session_index.log_path(session_id) if session_index is not None else None
+    try:
+        report = analytics.session_report(session_id, log_writer.directory, path)
+    except (OSError, ValueError) as e:
+        print(f"Error reading the session log of {session_id}: {e}")
+        return None
+    if report is not None and session_index is not None:
+        session_index.add_summary(report, path)
+        report["evidence"] = [{"taken_at": analytics.iso(taken_at), "path": image, "bytes": size}
+                              for taken_at, image, size in session_index.evidence(session_id)]
+    if report is not None:
+        away = report["away_episodes"]
+        print(f"Session {session_id}: {report['duration_s']:.0f}s, {away['count']} away episodes "
+              f"({away['flagged']} flagged, {away['total_s']:.0f}s), "
+              f"{report['no_face']['count']} without a face ({report['no_face']['total_s']:.0f}s)")
+    return report
+
 
 @app.get("/result")
-def results(): 
+async def results(request: Request, session_id: str = None, format: str = None):
+    """The result page; with ?format=json, the session's gaze analytics report instead"""
     # Camera is managed per WebSocket connection, not globally
-    evaluate()
-    page = Path("templates/result.html")
-    if not page.exists():
+    session_id = parse_session_id(session_id or request.cookies.get(SESSION_COOKIE))
+    session = session_registry.get(session_id)
+    log = None
+    if session is not None:
+        await asyncio.wrap_future(evaluate(session))
+        log = session.log
+    elif session_id is not None:
+        # The session's connections were served by another worker
+        await asyncio.wrap_future(session_registry.write(finish_session, session_id))
+    report = await asyncio.to_thread(session_report, session_id, log) if session_id is not None else None
+    if format == "json":
+        if report is None:
+            return JSONResponse({"error": "No gaze log found for this session"}, status_code=404)
+        return JSONResponse(report)
+    response = page_cache.response(request, "result.html")
+    if response is None:
         return {"error": "Template file not found"}
-    context = page.read_text(encoding="utf-8")
-    return HTMLResponse(content=context, status_code=200)
\ No newline at end of file
+    return response
\ No newline at end of file
@@ -0,0 +1,149 @@
+"""Process metrics in the Prometheus text format, served on /metrics.
+
+Two kinds of metric:
+
+- Latency histograms of the stages a frame goes through, labelled by stage:
+  ``receive`` (handling the WebSocket message), ``queued`` (from arrival to
+  a worker picking the frame up: mailbox plus scheduler), ``decode``,
+  ``inference`` (FaceMesh and the gaze measurement), ``classify`` (gaze
+  timers), ``send`` and ``frame`` (arrival to result sent), plus the disk
+  writes ``log_write``, ``log_fsync`` and ``evidence_write``. Only a
+  METRICS_SAMPLE_RATE fraction of frames is timed, so the hot path can stay
+  instrumented under full load; disk writes are batched and always timed.
+- Counters and gauges read from their owners (sessions, mailboxes, the
+  inference pool, the writers) by callbacks at scrape time, so they cost
+  nothing per frame.
+"""
+import bisect
+import os
+import random
+import threading
+import time
+
+
+# Fraction of frames whose stages are timed; 0 turns the timers off
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+
+# Histogram bucket bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+STAGES = ("receive", "queued", "decode", "inference", "classify", "send", "frame", "log_write", "log_fsync",
+          "evidence_write")
+
+PREFIX = "gaze_"
+
+
+class Histogram:
+    """Cumulative latency histogram; observe() may be called from any thread"""
+
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # One slot per bound plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Registry:
+    def __init__(self, sample_rate=METRICS_SAMPLE_RATE, stages=STAGES):
+        self.sample_rate = sample_rate
+        self.stages = {stage: Histogram() for stage in stages}
+        # name -> [help, value] of counters incremented with inc()
+        self._counters = {}
+        # name -> (type, help, callback returning a number or {label value: number}, label name)
+        self._collected = {}
+
+    def sampled(self):
+        """Whether to time the current frame"""
+        return random.random() < self.sample_rate
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    def inc(self, name, help_text, amount=1):
+        counter = self._counters.get(name)
+        if counter is None:
+            counter = self._counters[name] = [help_text, 0]
+        counter[1] += amount
+
+    def counter(self, name, help_text, callback, label=None):
+        """Register a counter read from ``callback`` at scrape time"""
+        self._collected[name] = ("counter", help_text, callback, label)
+
+    def gauge(self, name, help_text, callback, label=None):
+        """Register a gauge read from ``callback`` at scrape time"""
+        self._collected[name] = ("gauge", help_text, callback, label)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        name = PREFIX + "stage_seconds"
+        lines.append(f"# HELP {name} Time spent per frame in each pipeline stage (sampled) and per disk write")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in self.stages.items():
+            counts, total, count = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket in zip(histogram.bounds, counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+        for counter_name, (help_text, value) in self._counters.items():
+            _append(lines, PREFIX + counter_name, "counter", help_text, value)
+        for metric_name, (kind, help_text, callback, label) in self._collected.items():
+            try:
+                value = callback()
+            except Exception as e:
+                print(f"Error collecting metric {metric_name}: {e}")
+                continue
+            if value is not None:
+                _append(lines, PREFIX + metric_name, kind, help_text, value, label)
+
+        # process_time() is user plus system time, like getrusage(), but also on Windows
+        _append(lines, "process_cpu_seconds_total", "counter", "User and system CPU time of this process",
+                round(time.process_time(), 6))
+        rss = _resident_memory()
+        if rss is not None:
+            _append(lines, "process_resident_memory_bytes", "gauge", "Resident memory of this process", rss)
+        _append(lines, "process_start_time_seconds", "gauge", "Start time of this process (Unix time)", START_TIME)
+        return "\n".join(lines) + "\n"
+
+
+def _append(lines, name, kind, help_text, value, label=None):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    if isinstance(value, dict):
+        for label_value, number in value.items():
+            lines.append(f'{name}{{{label}="{label_value}"}} {number}')
+    else:
+        lines.append(f"{name} {value}")
+
+
+def _resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+START_TIME = time.time()
+
+# The registry of this process
+REGISTRY = Registry()
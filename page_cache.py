@@ -0,0 +1,154 @@
+"""In-memory cache of the HTML pages, served compressed and revalidated with ETags.
+
+/, /home and /result used to read their template from disk on every request
+and send it uncompressed; at exam start hundreds of students load /home at
+once. PageCache instead:
+
+- reads each page once, and again only when its modification time or size
+  changes, checked at most every PAGE_CHECK_INTERVAL seconds,
+- compresses it once per version: gzip, plus brotli when the ``brotli``
+  package is installed, sending whichever the browser accepts,
+- tags every variant with an ETag and answers a matching If-None-Match with
+  an empty 304, so a reload costs no body at all.
+
+Pages are sent with ``Cache-Control: no-cache``: browsers keep them but ask
+each time, so a changed template reaches everyone on their next load.
+"""
+import gzip
+import hashlib
+import os
+import time
+
+from fastapi import Response
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+
+TEMPLATE_DIR = "templates"
+# Seconds between checks of a cached page's modification time; 0 checks on every request
+PAGE_CHECK_INTERVAL = float(os.environ.get("PAGE_CHECK_INTERVAL", "2"))
+
+# Compressed once per page version, so the slowest settings are affordable
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+MEDIA_TYPE = "text/html; charset=utf-8"
+
+
+class Page:
+    __slots__ = ("path", "mtime", "size", "checked_at", "body", "etag", "variants")
+
+    def __init__(self, path, mtime, size, body, checked_at):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.checked_at = checked_at
+        self.body = body
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        self.etag = f'"{digest}"'
+        # content coding -> (body, etag), best first; each coding gets its own
+        # strong ETag since the bytes differ
+        self.variants = {}
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+            if len(compressed) < len(body):
+                self.variants["br"] = (compressed, f'"{digest}-br"')
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+        if len(compressed) < len(body):
+            self.variants["gzip"] = (compressed, f'"{digest}-gz"')
+
+    def etags(self):
+        return {self.etag, *(etag for _, etag in self.variants.values())}
+
+
+def accepted_codings(header):
+    """Content codings an Accept-Encoding header allows (q > 0), lowercased"""
+    codings = set()
+    for part in (header or "").split(","):
+        coding, _, parameters = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            codings.add(coding)
+    return codings
+
+
+def etag_matches(header, etags):
+    """Whether an If-None-Match header matches any of ``etags`` (weak comparison, as RFC 9110 asks)"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in etags:
+            return True
+    return False
+
+
+class PageCache:
+    def __init__(self, directory=TEMPLATE_DIR, check_interval=PAGE_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._pages = {}
+        self.loads = 0
+        self.not_modified = 0
+
+    def get(self, name):
+        """The cached Page of template ``name``, reloaded if the file changed; None if it doesn't exist"""
+        page = self._pages.get(name)
+        now = time.monotonic()
+        if page is not None and now - page.checked_at < self.check_interval:
+            return page
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._pages.pop(name, None)
+            return None
+        if page is not None and page.mtime == stat.st_mtime_ns and page.size == stat.st_size:
+            page.checked_at = now
+            return page
+        with open(path, "rb") as f:
+            body = f.read()
+        page = self._pages[name] = Page(path, stat.st_mtime_ns, stat.st_size, body, now)
+        self.loads += 1
+        return page
+
+    def preload(self, *names):
+        for name in names:
+            self.get(name)
+
+    def response(self, request, name):
+        """Response for template ``name``: 304, compressed or plain as the request allows; None if it doesn't exist"""
+        page = self.get(name)
+        if page is None:
+            return None
+        headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        body, etag = page.body, page.etag
+        codings = accepted_codings(request.headers.get("accept-encoding"))
+        for coding, (compressed, variant_etag) in page.variants.items():
+            if coding in codings:
+                body, etag = compressed, variant_etag
+                headers["Content-Encoding"] = coding
+                break
+        headers["ETag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), page.etags()):
+            self.not_modified += 1
+            headers.pop("Content-Encoding", None)
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type=MEDIA_TYPE, headers=headers)
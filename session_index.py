@@ -0,0 +1,367 @@
+"""SQLite index of sessions, their gaze summaries and evidence images.
+
+Session logs and evidence images are flat files, named by session id (plus a
+millisecond timestamp for images), in directories that only grow. The index
+records where each one is, next to the session store's table in the same
+database (SESSION_INDEX_PATH, by default the store's SESSION_STORE_PATH), so
+finding a session's log or images, or the sessions of a time range or with
+many flags, is an indexed lookup instead of a directory listing:
+
+- ``session_summaries``: one row per session, added when it is created, with
+  its log path, and filled in with analytics.summary() once it has been
+  reported on (by /result, or by maintenance once it has gone idle). Its
+  ``updated_at`` moves whenever the registry syncs new gaze events, so a
+  running exam is never idle, and a session that logs again after its
+  summary is summarized again,
+- ``evidence``: one row per image the EvidenceWriter wrote.
+
+maintain(), run every RETENTION_INTERVAL seconds, summarizes idle sessions
+nobody asked /result about, compacts the JSON Lines logs of sessions finished
+LOG_COMPACT_AFTER seconds ago to .npz (see events.py), and deletes sessions
+started more than RETENTION_DAYS days ago, with their logs and images.
+
+Run this module to query the index, or to (re)build it from the files:
+
+    python session_index.py sessions --since 2026-10-01 --min-flagged 100
+    python session_index.py evidence <session_id>
+    python session_index.py rebuild
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+import analytics
+import events
+from evidence import EVIDENCE_DIR
+from session_log import SESSION_LOG_DIR
+from sessions import SESSION_IDLE_TIMEOUT
+from store import SESSION_STORE_PATH
+
+
+SESSION_INDEX = os.environ.get("SESSION_INDEX", "1") == "1"
+SESSION_INDEX_PATH = os.environ.get("SESSION_INDEX_PATH", SESSION_STORE_PATH)
+# Days sessions, their logs and images are kept; 0 keeps them forever
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS", "90"))
+# Seconds after a session's last gaze that its JSON Lines log is compacted to .npz; 0 never
+LOG_COMPACT_AFTER = float(os.environ.get("LOG_COMPACT_AFTER", "86400"))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))
+# Most sessions summarized, compacted or deleted per maintenance step
+MAINTENANCE_BATCH = 200
+
+# analytics.summary() fields kept per session
+SUMMARY_COLUMNS = ("duration_s", "frames", "center_share", "away_s", "away_episodes", "flagged_episodes",
+                   "longest_away_s", "no_face_s", "no_face_intervals", "flagged_frames")
+
+SESSION_FIELDS = ("session_id", "started_at", "updated_at", "ended_at", "summarized_at", "log_path") \
+    + SUMMARY_COLUMNS
+
+
+class SessionIndex:
+    def __init__(self, path=SESSION_INDEX_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # Autocommit, as in store.py; _executemany() runs its statements in one transaction
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS session_summaries (
+                session_id TEXT PRIMARY KEY,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                ended_at REAL,
+                summarized_at REAL,
+                log_path TEXT,
+                duration_s REAL,
+                frames INTEGER,
+                center_share REAL,
+                away_s REAL,
+                away_episodes INTEGER,
+                flagged_episodes INTEGER,
+                longest_away_s REAL,
+                no_face_s REAL,
+                no_face_intervals INTEGER,
+                flagged_frames INTEGER NOT NULL DEFAULT 0
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS session_summaries_started_at ON session_summaries (started_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS session_summaries_updated_at ON session_summaries (updated_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS session_summaries_ended_at ON session_summaries (ended_at)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS session_summaries_flagged ON session_summaries (flagged_frames)")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS evidence (
+                path TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                taken_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS evidence_session ON evidence (session_id, taken_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS evidence_taken_at ON evidence (taken_at)")
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters)
+
+    def _executemany(self, sql, rows):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(sql, rows)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def add_session(self, session_id, started_at, log_path=None):
+        """Record a new session and where its log goes; keeps the row of a known session"""
+        self._execute(
+            "INSERT INTO session_summaries (session_id, started_at, updated_at, log_path) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at,"
+            " log_path = coalesce(session_summaries.log_path, excluded.log_path)",
+            (session_id, started_at, time.time(), log_path))
+
+    def touch(self, session_ids, now=None):
+        """Mark sessions as updated, i.e. as having logged gaze since their last summary"""
+        now = time.time() if now is None else now
+        self._executemany("UPDATE session_summaries SET updated_at = ? WHERE session_id = ?",
+                          [(now, session_id) for session_id in session_ids])
+
+    def add_summary(self, report, log_path=None):
+        """Store the analytics.summary() of a session's report"""
+        row = analytics.summary(report)
+        started_at = _timestamp(report["start"])
+        ended_at = _timestamp(report["end"])
+        now = time.time()
+        self._execute(
+            "INSERT INTO session_summaries (session_id, started_at, updated_at, ended_at, summarized_at, log_path, "
+            + ", ".join(SUMMARY_COLUMNS) + ") VALUES (" + ", ".join("?" * (6 + len(SUMMARY_COLUMNS))) + ")"
+            " ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at,"
+            " ended_at = excluded.ended_at, summarized_at = excluded.summarized_at,"
+            " log_path = coalesce(excluded.log_path, session_summaries.log_path), "
+            + ", ".join(f"{column} = excluded.{column}" for column in SUMMARY_COLUMNS),
+            (report["session_id"], started_at or now, now, ended_at, now, log_path)
+            + tuple(row[column] for column in SUMMARY_COLUMNS))
+
+    def add_evidence(self, session_id, taken_at, path, size):
+        self._execute("INSERT OR REPLACE INTO evidence (path, session_id, taken_at, size) VALUES (?, ?, ?, ?)",
+                      (path, session_id, taken_at, size))
+
+    def get(self, session_id):
+        """A session's row as a dict, None if it isn't indexed"""
+        rows = self._query(f"SELECT {', '.join(SESSION_FIELDS)} FROM session_summaries WHERE session_id = ?",
+                           (session_id,))
+        return dict(zip(SESSION_FIELDS, rows[0])) if rows else None
+
+    def log_path(self, session_id):
+        rows = self._query("SELECT log_path FROM session_summaries WHERE session_id = ?", (session_id,))
+        return rows[0][0] if rows else None
+
+    def evidence(self, session_id):
+        """A session's images as (taken_at, path, size), oldest first"""
+        return self._query("SELECT taken_at, path, size FROM evidence WHERE session_id = ? ORDER BY taken_at",
+                           (session_id,))
+
+    def find(self, since=None, until=None, min_flagged=None, min_flagged_episodes=None, limit=100):
+        """Sessions started in [since, until) (Unix time) with at least that many flags, newest first"""
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append("started_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("started_at < ?")
+            parameters.append(until)
+        if min_flagged is not None:
+            conditions.append("flagged_frames >= ?")
+            parameters.append(min_flagged)
+        if min_flagged_episodes is not None:
+            conditions.append("flagged_episodes >= ?")
+            parameters.append(min_flagged_episodes)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        rows = self._query(f"SELECT {', '.join(SESSION_FIELDS)} FROM session_summaries{where}"
+                           " ORDER BY started_at DESC LIMIT ?", (*parameters, limit))
+        return [dict(zip(SESSION_FIELDS, row)) for row in rows]
+
+    def summarize_idle(self, before, directory=SESSION_LOG_DIR, limit=MAINTENANCE_BATCH):
+        """Summarize sessions not updated since ``before`` whose summary is missing or older than their last
+        update; returns how many"""
+        rows = self._query("SELECT session_id, log_path FROM session_summaries WHERE updated_at < ?"
+                           " AND (summarized_at IS NULL OR summarized_at < updated_at) LIMIT ?", (before, limit))
+        for session_id, log_path in rows:
+            if log_path is None or not os.path.exists(log_path):
+                log_path = analytics.find_session_log(session_id, directory)
+            report = None
+            if log_path is not None:
+                try:
+                    report = analytics.report(analytics.load_timeline(log_path))
+                except (OSError, ValueError) as e:
+                    print(f"Error summarizing session {session_id}: {e}")
+            if report is not None:
+                self.add_summary(report, log_path)
+            else:
+                # Nothing to summarize; don't look at it again
+                self._execute("UPDATE session_summaries SET summarized_at = ? WHERE session_id = ?",
+                              (time.time(), session_id))
+        return len(rows)
+
+    def compact_logs(self, before, limit=MAINTENANCE_BATCH):
+        """Convert the JSON Lines logs of sessions that ended before ``before`` to .npz; returns how many"""
+        rows = self._query("SELECT session_id, log_path FROM session_summaries"
+                           " WHERE ended_at < ? AND log_path LIKE '%.jsonl' LIMIT ?", (before, limit))
+        compacted = 0
+        for session_id, log_path in rows:
+            target = os.path.join(os.path.dirname(log_path), f"session_{session_id}.npz")
+            try:
+                if os.path.exists(log_path):
+                    events.convert(log_path, target)
+                    os.remove(log_path)
+                    compacted += 1
+                elif not os.path.exists(target):
+                    target = None
+            except (OSError, ValueError) as e:
+                print(f"Error compacting {log_path}: {e}")
+                continue
+            self._execute("UPDATE session_summaries SET log_path = ? WHERE session_id = ?", (target, session_id))
+        return compacted
+
+    def expire(self, before, limit=MAINTENANCE_BATCH):
+        """Delete sessions started before ``before`` with their logs and images, and older orphaned images.
+
+        Returns (sessions, images) deleted.
+        """
+        sessions = images = 0
+        while True:
+            rows = self._query("SELECT session_id, log_path FROM session_summaries WHERE started_at < ? LIMIT ?",
+                               (before, limit))
+            if not rows:
+                break
+            for session_id, log_path in rows:
+                if log_path is not None:
+                    _remove(log_path)
+                images += self._delete_evidence("session_id = ?", (session_id,))
+            self._executemany("DELETE FROM session_summaries WHERE session_id = ?",
+                              [(session_id,) for session_id, _ in rows])
+            sessions += len(rows)
+        images += self._delete_evidence("taken_at < ?", (before,))
+        return sessions, images
+
+    def _delete_evidence(self, condition, parameters):
+        rows = self._query(f"SELECT path FROM evidence WHERE {condition}", parameters)
+        for (path,) in rows:
+            _remove(path)
+        self._executemany("DELETE FROM evidence WHERE path = ?", rows)
+        return len(rows)
+
+    def maintain(self, now=None, idle_after=SESSION_IDLE_TIMEOUT, compact_after=LOG_COMPACT_AFTER,
+                 retention_days=RETENTION_DAYS):
+        """One maintenance pass: summarize idle sessions, compact old logs, expire old sessions"""
+        now = time.time() if now is None else now
+        summarized = self.summarize_idle(now - idle_after)
+        compacted = self.compact_logs(now - compact_after) if compact_after > 0 else 0
+        sessions, images = self.expire(now - retention_days * 86400) if retention_days > 0 else (0, 0)
+        self._execute("PRAGMA optimize")
+        if summarized or compacted or sessions or images:
+            print(f"Session index: summarized {summarized} idle sessions, compacted {compacted} logs, "
+                  f"deleted {sessions} expired sessions and {images} images")
+        return summarized, compacted, sessions, images
+
+    async def run_maintenance(self, interval=RETENTION_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.maintain)
+            except Exception as e:
+                print(f"Error maintaining the session index: {e}")
+
+    def rebuild(self, log_dir=SESSION_LOG_DIR, evidence_dir=EVIDENCE_DIR, workers=None):
+        """Index every session log and evidence image on disk; returns (sessions, images)"""
+        sessions = 0
+        for path, report, error in analytics.run_reports(analytics.expand_logs([log_dir]), workers=workers):
+            if error is not None:
+                print(f"Skipping {path}: {error}")
+                continue
+            self.add_summary(report, path)
+            sessions += 1
+        images = []
+        for name in os.listdir(evidence_dir) if os.path.isdir(evidence_dir) else ():
+            session_id, _, stamp = os.path.splitext(name)[0].rpartition("_")
+            if not session_id or not stamp.isdigit():
+                continue
+            path = os.path.join(evidence_dir, name)
+            images.append((path, session_id, int(stamp) / 1000, os.path.getsize(path)))
+        self._executemany("INSERT OR REPLACE INTO evidence (path, session_id, taken_at, size) VALUES (?, ?, ?, ?)",
+                          images)
+        return sessions, len(images)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _timestamp(iso):
+    return datetime.datetime.fromisoformat(iso).timestamp() if iso else None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_index(enabled=SESSION_INDEX, path=SESSION_INDEX_PATH):
+    return SessionIndex(path) if enabled else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and maintain the session index")
+    parser.add_argument("--db", default=SESSION_INDEX_PATH, help=f"index database (default: {SESSION_INDEX_PATH})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    find = commands.add_parser("sessions", help="list sessions, newest first")
+    find.add_argument("--since", type=_timestamp, help="started at or after this date/time (ISO 8601)")
+    find.add_argument("--until", type=_timestamp, help="started before this date/time (ISO 8601)")
+    find.add_argument("--min-flagged", type=int, help="at least this many flagged frames")
+    find.add_argument("--min-flagged-episodes", type=int, help="at least this many flagged away episodes")
+    find.add_argument("--limit", type=int, default=100)
+    show = commands.add_parser("evidence", help="list a session's evidence images")
+    show.add_argument("session_id")
+    rebuild = commands.add_parser("rebuild", help="index the session logs and evidence images on disk")
+    rebuild.add_argument("--logs", default=SESSION_LOG_DIR)
+    rebuild.add_argument("--images", default=EVIDENCE_DIR)
+    rebuild.add_argument("--workers", type=int, default=0, help="worker processes (default: CPU count)")
+    commands.add_parser("maintain", help="run one maintenance pass now")
+    args = parser.parse_args()
+
+    index = SessionIndex(args.db)
+    try:
+        if args.command == "sessions":
+            for row in index.find(args.since, args.until, args.min_flagged, args.min_flagged_episodes, args.limit):
+                summary = (f"{row['duration_s']:.0f}s, {row['flagged_frames']} flagged frames, "
+                           f"{row['flagged_episodes']} flagged episodes" if row["summarized_at"] and row["frames"]
+                           else "not summarized")
+                print(f"{row['session_id']}  {analytics.iso(row['started_at'])}  {summary}  {row['log_path'] or '-'}")
+        elif args.command == "evidence":
+            for taken_at, path, size in index.evidence(args.session_id):
+                print(f"{analytics.iso(taken_at)}  {path}  {size} bytes")
+        elif args.command == "rebuild":
+            started = time.perf_counter()
+            sessions, images = index.rebuild(args.logs, args.images, args.workers)
+            print(f"Indexed {sessions} sessions and {images} images in {time.perf_counter() - started:.1f}s")
+        else:
+            index.maintain()
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
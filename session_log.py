@@ -0,0 +1,202 @@
+"""Append-only session logs.
+
+Events are buffered in memory as they arrive (as direction codes in an
+events.EventBuffer) and a background thread appends them to
+``session_<id>.jsonl``, or to the packed binary ``session_<id>.events`` with
+LOG_FORMAT=binary, in batches, flushing every LOG_FLUSH_INTERVAL
+seconds and fsyncing every LOG_FSYNC_INTERVAL seconds and when a session's
+log is closed. Nothing here runs file I/O on the event loop, and a session's
+events are never all held in memory at once.
+
+With LOG_MODE=intervals, runs of identical directions are collapsed into one
+(direction, start, end, frames) interval each before they are buffered, and
+the log goes to ``session_<id>.intervals.jsonl`` (or ``.intervals``).
+
+read_session_log() streams a log back one record at a time, for offline
+analysis; it also reads the JSON array logs written by older versions. See
+events.py for converting between formats.
+"""
+import json
+import os
+import threading
+import time
+
+import events
+import metrics
+from events import EventBuffer, IntervalBuffer, RunLengthEncoder
+
+
+SESSION_LOG_DIR = "suspicious_behaviour/session_log/"
+# jsonl or binary
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "jsonl")
+# events (one record per analyzed frame) or intervals (one per run of identical directions)
+LOG_MODE = os.environ.get("LOG_MODE", "events")
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_FSYNC_INTERVAL = float(os.environ.get("LOG_FSYNC_INTERVAL", "10.0"))
+# Wake the writer early once a session has this many events waiting
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "256"))
+
+
+def session_log_path(session_id, directory=SESSION_LOG_DIR, log_format=LOG_FORMAT, log_mode=LOG_MODE):
+    if log_format == "binary":
+        extension = log_mode
+    else:
+        extension = "jsonl" if log_mode == "events" else "intervals.jsonl"
+    return os.path.join(directory, f"session_{session_id}.{extension}")
+
+
+def read_session_log(path):
+    """Yield the records of a session log, one dict per event or interval"""
+    if events.format_of(path) != "jsonl":
+        session_id, records = events.load_records(path)
+        for line in events.jsonl_records(session_id, records):
+            yield json.loads(line)
+        return
+    with open(path, "r") as f:
+        if path.endswith(".json"):
+            # Legacy format: the whole session as one JSON array
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class SessionLog:
+    """Log of one session. append() is called on the event loop, everything
+    else runs on the LogWriter thread."""
+
+    def __init__(self, writer, session_id, path, intervals=False):
+        self.writer = writer
+        self.session_id = session_id
+        self.path = path
+        self.binary = events.format_of(path) != "jsonl"
+        self.closed = False
+        # Loop side only: the interval still being extended
+        self._encoder = RunLengthEncoder() if intervals else None
+        self._buffer_type = IntervalBuffer if intervals else EventBuffer
+        self._pending = self._buffer_type()
+        self._lock = threading.Lock()
+        self._file = None
+        self._last_fsync = time.monotonic()
+        # Set once the log is closed and all of it is on disk
+        self.written = threading.Event()
+
+    def append(self, code):
+        if self._encoder is not None:
+            interval = self._encoder.update(code)
+            if interval is None:
+                return
+            with self._lock:
+                self._pending.append(*interval)
+                pending = len(self._pending)
+        else:
+            with self._lock:
+                self._pending.append(code)
+                pending = len(self._pending)
+        if pending >= LOG_BATCH_SIZE:
+            self.writer.wake()
+
+    def close(self):
+        """Stop accepting events; the writer writes what's left and closes the file"""
+        if self._encoder is not None:
+            interval = self._encoder.flush()
+            if interval is not None:
+                with self._lock:
+                    self._pending.append(*interval)
+        self.closed = True
+        self.writer.wake()
+
+    def write_pending(self, force_fsync=False):
+        with self._lock:
+            batch, self._pending = self._pending, self._buffer_type()
+        if len(batch):
+            started = time.perf_counter()
+            records = batch.to_records()
+            if self._file is None:
+                self._file = open(self.path, "ab" if self.binary else "a", encoding=None if self.binary else "utf-8")
+            if self.binary:
+                self._file.write(records.tobytes())
+            else:
+                self._file.write("".join(events.jsonl_records(self.session_id, records)))
+            self._file.flush()
+            metrics.REGISTRY.observe("log_write", time.perf_counter() - started)
+        if self._file is not None and (force_fsync or time.monotonic() - self._last_fsync >= LOG_FSYNC_INTERVAL):
+            started = time.perf_counter()
+            os.fsync(self._file.fileno())
+            metrics.REGISTRY.observe("log_fsync", time.perf_counter() - started)
+            self._last_fsync = time.monotonic()
+
+    def close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LogWriter:
+    """Background thread that writes every open SessionLog to disk."""
+
+    def __init__(self, directory=SESSION_LOG_DIR, flush_interval=LOG_FLUSH_INTERVAL, log_format=LOG_FORMAT,
+                 log_mode=LOG_MODE):
+        if log_format not in ("jsonl", "binary"):
+            raise ValueError(f"Unknown LOG_FORMAT {log_format!r}, expected 'jsonl' or 'binary'")
+        if log_mode not in ("events", "intervals"):
+            raise ValueError(f"Unknown LOG_MODE {log_mode!r}, expected 'events' or 'intervals'")
+        self.directory = directory
+        self.log_format = log_format
+        self.log_mode = log_mode
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self._logs = {}
+        # Closed logs replaced in _logs by a reopened one, still to be written out
+        self._closing = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="session-log-writer", daemon=True)
+        self._thread.start()
+
+    def open(self, session_id):
+        """Return the log of ``session_id``, appending to its file if it already exists"""
+        with self._lock:
+            log = self._logs.get(session_id)
+            if log is None or log.closed:
+                if log is not None:
+                    self._closing.append(log)
+                log = self._logs[session_id] = SessionLog(
+                    self, session_id, session_log_path(session_id, self.directory, self.log_format, self.log_mode),
+                    intervals=self.log_mode == "intervals")
+        return log
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        """Write and close all logs, then stop the thread"""
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._write_all()
+        self._write_all(final=True)
+
+    def _write_all(self, final=False):
+        with self._lock:
+            logs = list(self._logs.values()) + self._closing
+            self._closing = []
+        for log in logs:
+            done = log.closed or final
+            try:
+                log.write_pending(force_fsync=done)
+            except OSError as e:
+                print(f"Error writing session log {log.path}: {e}")
+            if done:
+                log.close_file()
+                log.written.set()
+                with self._lock:
+                    if self._logs.get(log.session_id) is log:
+                        del self._logs[log.session_id]
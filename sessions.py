@@ -0,0 +1,237 @@
+"""In-memory registry of exam sessions.
+
+Replaces the single global ``session_data`` dict, which only allowed one exam
+per server and grew without bound. Every session is keyed by its id (a UUID
+handed out by /home and sent back on /ws and /result), streams its gaze
+events to its session log, keeps running counters so /result doesn't have to
+read the log back, and is evicted once it has had no connection for
+SESSION_IDLE_TIMEOUT seconds.
+
+The registry only knows the sessions of its own process. With several worker
+processes, what another worker needs (the session's existence and counters)
+goes to the shared session store, see store.py: counters are pushed as deltas
+every SESSION_SYNC_INTERVAL seconds and when a connection closes. Store and
+index writes go through write(), which runs them in order on one thread: a
+SQLite write can wait seconds for another worker's lock, and the event loop
+must not wait with it.
+"""
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from events import LABELS, Direction, encode
+from store import SESSION_STORE_TTL
+
+
+SESSION_COOKIE = "session_id"
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", "1800"))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "1000"))
+SESSION_SYNC_INTERVAL = float(os.environ.get("SESSION_SYNC_INTERVAL", "5"))
+
+FLAGGED_DIRECTION = LABELS[Direction.AWAY_FLAGGED]
+
+
+def parse_session_id(value):
+    """Return ``value`` as a canonical session id, or None if it isn't a UUID.
+
+    Session ids end up in file names, so anything else is rejected.
+    """
+    if not value:
+        return None
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+
+class Session:
+    __slots__ = ("session_id", "created_at", "last_seen", "active", "connections", "log", "event_count", "flagged",
+                 "synced_events", "synced_flagged")
+
+    def __init__(self, session_id, log=None):
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.last_seen = time.monotonic()
+        self.active = False
+        self.connections = 0
+        # session_log.SessionLog the events are streamed to, if any
+        self.log = log
+        self.event_count = 0
+        self.flagged = 0
+        # Counts already pushed to the session store
+        self.synced_events = 0
+        self.synced_flagged = 0
+
+    def record(self, direction):
+        code = encode(direction)
+        self.event_count += 1
+        if code == Direction.AWAY_FLAGGED:
+            self.flagged += 1
+        if self.log is not None:
+            self.log.append(code)
+
+    def finish(self):
+        """Mark the session inactive and close its log"""
+        self.active = False
+        if self.log is not None:
+            self.log.close()
+
+
+class SessionRegistry:
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT, max_sessions=MAX_SESSIONS, log_writer=None, on_evict=None,
+                 store=None, index=None):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        # session_log.LogWriter that gives every session its log
+        self.log_writer = log_writer
+        # Session store shared with the other worker processes, if any
+        self.store = store
+        # session_index.SessionIndex that new sessions and their logs are recorded in, if any
+        self.index = index
+        # Called with each evicted session, e.g. to write out its log
+        self.on_evict = on_evict
+        # Least recently seen first
+        self._sessions = OrderedDict()
+        # Open connections across all sessions
+        self.connections = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-writer")
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self.touch(session)
+        return session
+
+    def create(self, session_id=None, active=True):
+        """Register a new session.
+
+        Only active sessions, i.e. exams, are logged: an inactive one (a /ws
+        connection without a session) gets no log and no store or index row.
+        """
+        session_id = session_id or str(uuid.uuid4())
+        log = self.log_writer.open(session_id) if active and self.log_writer is not None else None
+        session = Session(session_id, log)
+        session.active = active
+        if active and self.store is not None:
+            self.write(self.store.create, session_id)
+        if active and self.index is not None:
+            self.write(self.index.add_session, session_id, session.created_at, log.path if log is not None else None)
+        self._sessions[session.session_id] = session
+        if len(self._sessions) > self.max_sessions:
+            self._evict_oldest_idle()
+        return session
+
+    def get_or_create(self, session_id):
+        return self.get(session_id) or self.create(session_id)
+
+    def touch(self, session):
+        session.last_seen = time.monotonic()
+        self._sessions.move_to_end(session.session_id)
+
+    def connect(self, session):
+        session.connections += 1
+        self.connections += 1
+        self.touch(session)
+
+    def disconnect(self, session):
+        session.connections -= 1
+        self.connections -= 1
+        self.touch(session)
+        self.sync(session)
+
+    def sync(self, session):
+        """Push the counts recorded since the last sync to the store, and mark the session updated in the index"""
+        if self._push(session) and self.index is not None:
+            self.write(self.index.touch, [session.session_id])
+
+    def _push(self, session):
+        """Push the counts recorded since the last sync to the store; returns whether there were any"""
+        events = session.event_count - session.synced_events
+        flagged = session.flagged - session.synced_flagged
+        if not (events or flagged):
+            return False
+        if self.store is not None:
+            self.write(self.store.add_counts, session.session_id, events, flagged)
+        session.synced_events = session.event_count
+        session.synced_flagged = session.flagged
+        return True
+
+    def sync_all(self):
+        """Sync every session, marking those that recorded anything as updated in one index transaction"""
+        updated = [session.session_id for session in list(self._sessions.values()) if self._push(session)]
+        if updated and self.index is not None:
+            self.write(self.index.touch, updated)
+
+    def write(self, function, *args):
+        """Run ``function(*args)``, a store or index call, on the writer thread after the ones before it.
+
+        Returns its concurrent.futures.Future; errors are printed.
+        """
+        future = self._writer.submit(function, *args)
+        future.add_done_callback(_print_error)
+        return future
+
+    def close(self):
+        """Wait for the pending writes; the store and index can be closed after this"""
+        self._writer.shutdown(wait=True)
+
+    def remove(self, session_id):
+        return self._sessions.pop(session_id, None)
+
+    def evict_idle(self):
+        """Evict sessions with no connection that haven't been seen for idle_timeout seconds"""
+        deadline = time.monotonic() - self.idle_timeout
+        evicted = []
+        for session in list(self._sessions.values()):
+            if session.last_seen > deadline:
+                # Ordered by last_seen, everything after this is newer
+                break
+            if session.connections == 0:
+                evicted.append(self._evict(session))
+        return evicted
+
+    def _evict_oldest_idle(self):
+        for session in self._sessions.values():
+            if session.connections == 0:
+                self._evict(session)
+                return
+
+    def _evict(self, session):
+        del self._sessions[session.session_id]
+        if self.on_evict is not None:
+            try:
+                self.on_evict(session)
+            except Exception as e:
+                print(f"Error finalizing evicted session {session.session_id}: {e}")
+        # Whatever on_evict did, the log must not outlive the session
+        if session.log is not None and not session.log.closed:
+            session.log.close()
+        return session
+
+    async def run_eviction(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle()
+            if evicted:
+                print(f"Evicted {len(evicted)} idle sessions, {len(self._sessions)} left")
+            if self.store is not None:
+                self.write(self.store.expire, time.time() - SESSION_STORE_TTL)
+
+    async def run_sync(self, interval=SESSION_SYNC_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sync_all()
+            except Exception as e:
+                print(f"Error syncing sessions to the store: {e}")
+
+
+def _print_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error writing to the session store: {future.exception()}")
@@ -0,0 +1,169 @@
+"""Session state shared by every server process.
+
+A SessionRegistry holds the live Session objects of the connections its
+process serves: timers, the open log, the tracker. What a session needs when
+its next request lands on another worker process lives in a session store:
+
+- that the session exists, and whether it has been finished by /result,
+- its event and flagged counters, pushed as deltas by each process that
+  served one of its connections,
+- its gaze calibration, so a reconnect to another worker doesn't calibrate
+  again.
+
+SESSION_STORE picks the backend: ``memory`` for a single process, or
+``sqlite`` for any number of uvicorn workers on one machine, sharing the
+database at SESSION_STORE_PATH. By default it is ``sqlite`` as soon as
+WEB_CONCURRENCY (uvicorn's worker count) is above 1.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite" if WEB_CONCURRENCY > 1 else "memory")
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", "suspicious_behaviour/sessions.db")
+# Seconds a session's record is kept after it was last updated
+SESSION_STORE_TTL = float(os.environ.get("SESSION_STORE_TTL", "86400"))
+
+# calibration is the JSON text of calibration.to_json(), or None
+SessionRecord = namedtuple("SessionRecord", [
+    "session_id", "created_at", "updated_at", "event_count", "flagged", "finished", "calibration"])
+
+
+class MemorySessionStore:
+    """Store for a single server process"""
+
+    def __init__(self):
+        # session id -> [created_at, updated_at, event_count, flagged, finished, calibration]
+        self._records = {}
+
+    def create(self, session_id):
+        now = time.time()
+        self._records.setdefault(session_id, [now, now, 0, 0, False, None])
+
+    def get(self, session_id):
+        record = self._records.get(session_id)
+        return SessionRecord(session_id, *record) if record is not None else None
+
+    def add_counts(self, session_id, events, flagged):
+        record = self._records.get(session_id)
+        if record is None:
+            self.create(session_id)
+            record = self._records[session_id]
+        record[1] = time.time()
+        record[2] += events
+        record[3] += flagged
+
+    def finish(self, session_id):
+        """Mark a session finished and return its record (None if unknown)"""
+        record = self._records.get(session_id)
+        if record is None:
+            return None
+        record[1] = time.time()
+        record[4] = True
+        return self.get(session_id)
+
+    def set_calibration(self, session_id, calibration):
+        self.create(session_id)
+        record = self._records[session_id]
+        record[1] = time.time()
+        record[5] = calibration
+
+    def expire(self, before):
+        """Delete records not updated since ``before`` (Unix time); returns how many"""
+        expired = [session_id for session_id, record in self._records.items() if record[1] < before]
+        for session_id in expired:
+            del self._records[session_id]
+        return len(expired)
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """Store in a SQLite database shared by the worker processes of one machine"""
+
+    def __init__(self, path=SESSION_STORE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # Autocommit; every call is a single statement
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        # WAL lets the workers read while one of them writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                event_count INTEGER NOT NULL DEFAULT 0,
+                flagged INTEGER NOT NULL DEFAULT 0,
+                finished INTEGER NOT NULL DEFAULT 0,
+                calibration TEXT
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters)
+
+    def create(self, session_id):
+        now = time.time()
+        self._execute("INSERT OR IGNORE INTO sessions (session_id, created_at, updated_at) VALUES (?, ?, ?)",
+                      (session_id, now, now))
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT session_id, created_at, updated_at, event_count, flagged, finished, calibration"
+                " FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        return SessionRecord(*row[:5], bool(row[5]), row[6])
+
+    def add_counts(self, session_id, events, flagged):
+        now = time.time()
+        self._execute(
+            "INSERT INTO sessions (session_id, created_at, updated_at, event_count, flagged) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at,"
+            " event_count = event_count + excluded.event_count, flagged = flagged + excluded.flagged",
+            (session_id, now, now, events, flagged))
+
+    def finish(self, session_id):
+        """Mark a session finished and return its record (None if unknown)"""
+        self._execute("UPDATE sessions SET finished = 1, updated_at = ? WHERE session_id = ?",
+                      (time.time(), session_id))
+        return self.get(session_id)
+
+    def set_calibration(self, session_id, calibration):
+        now = time.time()
+        self._execute(
+            "INSERT INTO sessions (session_id, created_at, updated_at, calibration) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at,"
+            " calibration = excluded.calibration",
+            (session_id, now, now, calibration))
+
+    def expire(self, before):
+        """Delete records not updated since ``before`` (Unix time); returns how many"""
+        return self._execute("DELETE FROM sessions WHERE updated_at < ?", (before,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_store(kind=SESSION_STORE, path=SESSION_STORE_PATH):
+    if kind == "memory":
+        if WEB_CONCURRENCY > 1:
+            print(f"Warning: SESSION_STORE=memory with {WEB_CONCURRENCY} workers; "
+                  "sessions will only be found on the worker that created them")
+        return MemorySessionStore()
+    if kind == "sqlite":
+        return SQLiteSessionStore(path)
+    raise ValueError(f"Unknown SESSION_STORE {kind!r}, expected 'memory' or 'sqlite'")
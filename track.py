@@ -1,6 +1,7 @@
 import cv2
 import mediapipe as mp
-import numpy as np
+
+from landmarks import LandmarkBuffer
 
 mp_face_mesh = mp.solutions.face_mesh
 mp_drawing = mp.solutions.drawing_utils
@@ -18,17 +19,12 @@ face_mesh = mp_face_mesh.FaceMesh(
     min_tracking_confidence=0.5
 )
 
-def get_iris_center(landmarks, eye_indices, img_w, img_h):
-    points = []
-    for idx in eye_indices:
-        x = int(landmarks.landmark[idx].x * img_w)
-        y = int(landmarks.landmark[idx].y * img_h)
-        points.append((x, y))
-    if points:
-        cx = int(np.mean([p[0] for p in points]))
-        cy = int(np.mean([p[1] for p in points]))
-        return cx, cy
-    return None, None
+# Landmarks of the face being drawn, as a (478, 3) array in pixels
+landmark_buffer = LandmarkBuffer()
+
+def get_iris_center(points, eye_indices):
+    cx, cy = points[eye_indices, :2].mean(axis=0)
+    return int(cx), int(cy)
 
 def get_gaze_direction(left_eye_x, right_eye_x, frame_width):
     eye_avg_x = (left_eye_x + right_eye_x) / 2
@@ -51,8 +47,9 @@ while cap.isOpened():
     if results.multi_face_landmarks:
         for landmarks in results.multi_face_landmarks:
             # Get iris centers
-            left_eye_x, left_eye_y = get_iris_center(landmarks, LEFT_IRIS, img_w, img_h)
-            right_eye_x, right_eye_y = get_iris_center(landmarks, RIGHT_IRIS, img_w, img_h)
+            points = landmark_buffer.load(landmarks, img_w, img_h)
+            left_eye_x, left_eye_y = get_iris_center(points, LEFT_IRIS)
+            right_eye_x, right_eye_y = get_iris_center(points, RIGHT_IRIS)
 
             if left_eye_x and right_eye_x:
                 # Draw iris positions
@@ -9,8 +9,13 @@
     # from this we know the precise location of that landmark in the eye
 import cv2 
 import numpy as np
+import os
 import time
 
+import filters
+import gaze
+import landmarks as lm
+
 # Import MediaPipe with error handling
 try:
     import mediapipe as mp
@@ -18,104 +23,259 @@ except ImportError as e:
     raise ImportError(f"Failed to import MediaPipe: {e}. Make sure mediapipe is installed correctly.")
 
 
-class EyeTracker:
-    def __init__(self):
-        # Verify MediaPipe is properly imported
-        if not hasattr(mp, 'solutions'):
-            raise AttributeError(
-                f"MediaPipe 'solutions' module not found. "
-                f"MediaPipe version: {getattr(mp, '__version__', 'unknown')}. "
-                f"Available attributes: {dir(mp)}"
-            )
-        self.mp_face_mesh = mp.solutions.face_mesh
-        # Don't open camera here - it will be opened in main.py
-        # self.cap = cv2.VideoCapture(0)  # Removed to avoid conflicts
-        self.left_iris = [474, 475, 476, 477]
-        self.right_iris = [469, 470, 471, 472]
-        self.face_mesh = self.mp_face_mesh.FaceMesh(
-            max_num_faces=1,
-            refine_landmarks=True,
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5
-        )
+# Region of interest mode: once a face is found, later frames only run FaceMesh
+# on a padded box around it, downscaled to at most GAZE_ROI_WIDTH pixels wide.
+# Pays off on large frames; FaceMesh already runs its models on fixed size
+# crops, so at webcam resolutions there is little left to save
+GAZE_ROI = os.environ.get("GAZE_ROI", "0") == "1"
+GAZE_ROI_WIDTH = int(os.environ.get("GAZE_ROI_WIDTH", "320"))
+# Padding added on each side of the face box, as a fraction of its size
+GAZE_ROI_PADDING = float(os.environ.get("GAZE_ROI_PADDING", "0.3"))
+
+
+class GazeState:
+    """Temporal gaze state of one person: the away and no-face timers.
+
+    Kept apart from EyeTracker so every session gets its own timers while the
+    heavyweight FaceMesh model can be shared through a pool.
+    """
+
+    def __init__(self, model=gaze.GAZE_MODEL, calibration=None, smoothing=filters.GAZE_FILTER):
+        # "pose" classifies GazeSamples with the gaze engine, "position" uses
+        # the absolute x of the iris centers as before
+        self.model = model
+        # gaze.Calibration of this student for the pose model; None measures
+        # against straight ahead with the default limits
+        self.calibration = calibration
+        # filters.GazeFilter smoothing the measurements and debouncing the
+        # direction, or None to decide from each frame alone
+        self.filter = filters.GazeFilter() if smoothing else None
         self.away_start_time = None
         self.away_flagged = False
         self.no_face_start_time = None
         self.no_face_flagged = False
 
-    def locate_pupil(self, landmarks, eye_index, image_width, Image_height):
-        pupils_co_ordinates = []
-        for i in eye_index:
-            x = int(landmarks.landmark[i].x * image_width)
-            y = int(landmarks.landmark[i].y * Image_height)
-            pupils_co_ordinates.append((x, y))
-        if pupils_co_ordinates:
-            pcx = int(np.mean([i[0] for i in pupils_co_ordinates]))
-            pcy = int(np.mean([i[1] for i in pupils_co_ordinates]))
-            return pcx, pcy
-        return None, None
-
-    def locate_gaze_direction(self, left_eye_x, right_eye_x, frame_width):
-        eye_avg_x = (left_eye_x + right_eye_x) / 2
-        now = time.time()
+    def track_away(self, direction, away, now):
+        """Run the look-away timer on one frame and return the direction to report"""
+        if self.filter is not None:
+            # A single frame that reads as centered no longer resets the timer
+            direction, away = self.filter.debounce(direction, away, now)
 
         # If already flagged for looking away, keep returning the flagged message until gaze is centered
         if self.away_flagged:
-            if frame_width * 0.45 <= eye_avg_x <= frame_width * 0.65:
+            if not away:
                 self.away_flagged = False
                 self.away_start_time = None
             else:
                 return "Flagged: Looking away for 3+ seconds"
 
         # Check if looking away (left or right)
-        if eye_avg_x < frame_width * 0.45 or eye_avg_x > frame_width * 0.65:
+        if away:
             if self.away_start_time is None:
                 self.away_start_time = now
             elif now - self.away_start_time >= 3:
                 self.away_flagged = True
         else:
             self.away_start_time = None
+        return direction
+
+    def locate_gaze_direction(self, left_eye_x, right_eye_x, frame_width, now=None):
+        eye_avg_x = (left_eye_x + right_eye_x) / 2
+        now = time.time() if now is None else now
+        if self.filter is not None:
+            eye_avg_x = self.filter.smooth_position(eye_avg_x / frame_width, now) * frame_width
+        away = eye_avg_x < frame_width * 0.45 or eye_avg_x > frame_width * 0.65
 
         # Normal gaze direction logic
         if eye_avg_x < frame_width * 0.49:
-            return "looking right"
+            direction = "looking right"
         elif eye_avg_x > frame_width * 0.59:
-            return "Looking left"
+            direction = "Looking left"
         else:
-            return "Looking Center"
+            direction = "Looking Center"
+        return self.track_away(direction, away, now)
 
-    def process_frame(self, frame):
-        image_height, image_width, _ = frame.shape
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        results = self.face_mesh.process(frame_rgb)
-        now = time.time()
+    def locate_gaze_pose(self, sample, now=None):
+        """Direction of a gaze.GazeSample from eye ratios and head pose"""
+        now = time.time() if now is None else now
+        baseline = self.calibration.baseline if self.calibration is not None else gaze.STRAIGHT_AHEAD
+        horizontal, pitch = gaze.gaze_angles(sample, baseline)
+        if self.filter is not None:
+            horizontal, pitch = self.filter.smooth_angles(horizontal, pitch, now)
+        direction, away = gaze.classify_angles(horizontal, pitch, self.calibration)
+        return self.track_away(direction, away, now)
+
+    def classify(self, eyes, image_width, now=None):
+        """Turn the output of detect() into a direction, updating the away/no-face timers.
+
+        ``now`` is the frame time in seconds; it defaults to the wall clock, and
+        offline analysis passes the frame's position in the recording instead.
+        """
+        now = time.time() if now is None else now
 
-        if results.multi_face_landmarks:
+        if eyes is not None:
             # Face detected, reset no-face flag
             self.no_face_start_time = None
             self.no_face_flagged = False
-            for landmarks in results.multi_face_landmarks:
-                left_eye_x, left_eye_y = self.locate_pupil(landmarks, self.left_iris, image_width, image_height)
-                right_eye_x, right_eye_y = self.locate_pupil(landmarks, self.right_iris, image_width, image_height)
-                if left_eye_x and right_eye_x:
-                    direction = self.locate_gaze_direction(left_eye_x, right_eye_x, image_width)
-                    return {"direction": direction}
-            # If landmarks exist but eyes can't be tracked, treat as no face
-            if not self.no_face_flagged:
-                if self.no_face_start_time is None:
-                    self.no_face_start_time = now
-                elif now - self.no_face_start_time >= 3:
-                    self.no_face_flagged = True
-                return {"direction": "No face detected"}
-                
-            return {"direction": "No face detected"}
+            if self.model == "pose" and isinstance(eyes, gaze.GazeSample):
+                return {"direction": self.locate_gaze_pose(eyes, now)}
+            (left_eye_x, _), (right_eye_x, _) = eyes[:2]
+            direction = self.locate_gaze_direction(left_eye_x, right_eye_x, image_width, now)
+            return {"direction": direction}
+
+        # No face detected (or landmarks exist but eyes can't be tracked)
+        if not self.no_face_flagged:
+            if self.no_face_start_time is None:
+                self.no_face_start_time = now
+            elif now - self.no_face_start_time >= 3:
+                self.no_face_flagged = True
+        return {"direction": "No face detected"}
+
+
+class EyeTracker:
+    def __init__(self, roi=GAZE_ROI, roi_width=GAZE_ROI_WIDTH, roi_padding=GAZE_ROI_PADDING):
+        # Verify MediaPipe is properly imported
+        if not hasattr(mp, 'solutions'):
+            raise AttributeError(
+                f"MediaPipe 'solutions' module not found. "
+                f"MediaPipe version: {getattr(mp, '__version__', 'unknown')}. "
+                f"Available attributes: {dir(mp)}"
+            )
+        self.mp_face_mesh = mp.solutions.face_mesh
+        # Don't open camera here - it will be opened in main.py
+        # self.cap = cv2.VideoCapture(0)  # Removed to avoid conflicts
+        self.left_iris = lm.LEFT_IRIS
+        self.right_iris = lm.RIGHT_IRIS
+        self.face_mesh = self._new_face_mesh()
+        # Gaze state for process_frame(); the server keeps one GazeState per
+        # session instead and only uses detect() on pooled trackers
+        self.state = GazeState()
+        self.roi = roi
+        self.roi_width = roi_width
+        self.roi_padding = roi_padding
+        # Landmarks of the latest frame with a face, (478, 3) in frame pixels
+        self.landmarks = lm.LandmarkBuffer()
+        # Face box (x0, y0, x1, y1) in pixels from the previous frame, None when tracking is lost
+        self.face_box = None
+        # Crops, ours in ROI mode or the client's, get their own model: FaceMesh
+        # tracks the face from frame to frame in normalized coordinates, which
+        # would jump whenever one model switched between whole frames and crops.
+        # Without ROI mode it is only built once a client sends a crop
+        self.roi_face_mesh = self._new_face_mesh() if roi else None
+
+    def _new_face_mesh(self):
+        return self.mp_face_mesh.FaceMesh(
+            max_num_faces=1,
+            refine_landmarks=True,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
+
+    def warm_up(self):
+        """Run one inference on a blank frame so the first real frame doesn't pay for graph setup"""
+        self.detect(np.zeros((240, 320, 3), dtype=np.uint8))
+        if self.roi_face_mesh is not None:
+            self.roi_face_mesh.process(np.zeros((self.roi_width, self.roi_width, 3), dtype=np.uint8))
+        return self
+
+    def reset(self):
+        """Forget the face tracked so far, e.g. before frames from another camera or recording"""
+        self.face_mesh.reset()
+        if self.roi_face_mesh is not None:
+            self.roi_face_mesh.reset()
+        self.face_box = None
+        return self
+
+    def locate_pupil(self, landmarks, eye_index, image_width, Image_height):
+        points = self.landmarks.load(landmarks, image_width, Image_height)
+        pcx, pcy = points[eye_index, :2].mean(axis=0)
+        return int(pcx), int(pcy)
+
+    def detect(self, frame, origin=None):
+        """Run FaceMesh on a BGR frame and locate both iris centers.
+
+        Returns a gaze.GazeSample, whose first two fields are the iris centers
+        ((left_x, left_y), (right_x, right_y)) in pixels of ``frame``, or None
+        when no face is found. Only touches the FaceMesh model, not the
+        temporal gaze state, so it can run on a worker.
+
+        ``origin`` (x, y, frame_width, frame_height) says ``frame`` is a crop
+        at (x, y) of a larger camera frame (see frames.frame_origin()); the
+        sample is then measured in that frame's coordinates.
+
+        In ROI mode FaceMesh runs on the face box of the previous frame; if the
+        face isn't found there, the whole frame is searched again.
+        """
+        if origin is not None and origin == (0, 0, frame.shape[1], frame.shape[0]):
+            # gaze.binary.v2 sends whole frames with a header too
+            origin = None
+        if origin is not None:
+            # Already cropped by the client
+            self.face_box = None
+            return self._detect_in(frame, None, origin)
+        if self.roi and self.face_box is not None:
+            eyes = self._detect_in(frame, self.face_box)
+            if eyes is not None:
+                return eyes
+            self.face_box = None
+        return self._detect_in(frame, None)
+
+    def _detect_in(self, frame, box, origin=None):
+        """Detect in ``box`` of ``frame`` (the whole frame if None), returning full frame coordinates"""
+        if box is None:
+            x0, y0 = 0, 0
+            region = frame
+        else:
+            x0, y0, x1, y1 = box
+            region = frame[y0:y1, x0:x1]
+            if region.shape[1] > self.roi_width:
+                # Landmarks come back normalized, so the scale doesn't need undoing
+                height = max(1, round(region.shape[0] * self.roi_width / region.shape[1]))
+                region = cv2.resize(region, (self.roi_width, height), interpolation=cv2.INTER_LINEAR)
+        region_height, region_width = (y1 - y0, x1 - x0) if box is not None else frame.shape[:2]
+        frame_rgb = cv2.cvtColor(region, cv2.COLOR_BGR2RGB)
+        if box is None and origin is None:
+            face_mesh = self.face_mesh
+        else:
+            if self.roi_face_mesh is None:
+                self.roi_face_mesh = self._new_face_mesh()
+            face_mesh = self.roi_face_mesh
+        results = face_mesh.process(frame_rgb)
+
+        if not results.multi_face_landmarks:
+            return None
+        if origin is not None:
+            x0, y0, frame_width, frame_height = origin
         else:
-            # No face detected
-            if not self.no_face_flagged:
-                if self.no_face_start_time is None:
-                    self.no_face_start_time = now
-                elif now - self.no_face_start_time >= 3:
-                    self.no_face_flagged = True
-                return {"direction": "No face detected"}
-                    
-            return {"direction": "No face detected"}
+            frame_height, frame_width = frame.shape[:2]
+        # One vectorized copy of all landmarks, already in frame pixels
+        points = self.landmarks.load(results.multi_face_landmarks[0], region_width, region_height, x0, y0)
+        if self.roi and origin is None:
+            self.face_box = self._face_box(points, frame.shape)
+        return gaze.measure(points, frame_width, frame_height)
+
+    def _face_box(self, points, frame_shape):
+        """Padded square box around the face, in frame pixels"""
+        min_x, min_y, max_x, max_y = lm.bounds(points)
+        center_x = (min_x + max_x) / 2
+        center_y = (min_y + max_y) / 2
+        half = max(max_x - min_x, max_y - min_y) * (0.5 + self.roi_padding)
+        frame_height, frame_width = frame_shape[:2]
+        box = (max(0, int(center_x - half)), max(0, int(center_y - half)),
+               min(frame_width, int(center_x + half)), min(frame_height, int(center_y + half)))
+        if box[2] - box[0] < 16 or box[3] - box[1] < 16:
+            return None
+        current = self.face_box
+        if current is not None:
+            # Keep the box while the face stays well inside it: a crop that moves
+            # every frame makes the face jump around inside it between frames
+            size = current[2] - current[0]
+            margin = size * self.roi_padding / (1 + 2 * self.roi_padding) / 2
+            if (min_x >= current[0] + margin and max_x <= current[2] - margin
+                    and min_y >= current[1] + margin and max_y <= current[3] - margin
+                    and abs((box[2] - box[0]) - size) < 0.2 * size):
+                return current
+        return box
+
+    def process_frame(self, frame):
+        return self.state.classify(self.detect(frame), frame.shape[1])